@@ -1,20 +1,55 @@
-from flask import Flask, render_template, redirect, url_for
+from flask import Flask, Request, render_template, redirect, url_for, current_app
 from flask_login import LoginManager
-from flask_migrate import Migrate
+from flask_migrate import Migrate, upgrade
 from models import db, User, Category, Product
+import database
+from sqlalchemy.orm import joinedload
 from config import Config
+import stats
+import search
+import jobs
+import catalog_cache
+import fragment_cache
+import http_cache
+import uploads
+import recommendations
 import os
 from datetime import datetime
 import pytz
 
 
+class UploadLimitRequest(Request):
+    """Request that allows larger bodies on endpoints which stream their uploads"""
+    
+    # Endpoint -> config key holding its upload size limit
+    CONTENT_LENGTH_LIMITS = {
+        'admin.bulk_upload_products': 'BULK_UPLOAD_MAX_CONTENT_LENGTH',
+    }
+    
+    @property
+    def max_content_length(self):
+        config_key = self.CONTENT_LENGTH_LIMITS.get(self.endpoint)
+        if config_key and current_app:
+            return current_app.config[config_key]
+        return super().max_content_length
+
+
 def create_app():
     app = Flask(__name__)
+    app.request_class = UploadLimitRequest
     app.config.from_object(Config)
     
     # Initialize extensions
-    db.init_app(app)
-    migrate = Migrate(app, db)
+    database.init_app(app)
+    migrate = Migrate(app, db, directory=os.path.join(os.path.dirname(__file__), 'migrations'))
+    stats.init_app(app)
+    search.init_app(app)
+    jobs.init_app(app)
+    catalog_cache.init_app(app)
+    fragment_cache.init_app(app)
+    http_cache.init_app(app)
+    uploads.init_app(app)
+    recommendations.init_app(app)
     
     login_manager = LoginManager()
     login_manager.init_app(app)
@@ -98,8 +133,8 @@ def create_app():
     
     # ========== ROUTES ==========
     
-    @app.route('/')
-    def index():
+    def load_home():
+        """Snapshot the categories and featured products shown on the home page"""
         try:
             # Only show active categories and products
             categories = Category.query.filter_by(is_active=True).all()
@@ -109,13 +144,25 @@ def create_app():
             categories = Category.query.all()
         
         try:
-            featured_products = Product.query.filter_by(is_active=True).limit(8).all()
+            featured_products = Product.query.filter_by(is_active=True) \
+                .options(joinedload(Product.category)).limit(8).all()
         except Exception as e:
             print(f'Error querying Product with is_active filter: {type(e).__name__}: {e}')
             # Fallback to all products if error
-            featured_products = Product.query.limit(8).all()
+            featured_products = Product.query.options(joinedload(Product.category)).limit(8).all()
         
-        return render_template('index.html', categories=categories, featured_products=featured_products)
+        return ([catalog_cache.snapshot_category(category) for category in categories],
+                [catalog_cache.snapshot_product(product) for product in featured_products])
+    
+    @app.route('/')
+    @database.read_only
+    @http_cache.catalog_page
+    def index():
+        categories, featured_products = catalog_cache.cached('home', load_home)
+        stock = catalog_cache.stock_levels(product.id for product in featured_products)
+        http_cache.check_stock(stock)
+        return render_template('index.html', categories=categories, featured_products=featured_products,
+                               stock=stock)
     
     @app.route('/shop')
     def shop():
@@ -129,5 +176,5 @@ app = create_app()
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        upgrade()
     app.run(debug=True)
\ No newline at end of file
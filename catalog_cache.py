@@ -0,0 +1,410 @@
+"""
+Catalog Cache
+-------------
+Caches what the storefront shows (active categories, featured products,
+shop pages) as plain snapshots, keyed by a catalog version number.
+
+The version is a row in the stat_counter table ('catalog.version'). It is
+bumped inside the same transaction as every change to a Product or Category:
+automatically for ORM flushes, and through bump_version() for Core writes
+that bypass the ORM (bulk imports). A page view reads the version with one
+primary-key lookup, so an admin edit shows up on the very next request in
+every process, while an unchanged catalog is served without touching the
+product tables.
+
+Stock is not part of the catalog: checkouts and subscription runs change it
+all the time, and bumping the version for them would throw away every cached
+page on every order. Snapshots leave it out, and pages read the stock of the
+products they show live (stock_levels()). A flush that changes nothing but
+Product.stock doesn't bump the version either.
+
+The same transaction appends the ids of the products it changed to the
+product_change log (Core writers pass them to bump_version()), so in-memory
+indexes such as the shop facets (facets.py) can re-read just those rows.
+Stock changes are logged as stock_only entries when they matter to those
+indexes - a product selling out (log_stock_changes(), called by
+stock.reserve_stock()) or an admin changing the stock - and indexes of
+catalog data only (suggest.py) skip them. The log keeps the last
+CHANGE_LOG_SIZE entries.
+
+Entries are kept in two tiers:
+  - an LRU of CATALOG_CACHE_SIZE entries in each process
+  - optionally a SQLite file shared by the processes on one host
+    (CATALOG_CACHE_PATH), so workers don't each rebuild the same pages
+
+Snapshots are namedtuples rather than ORM objects, so they can be shared
+between requests and pickled to the shared tier; templates read them the
+same way (product.category.name etc.). Force every page to be rebuilt with:
+    flask --app app clear-catalog-cache
+"""
+
+import logging
+import os
+import pickle
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app, g, has_request_context
+from flask_sqlalchemy.pagination import Pagination
+from sqlalchemy import case, event, inspect
+from sqlalchemy.orm import Session
+
+from models import db, Category, Product, ProductChange, StatCounter
+import uploads
+
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'catalog.version'
+
+# Changes to these models invalidate every cached page (except stock-only product changes)
+CATALOG_MODELS = (Product, Category)
+
+# Entries kept in the product_change log, pruned by about one write in CHANGE_LOG_PRUNE_EVERY
+CHANGE_LOG_SIZE = 100000
+CHANGE_LOG_PRUNE_EVERY = 1000
+
+
+# Product columns that can change without changing the catalog version
+STOCK_ATTRIBUTES = {'stock', 'stock_updated_at'}
+
+
+# image_variants: whether resized variants of an uploaded image exist (uploads.py)
+CategorySnapshot = namedtuple('CategorySnapshot', 'id name description image image_variants')
+ProductSnapshot = namedtuple('ProductSnapshot', 'id name description price image image_variants category_id category')
+
+
+def snapshot_category(category):
+    return CategorySnapshot(category.id, category.name, category.description, category.image,
+                            uploads.has_variants('categories', category.image))
+
+
+def snapshot_product(product):
+    category = snapshot_category(product.category) if product.category else None
+    return ProductSnapshot(product.id, product.name, product.description, product.price, product.image,
+                           uploads.has_variants('products', product.image),
+                           product.category_id, category)
+
+
+class SnapshotPagination(Pagination):
+    """Flask-SQLAlchemy pagination over a cached page of items and its total"""
+
+    def _query_items(self):
+        return self._query_args['items']
+
+    def _query_count(self):
+        return self._query_args['total']
+
+
+# ========== VERSION ==========
+
+def get_version():
+    """
+    Current catalog version, or None if it hasn't been created yet (caching is
+    skipped). Read once per request; a bump in the same request reads it again.
+    """
+    if has_request_context() and 'catalog_version' in g:
+        return g.catalog_version
+
+    value = db.session.execute(
+        db.select(StatCounter.value).where(StatCounter.key == VERSION_KEY)
+    ).scalar()
+    version = None if value is None else int(value)
+    if has_request_context():
+        g.catalog_version = version
+    return version
+
+
+def _bump(connection, product_ids=()):
+    # The version is the change time in milliseconds (or one past the previous
+    # version if that is later), so a recreated row never reuses an old version
+    now = int(time.time() * 1000)
+    table = StatCounter.__table__
+    updated = connection.execute(
+        table.update().where(table.c.key == VERSION_KEY).values(
+            value=case((table.c.value + 1 > now, table.c.value + 1), else_=now)
+        )
+    )
+    if updated.rowcount == 0:
+        connection.execute(table.insert().values(key=VERSION_KEY, value=now))
+    if has_request_context():
+        g.pop('catalog_version', None)
+    _log(connection, product_ids, stock_only=False)
+
+
+def _log(connection, product_ids, stock_only):
+    # Logged after a write to the version row, whose row lock orders concurrent
+    # catalog writes, so log ids become visible in increasing order
+    if product_ids:
+        log = ProductChange.__table__
+        connection.execute(log.insert(), [{'product_id': product_id, 'stock_only': stock_only}
+                                          for product_id in product_ids])
+        if random.randrange(CHANGE_LOG_PRUNE_EVERY) == 0:
+            newest = connection.execute(db.select(db.func.max(log.c.id))).scalar()
+            connection.execute(log.delete().where(log.c.id <= newest - CHANGE_LOG_SIZE))
+
+
+def _log_stock(connection, product_ids):
+    if not product_ids:
+        return
+    # Takes the version row's lock without changing the version, so the
+    # entries are ordered with the catalog writes' and no cached page is lost
+    table = StatCounter.__table__
+    connection.execute(table.update().where(table.c.key == VERSION_KEY).values(value=table.c.value))
+    _log(connection, product_ids, stock_only=True)
+
+
+def products_with_image(kind, filenames):
+    """
+    Ids of the products whose snapshots show one of the uploaded images: as
+    their own image (kind 'products') or their category's ('categories')
+    """
+    filenames = list(filenames)
+    if not filenames:
+        return []
+    if kind == 'products':
+        statement = db.select(Product.id).where(Product.image.in_(filenames))
+    else:
+        statement = db.select(Product.id).join(Category, Category.id == Product.category_id) \
+            .where(Category.image.in_(filenames))
+    return db.session.execute(statement).scalars().all()
+
+
+def bump_version(product_ids=()):
+    """
+    Invalidate cached pages for writes that bypass ORM flush events (Core
+    updates/inserts). Pass the ids of products whose row changed.
+    """
+    _bump(db.session.connection(), sorted(set(product_ids)))
+
+
+def log_stock_changes(product_ids):
+    """
+    Log products whose stock changed in a way the in-memory indexes must see
+    (sold out) for Core writes, without bumping the catalog version
+    """
+    _log_stock(db.session.connection(), sorted(set(product_ids)))
+
+
+class StockLevels(dict):
+    """{product id: stock}, with the time of the newest stock change among them (None if unknown)"""
+
+    def __init__(self, levels=(), updated_at=None):
+        super().__init__(levels)
+        self.updated_at = updated_at
+
+
+def stock_levels(product_ids):
+    """StockLevels read live, for pages that show cached snapshots"""
+    product_ids = list(product_ids)
+    if not product_ids:
+        return StockLevels()
+    rows = db.session.execute(
+        db.select(Product.id, Product.stock, Product.stock_updated_at).where(Product.id.in_(product_ids))
+    ).all()
+    changed = [row.stock_updated_at for row in rows if row.stock_updated_at is not None]
+    return StockLevels(((row.id, row.stock) for row in rows), max(changed, default=None))
+
+
+def newest_change():
+    """Id of the newest product_change entry (0 if there is none)"""
+    log = ProductChange.__table__
+    return db.session.execute(db.select(db.func.max(log.c.id))).scalar() or 0
+
+
+def changed_products(after, limit, stock=True):
+    """
+    (newest change id, ids of the products changed since change `after`), or
+    (newest change id, None) if that is more than `limit` products or the
+    log no longer reaches back that far. Pass stock=False to leave out
+    stock-only changes.
+    """
+    log = ProductChange.__table__
+    oldest, newest = db.session.execute(db.select(db.func.min(log.c.id), db.func.max(log.c.id))).one()
+    if newest is None or newest <= after:
+        return after, set()
+    if oldest > after + 1:
+        return newest, None
+
+    statement = db.select(log.c.product_id).where(log.c.id > after, log.c.id <= newest)
+    if not stock:
+        statement = statement.where(log.c.stock_only == False)
+    product_ids = set(db.session.execute(statement.distinct().limit(limit + 1)).scalars())
+    return newest, product_ids if len(product_ids) <= limit else None
+
+
+def _stock_only(product):
+    """Whether a flushed product changed nothing but its stock"""
+    return all(attribute.key in STOCK_ATTRIBUTES or not attribute.history.has_changes()
+               for attribute in inspect(product).attrs)
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_on_catalog_change(session, flush_context):
+    changed = [obj for obj in session.new if isinstance(obj, CATALOG_MODELS)] \
+        + [obj for obj in session.deleted if isinstance(obj, CATALOG_MODELS)]
+    stock_changed = []
+    for obj in session.dirty:
+        if not isinstance(obj, CATALOG_MODELS) or not session.is_modified(obj, include_collections=False):
+            continue
+        if isinstance(obj, Product) and _stock_only(obj):
+            stock_changed.append(obj)
+        else:
+            changed.append(obj)
+
+    if changed:
+        _bump(session.connection(), sorted({obj.id for obj in changed + stock_changed if isinstance(obj, Product)}))
+    elif stock_changed:
+        _log_stock(session.connection(), sorted({obj.id for obj in stock_changed}))
+
+
+# ========== LOCAL TIER ==========
+
+class _LRU:
+    """Thread-safe LRU of one catalog version's entries; older versions are dropped on sight"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.version = None
+
+    def get(self, version, key):
+        with self.lock:
+            if version != self.version:
+                return None
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, version, key, value, size):
+        with self.lock:
+            if self.version is None or version > self.version:
+                self.entries.clear()
+                self.version = version
+            elif version < self.version:
+                return  # built from an older catalog than the one already cached
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.version = None
+
+
+_local = _LRU()
+
+
+# ========== SHARED TIER ==========
+
+class _SharedStore:
+    """Best-effort SQLite file of pickled entries; any error counts as a miss"""
+
+    def __init__(self):
+        self.connections = threading.local()
+        self.purged_below = 0
+
+    def _connection(self, path):
+        connection = getattr(self.connections, 'connection', None)
+        if connection is None or self.connections.path != path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(path, timeout=1, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS catalog_cache ('
+                'version INTEGER NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, '
+                'PRIMARY KEY (version, key))'
+            )
+            self.connections.connection = connection
+            self.connections.path = path
+        return connection
+
+    def get(self, path, version, key):
+        try:
+            row = self._connection(path).execute(
+                'SELECT value FROM catalog_cache WHERE version = ? AND key = ?', (version, key)
+            ).fetchone()
+            return pickle.loads(row[0]) if row else None
+        except (sqlite3.Error, pickle.UnpicklingError, AttributeError, EOFError, TypeError) as e:
+            # TypeError: pickled by an older release whose snapshot fields differ
+            logger.debug(f"Shared catalog cache read failed: {e}")
+            return None
+
+    def set(self, path, version, key, value):
+        try:
+            connection = self._connection(path)
+            connection.execute(
+                'INSERT OR REPLACE INTO catalog_cache (version, key, value) VALUES (?, ?, ?)',
+                (version, key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+            )
+            if version > self.purged_below:
+                self.purged_below = version
+                connection.execute('DELETE FROM catalog_cache WHERE version < ?', (version,))
+        except sqlite3.Error as e:
+            logger.debug(f"Shared catalog cache write failed: {e}")
+
+    def clear(self, path):
+        try:
+            self._connection(path).execute('DELETE FROM catalog_cache')
+        except sqlite3.Error as e:
+            logger.debug(f"Shared catalog cache clear failed: {e}")
+
+
+_shared = _SharedStore()
+
+
+# ========== LOOKUP ==========
+
+def cached(name, loader, *args, shared=True):
+    """
+    Return loader(*args) for the current catalog version, building it on a miss.
+    The result must be picklable (snapshots, not ORM objects). Pass shared=False
+    for keys that are unlikely to repeat across processes (e.g. search terms).
+    """
+    version = get_version()
+    if version is None:
+        return loader(*args)
+
+    key = repr((name,) + args)
+    value = _local.get(version, key)
+    if value is not None:
+        return value
+
+    path = current_app.config.get('CATALOG_CACHE_PATH')
+    if shared and path:
+        value = _shared.get(path, version, key)
+
+    if value is None:
+        value = loader(*args)
+        if shared and path:
+            _shared.set(path, version, key, value)
+
+    _local.set(version, key, value, current_app.config['CATALOG_CACHE_SIZE'])
+    return value
+
+
+def clear():
+    """Bump the catalog version and drop this process's entries"""
+    bump_version()
+    db.session.commit()
+    _local.clear()
+    path = current_app.config.get('CATALOG_CACHE_PATH')
+    if path:
+        _shared.clear(path)
+
+
+def init_app(app):
+    """Register the clear-catalog-cache CLI command"""
+    @app.cli.command('clear-catalog-cache')
+    def clear_catalog_cache_command():
+        """Invalidate all cached storefront pages (also creates the catalog version)."""
+        clear()
+        print(f"Catalog cache cleared, now at version {get_version()}")
@@ -2,11 +2,71 @@ import os
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///grocery.db'
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///grocery.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'static/uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+    DATA_URI_MAX_LENGTH = int(os.environ.get('DATA_URI_MAX_LENGTH', 1024 * 1024))  # longest data:image URI accepted in image fields
+    IMAGE_VARIANT_WIDTHS = [int(width) for width in os.environ.get('IMAGE_VARIANT_WIDTHS', '320,640,1024').split(',')]  # resized upload widths (px)
+
+    # Database engine profile (see database.py)
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))  # ms a writer waits for the lock before "database is locked"
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')  # FULL for fsync on every commit
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))  # bytes of the file read through mmap; 0 = off
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))  # PostgreSQL connections kept open per process
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))  # extra connections allowed under load
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 10))  # seconds to wait for a free connection
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))  # seconds before a connection is replaced
+    DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 30000))  # ms; PostgreSQL cancels longer statements
+    DB_LOCK_TIMEOUT = int(os.environ.get('DB_LOCK_TIMEOUT', 5000))  # ms; PostgreSQL gives up waiting for a row lock
+    DATABASE_REPLICA_URLS = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]  # read replicas for @read_only views
+    REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 10))  # after writing, a browser reads from the primary this long
+
+    # Subscription scheduler settings
+    SUBSCRIPTION_BATCH_SIZE = int(os.environ.get('SUBSCRIPTION_BATCH_SIZE', 500))  # subscriptions per commit in batch mode
+
+    # Stock reservation retries on lock contention (checkout, scheduler)
+    STOCK_RETRY_ATTEMPTS = int(os.environ.get('STOCK_RETRY_ATTEMPTS', 5))
+    STOCK_RETRY_BASE_DELAY = float(os.environ.get('STOCK_RETRY_BASE_DELAY', 0.05))  # seconds, doubled per attempt
+
+    # Bulk product import
+    PRODUCT_IMPORT_CHUNK_SIZE = int(os.environ.get('PRODUCT_IMPORT_CHUNK_SIZE', 1000))  # rows read, written and committed at a time
+    BULK_UPLOAD_MAX_CONTENT_LENGTH = int(os.environ.get('BULK_UPLOAD_MAX_CONTENT_LENGTH', 512 * 1024 * 1024))  # files are streamed, so this can exceed MAX_CONTENT_LENGTH
+
+    # Admin CSV/Excel exports (see exports.py)
+    EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 2000))  # rows fetched and written out at a time
+
+    # Background jobs (see jobs.py)
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))  # worker threads per web process; 0 = use `flask run-jobs`
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 2))  # seconds between idle checks for new jobs
+    JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', 300))  # a running job without heartbeat this long is presumed dead
+    JOB_PROGRESS_INTERVAL = float(os.environ.get('JOB_PROGRESS_INTERVAL', 1))  # min seconds between progress writes
+    JOB_FILES_FOLDER = os.environ.get('JOB_FILES_FOLDER') or os.path.join(os.path.dirname(__file__), 'instance', 'job_files')
+
+    # Storefront caches (see catalog_cache.py, fragment_cache.py and http_cache.py)
+    CATALOG_CACHE_SIZE = int(os.environ.get('CATALOG_CACHE_SIZE', 512))  # cached pages per process
+    CATALOG_CACHE_PATH = os.environ.get('CATALOG_CACHE_PATH')  # optional SQLite file shared by processes on one host
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 2048))  # rendered product cards/category lists per process
+    UPLOAD_CACHE_MAX_AGE = int(os.environ.get('UPLOAD_CACHE_MAX_AGE', 365 * 24 * 3600))  # seconds browsers keep content-hashed uploads
+
+    # Shop filters (see facets.py)
+    SHOP_PRICE_BANDS = [float(edge) for edge in os.environ.get('SHOP_PRICE_BANDS', '50,100,250,500').split(',')]  # band edges (₹): under 50, 50-100, ..., 500 and up
+
+    # Shop search (see search.py)
+    SEARCH_MATCH_LIMIT = int(os.environ.get('SEARCH_MATCH_LIMIT', 1000))  # matches a search ranks, pages and counts
+
+    # Shop search-as-you-type (see suggest.py)
+    SUGGEST_LIMIT = int(os.environ.get('SUGGEST_LIMIT', 8))  # suggestions returned per query
+    SUGGEST_MAX_AGE = int(os.environ.get('SUGGEST_MAX_AGE', 60))  # seconds browsers may reuse a suggestion response
+
+    # "Frequently bought together" on product pages (see recommendations.py)
+    RECOMMENDATION_TOP_K = int(os.environ.get('RECOMMENDATION_TOP_K', 10))  # neighbours stored per product
+    RECOMMENDATION_MIN_ORDERS = int(os.environ.get('RECOMMENDATION_MIN_ORDERS', 2))  # orders two products must share to be recommended
+    RECOMMENDATION_STATE_PATH = os.environ.get('RECOMMENDATION_STATE_PATH') or os.path.join(os.path.dirname(__file__), 'instance', 'recommendations.npz')  # co-occurrence counts kept for incremental builds
+
+    # Admin and order history listings (see keyset.py)
+    LISTING_PAGINATION = os.environ.get('LISTING_PAGINATION', 'keyset')  # 'keyset' (Newer/Older, any depth) or 'offset' (numbered pages)
 
     # Mail settings
     MAIL_SERVER = 'smtp.gmail.com'
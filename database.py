@@ -0,0 +1,196 @@
+"""
+Database Engine
+---------------
+Engine options and per-connection settings for the configured database
+(DATABASE_URL, default: the SQLite file grocery.db). The profile is picked
+from the URL's backend:
+
+SQLite - one file shared by every gunicorn worker and the scheduler:
+  - journal_mode=WAL, so page views keep reading while a checkout writes
+  - busy_timeout (SQLITE_BUSY_TIMEOUT), so a writer waits its turn instead
+    of failing at once with "database is locked"
+  - synchronous=NORMAL, which is durable with WAL except for the last
+    commits before a power loss, and far cheaper than fsync per commit
+  - mmap_size (SQLITE_MMAP_SIZE), so reads skip a copy through the page cache
+
+PostgreSQL:
+  - a pool of DB_POOL_SIZE connections (+ DB_MAX_OVERFLOW) per process,
+    checked with a ping before use and recycled after DB_POOL_RECYCLE seconds
+  - statement_timeout and lock_timeout on every connection, so a stuck
+    query or lock wait fails the request instead of holding a worker
+
+Options set explicitly in SQLALCHEMY_ENGINE_OPTIONS take precedence.
+
+Read replicas
+-------------
+Replicas of the primary listed in DATABASE_REPLICA_URLS (comma separated)
+become binds replica_1, replica_2, ... Views marked @read_only (catalog
+pages, admin lists and reports) send their reads to one of them, picked
+per request; everything else, and any statement that writes or locks rows,
+stays on the primary. Once a request has written, the rest of it reads the
+primary too, and the browser that wrote is pinned to the primary for
+REPLICA_PIN_SECONDS so it sees its own change even if the replicas lag.
+
+Keeping replicas up to date is the database's job (streaming replication
+on PostgreSQL). Locally, two SQLite files work:
+    DATABASE_REPLICA_URLS=sqlite:////path/to/replica.db
+"""
+
+import random
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session as OrmSession
+
+
+# Cookie holding the time until which a browser that wrote reads from the primary
+PIN_COOKIE = 'db_primary_until'
+
+
+def _postgresql_options(config):
+    timeouts = f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT']} -c lock_timeout={config['DB_LOCK_TIMEOUT']}"
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+        'connect_args': {'options': timeouts},
+    }
+
+
+# Backend name -> engine options (SQLite is tuned per connection instead, see _sqlite_pragmas)
+PROFILES = {
+    'postgresql': _postgresql_options,
+}
+
+
+def normalize_uri(uri):
+    """
+    Accept the postgres:// scheme some hosts still hand out, and use the
+    psycopg2 driver from requirements.txt when the URL names none (newer
+    SQLAlchemy releases default to psycopg 3).
+    """
+    if uri.startswith('postgres://'):
+        uri = 'postgresql://' + uri[len('postgres://'):]
+    url = make_url(uri)
+    if url.drivername == 'postgresql':
+        uri = url.set(drivername='postgresql+psycopg2').render_as_string(hide_password=False)
+    return uri
+
+
+def engine_options(config, uri):
+    """Engine options of the profile for `uri`, overridden by SQLALCHEMY_ENGINE_OPTIONS"""
+    profile = PROFILES.get(make_url(uri).get_backend_name())
+    options = profile(config) if profile else {}
+    options.update(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    return options
+
+
+def _sqlite_pragmas(config):
+    pragmas = [
+        'PRAGMA journal_mode=WAL',
+        f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT'])}",
+        f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}",
+        f"PRAGMA mmap_size={int(config['SQLITE_MMAP_SIZE'])}",
+    ]
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+    return set_pragmas
+
+
+# ========== READ REPLICAS ==========
+
+def read_only(view):
+    """Let a view's reads go to a replica (GET and HEAD only)"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method in ('GET', 'HEAD'):
+            g.db_read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _pinned_to_primary():
+    try:
+        return float(request.cookies.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def _replica_key():
+    """Bind key of the replica serving this request, or None for the primary"""
+    if not has_request_context() or not g.get('db_read_only'):
+        return None
+    if 'db_replica' not in g:
+        replicas = current_app.extensions['database_replicas']
+        g.db_replica = random.choice(replicas) if replicas and not _pinned_to_primary() else None
+    return g.db_replica
+
+
+def _writes(clause):
+    return clause is not None and (clause.is_dml or getattr(clause, '_for_update_arg', None) is not None)
+
+
+class RoutingSession(Session):
+    """db.session: reads in @read_only requests go to a replica, the rest to the primary"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not self.info.get('wrote') and not _writes(clause):
+            key = _replica_key()
+            if key is not None:
+                return self._db.engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(OrmSession, 'after_flush')
+def _stick_to_primary(session, flush_context):
+    # The rest of this request reads the primary, and so does the browser for a while
+    session.info['wrote'] = True
+    if has_request_context():
+        g.db_wrote = True
+
+
+def _pin_writer(response):
+    if g.get('db_wrote') and current_app.extensions['database_replicas']:
+        seconds = current_app.config['REPLICA_PIN_SECONDS']
+        response.set_cookie(PIN_COOKIE, str(time.time() + seconds), max_age=seconds, httponly=True, samesite='Lax')
+    return response
+
+
+def init_app(app):
+    """Apply the engine profiles, initialise Flask-SQLAlchemy and tune SQLite connections"""
+    # models imports RoutingSession from here
+    from models import db
+
+    config = app.config
+    config['SQLALCHEMY_DATABASE_URI'] = normalize_uri(config['SQLALCHEMY_DATABASE_URI'])
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(config, config['SQLALCHEMY_DATABASE_URI'])
+
+    binds = dict(config.get('SQLALCHEMY_BINDS') or {})
+    replicas = []
+    for number, url in enumerate(config['DATABASE_REPLICA_URLS'], 1):
+        url = normalize_uri(url)
+        binds[f'replica_{number}'] = {'url': url, **engine_options(config, url)}
+        replicas.append(f'replica_{number}')
+    config['SQLALCHEMY_BINDS'] = binds
+    app.extensions['database_replicas'] = replicas
+    app.after_request(_pin_writer)
+
+    # Engines are created here, so the options above must be set first
+    db.init_app(app)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', _sqlite_pragmas(config))
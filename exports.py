@@ -0,0 +1,243 @@
+"""
+Data Exports
+------------
+CSV and Excel downloads of orders, order items, products and subscriptions
+for the admin pages, filtered by creation date and status.
+
+Rows are read as plain column tuples through a server-side cursor
+(stream_results + yield_per; a named cursor on PostgreSQL), so neither the
+driver nor the ORM identity map holds the table. The response is a
+generator: CSV goes out EXPORT_CHUNK_SIZE rows at a time as they are read,
+starting with the header before the query has even run, and memory stays
+flat however many rows match.
+
+Excel files are written with openpyxl's write-only mode, which spools each
+row to a temporary file instead of keeping cells in memory (through lxml,
+about 1.5x faster than openpyxl's pure-Python writer). An .xlsx file
+is a zip archive that can only be put together once the last row is in, so
+the download starts when the workbook is saved; the file is then streamed
+in blocks. A sheet holds at most XLSX_MAX_ROWS rows, larger exports carry
+on in further sheets.
+
+Dates (filters and timestamps) are in India time, like the admin pages.
+Text that a spreadsheet would read as a formula (starting with =, +, -, @,
+a tab or a carriage return, e.g. a product named "=HYPERLINK(...)") is
+prefixed with a quote in both formats, so it opens as plain text.
+"""
+
+import csv
+import io
+import tempfile
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+
+import openpyxl
+from flask import Response, current_app, stream_with_context
+
+from models import db, Category, Order, OrderItem, Product, Subscription, User
+import stats
+
+
+FORMATS = ('csv', 'xlsx')
+
+XLSX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Excel's row limit per sheet, header included
+XLSX_MAX_ROWS = 1048576
+
+# Bytes read at a time when streaming a saved workbook
+FILE_BLOCK_SIZE = 64 * 1024
+
+# India time, as on the admin pages (app.py to_ist); one fixed offset since 1945
+LOCAL_OFFSET = timedelta(hours=5, minutes=30)
+
+# Leading characters that make Excel, LibreOffice or Sheets evaluate a cell
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+# title: sheet and file name; headers: column titles; select: statement of the
+# exported columns; created_at: column the date range applies to;
+# statuses: accepted status filter values; filter_status: status -> where clause
+Export = namedtuple('Export', 'title headers select created_at statuses filter_status')
+
+
+def _orders():
+    item_count = db.select(db.func.count(OrderItem.id)).where(OrderItem.order_id == Order.id).scalar_subquery()
+    return db.select(
+        Order.id, Order.created_at, User.username, User.email, Order.status, Order.payment_method,
+        item_count, Order.total_amount, Order.delivery_address, Order.phone
+    ).join(User, Order.user_id == User.id).order_by(Order.created_at, Order.id)
+
+
+def _order_items():
+    return db.select(
+        Order.id, Order.created_at, Order.status, User.username, Product.sku, Product.name,
+        OrderItem.quantity, OrderItem.price, OrderItem.quantity * OrderItem.price
+    ).join(Order, OrderItem.order_id == Order.id) \
+        .join(User, Order.user_id == User.id) \
+        .outerjoin(Product, OrderItem.product_id == Product.id) \
+        .order_by(Order.created_at, Order.id)
+
+
+def _products():
+    return db.select(
+        Product.id, Product.sku, Product.name, Category.name, Product.price, Product.stock,
+        Product.is_active, Product.created_at
+    ).join(Category, Product.category_id == Category.id).order_by(Product.created_at, Product.id)
+
+
+def _subscriptions():
+    return db.select(
+        Subscription.id, Subscription.created_at, User.username, User.email, Subscription.name,
+        Subscription.frequency, Subscription.delivery_time, Subscription.status, Subscription.is_active,
+        Subscription.next_delivery
+    ).join(User, Subscription.user_id == User.id).order_by(Subscription.created_at, Subscription.id)
+
+
+EXPORTS = {
+    'orders': Export(
+        'Orders',
+        ['Order ID', 'Created (IST)', 'Customer', 'Email', 'Status', 'Payment', 'Items', 'Total',
+         'Delivery Address', 'Phone'],
+        _orders, Order.created_at, stats.ORDER_STATUSES, lambda status: Order.status == status
+    ),
+    'order_items': Export(
+        'Order Items',
+        ['Order ID', 'Created (IST)', 'Status', 'Customer', 'SKU', 'Product', 'Quantity', 'Price', 'Amount'],
+        _order_items, Order.created_at, stats.ORDER_STATUSES, lambda status: Order.status == status
+    ),
+    'products': Export(
+        'Products',
+        ['Product ID', 'SKU', 'Name', 'Category', 'Price', 'Stock', 'Active', 'Created (IST)'],
+        _products, Product.created_at, ('active', 'inactive'),
+        lambda status: Product.is_active == (status == 'active')
+    ),
+    'subscriptions': Export(
+        'Subscriptions',
+        ['Subscription ID', 'Created (IST)', 'Customer', 'Email', 'Name', 'Frequency', 'Delivery Time',
+         'Status', 'Active', 'Next Delivery (IST)'],
+        _subscriptions, Subscription.created_at, stats.SUBSCRIPTION_STATUSES,
+        lambda status: Subscription.status == status
+    ),
+}
+
+
+def parse_date(value):
+    """A date from a YYYY-MM-DD query argument, None if blank; raises ValueError otherwise"""
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _utc_start_of(day):
+    """The UTC time (naive, as stored) at which a local calendar day starts"""
+    return datetime.combine(day, time.min) - LOCAL_OFFSET
+
+
+def _local(value):
+    return value + LOCAL_OFFSET
+
+
+def _csv_datetime(value):
+    return (value + LOCAL_OFFSET).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _yes_no(value):
+    return 'Yes' if value else 'No'
+
+
+def _text(value):
+    """`value` with a quote in front if a spreadsheet would take it for a formula"""
+    return "'" + value if value.startswith(FORMULA_PREFIXES) else value
+
+
+def _converters(statement, for_csv):
+    """(position, function) for the exported columns whose values need converting"""
+    converters = []
+    for position, column in enumerate(statement.selected_columns):
+        if isinstance(column.type, db.String):
+            converters.append((position, _text))
+        elif isinstance(column.type, db.DateTime):
+            converters.append((position, _csv_datetime if for_csv else _local))
+        elif for_csv and isinstance(column.type, db.Boolean):
+            converters.append((position, _yes_no))
+    return converters
+
+
+def _statement(export, date_from, date_to, status):
+    statement = export.select()
+    if date_from is not None:
+        statement = statement.where(export.created_at >= _utc_start_of(date_from))
+    if date_to is not None:
+        statement = statement.where(export.created_at < _utc_start_of(date_to + timedelta(days=1)))
+    if status:
+        statement = statement.where(export.filter_status(status))
+    return statement
+
+
+def _row_blocks(statement, for_csv):
+    """Lists of exported rows, EXPORT_CHUNK_SIZE at a time, from a server-side cursor"""
+    converters = _converters(statement, for_csv)
+    chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
+    result = db.session.execute(statement, execution_options={'stream_results': True, 'yield_per': chunk_size})
+    for rows in result.partitions():
+        rows = [list(row) for row in rows]
+        for row in rows:
+            for position, convert in converters:
+                if row[position] is not None:
+                    row[position] = convert(row[position])
+        yield rows
+
+
+def _csv_chunks(export, statement):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # Byte order mark so Excel opens the file as UTF-8
+    buffer.write('\ufeff')
+    writer.writerow(export.headers)
+    yield buffer.getvalue().encode('utf-8')
+
+    for rows in _row_blocks(statement, for_csv=True):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+
+
+def _xlsx_chunks(export, statement):
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet, sheet_rows, sheets = None, XLSX_MAX_ROWS, 0
+    for rows in _row_blocks(statement, for_csv=False):
+        for row in rows:
+            if sheet_rows == XLSX_MAX_ROWS:
+                sheets += 1
+                sheet = workbook.create_sheet(export.title if sheets == 1 else f'{export.title} {sheets}')
+                sheet.append(export.headers)
+                sheet_rows = 1
+            sheet.append(row)
+            sheet_rows += 1
+    if sheet is None:
+        workbook.create_sheet(export.title).append(export.headers)
+
+    with tempfile.TemporaryFile() as file:
+        workbook.save(file)
+        file.seek(0)
+        while block := file.read(FILE_BLOCK_SIZE):
+            yield block
+
+
+def stream(kind, file_format, date_from=None, date_to=None, status=None):
+    """
+    Streaming download response for one of EXPORTS as 'csv' or 'xlsx', limited
+    to rows created between the two local dates (inclusive) and with `status`.
+    """
+    export = EXPORTS[kind]
+    statement = _statement(export, date_from, date_to, status)
+    chunks = _xlsx_chunks(export, statement) if file_format == 'xlsx' else _csv_chunks(export, statement)
+
+    filename = f"{kind}-{_local(datetime.utcnow()).strftime('%Y%m%d-%H%M')}.{file_format}"
+    response = Response(stream_with_context(chunks),
+                        mimetype=XLSX_MIME_TYPE if file_format == 'xlsx' else 'text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    # Let proxies pass blocks on as they come instead of buffering the whole file
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,265 @@
+"""
+Shop Facets
+-----------
+Filters for the shop page - category, price band (SHOP_PRICE_BANDS) and
+in stock only - with the number of products each choice would show.
+
+Each process keeps the facet columns of every product in numpy arrays
+sorted by product id, about 20 bytes per product. The category, price band
+and stock flag of a product are folded into one joint code, and a histogram
+of the codes of all active products is kept next to the arrays. Every count
+on the page is a sum over that small (categories x bands x 2) histogram -
+a facet's counts apply all the other filters but not its own, so the other
+categories still show how many products they would list - and the page of
+matches comes from scanning the codes only until it is full. Only the
+products on the page are then read from the database. A search counts
+over the (capped) ids full-text search returned instead, and takes its
+page from those ids (search.py page_ids).
+
+The arrays follow the product_change log (catalog_cache.py) rather than
+the catalog version, since products selling out change the in-stock counts
+without a new version. Each selection checks the newest log entry (one
+index lookup); when it moved, the products changed since the last refresh
+are re-read and patched into a copy of the arrays, which then replaces the
+old ones. The arrays are loaded in full on first use, and again when more
+than FULL_RELOAD_CHANGES products changed at once or the log was pruned
+past this process's last refresh.
+"""
+
+import copy
+import threading
+from collections import namedtuple
+
+import numpy as np
+from flask import current_app
+
+from models import db, Product
+import catalog_cache
+
+
+# Beyond this many changed products a full reload is cheaper than patching
+FULL_RELOAD_CHANGES = 10000
+
+# Products scanned at a time when looking for the matches on a page
+SCAN_CHUNK = 65536
+
+COLUMNS = ('ids', 'category_ids', 'bands', 'in_stock', 'active')
+
+# band: index into the price bands; low/high: its bounds (high is None for the last)
+PriceBand = namedtuple('PriceBand', 'band low high count')
+
+# categories: (category_id, count) pairs, price_bands: PriceBand tuples, in_stock: count
+FacetCounts = namedtuple('FacetCounts', 'categories price_bands in_stock')
+
+# ids: product ids of the requested page, in display order
+FacetResult = namedtuple('FacetResult', 'ids total counts')
+
+
+def _columns(rows, edges):
+    """Facet columns of (id, category_id, price, stock, is_active) rows sorted by id"""
+    ids, category_ids, prices, stock, active = zip(*rows) if rows else ((),) * 5
+    return {
+        'ids': np.array(ids, dtype=np.int64),
+        'category_ids': np.array(category_ids, dtype=np.int32),
+        'bands': np.searchsorted(edges, np.array(prices, dtype=np.float64), side='right').astype(np.int8),
+        'in_stock': np.array(stock, dtype=np.int64) > 0,
+        'active': np.array(active, dtype=bool),
+    }
+
+
+def _select_rows(product_ids=None):
+    statement = db.select(Product.id, Product.category_id, Product.price, Product.stock, Product.is_active)
+    if product_ids is not None:
+        statement = statement.where(Product.id.in_(product_ids))
+    return db.session.execute(statement.order_by(Product.id)).all()
+
+
+class FacetIndex:
+    """Facet columns of all products as of one product_change entry"""
+
+    def __init__(self, change_id, edges, ids, category_ids, bands, in_stock, active):
+        self.change_id = change_id  # newest product_change entry applied
+        self.edges = edges
+        self.ids = ids
+        self.category_ids = category_ids
+        self.bands = bands
+        self.in_stock = in_stock
+        self.active = active
+
+        # Joint code: (category number, band, in stock); inactive products get one past the last
+        self.categories = np.unique(category_ids)
+        self.shape = (len(self.categories), len(edges) + 1, 2)
+        self.joint = self._joint(slice(None))
+        self.histogram = self._histogram(self.joint)
+
+    def _joint(self, positions):
+        size = int(np.prod(self.shape))
+        joint = (np.searchsorted(self.categories, self.category_ids[positions]) * self.shape[1]
+                 + self.bands[positions]) * 2 + self.in_stock[positions]
+        return np.where(self.active[positions], joint, size).astype(np.int32)
+
+    def _histogram(self, joint):
+        size = int(np.prod(self.shape))
+        return np.bincount(joint, minlength=size + 1)[:size].reshape(self.shape)
+
+    def refreshed(self, change_id):
+        """This index as of a newer log entry that changed no products"""
+        index = copy.copy(self)
+        index.change_id = change_id
+        return index
+
+    def patched(self, change_id, product_ids):
+        """A copy with the current rows of `product_ids` applied (missing rows count as deleted)"""
+        changed = _columns(_select_rows(sorted(product_ids)), self.edges)
+        requested = np.fromiter(product_ids, dtype=np.int64, count=len(product_ids))
+        found, gone = self._positions(np.setdiff1d(requested, changed['ids']))
+        gone = gone[found]
+        found, positions = self._positions(changed['ids'])
+
+        index = self.refreshed(change_id)
+        for name in COLUMNS:
+            column = getattr(self, name).copy()
+            column[positions[found]] = changed[name][found]
+            setattr(index, name, column)
+        # Products no longer in the table drop out of every count
+        index.active[gone] = False
+
+        if found.all() and np.isin(changed['category_ids'], self.categories).all():
+            # Known products in known categories: recode just them
+            touched = np.concatenate((positions, gone))
+            index.joint = self.joint.copy()
+            index.joint[touched] = index._joint(touched)
+            index.histogram = self.histogram - self._histogram(self.joint[touched]) \
+                + self._histogram(index.joint[touched])
+            return index
+
+        # New products or categories: merge them in and recode everything
+        columns = {name: np.concatenate((getattr(index, name), changed[name][~found])) for name in COLUMNS}
+        order = np.argsort(columns['ids'], kind='stable')
+        return FacetIndex(change_id, self.edges, **{name: column[order] for name, column in columns.items()})
+
+    def _positions(self, product_ids):
+        """(whether each id is indexed, its position) for an array of product ids"""
+        positions = np.searchsorted(self.ids, product_ids)
+        found = positions < len(self.ids)
+        found[found] = self.ids[positions[found]] == product_ids[found]
+        return found, positions
+
+    def _scan(self, allowed, start, count):
+        """Positions of the allowed products number start .. start + count - 1, in id order"""
+        pages = []
+        for offset in range(0, len(self.joint), SCAN_CHUNK):
+            chunk = allowed[self.joint[offset:offset + SCAN_CHUNK]]
+            matches = np.count_nonzero(chunk)
+            if start >= matches:
+                start -= matches
+                continue
+            positions = np.flatnonzero(chunk)[start:start + count] + offset
+            pages.append(positions)
+            count -= len(positions)
+            start = 0
+            if not count:
+                break
+        return np.concatenate(pages) if pages else np.zeros(0, dtype=np.int64)
+
+    def _counts(self, histogram, category_id, price_band, in_stock):
+        """(FacetCounts, number of matches, allowed joint codes) of a histogram for the chosen filters"""
+        categories, bands, _ = self.shape
+        by_category = self.categories == category_id if category_id else np.ones(categories, dtype=bool)
+        by_band = np.arange(bands) == price_band if price_band is not None else np.ones(bands, dtype=bool)
+        by_stock = np.array([not in_stock, True])
+
+        category_counts = histogram[:, by_band][:, :, by_stock].sum(axis=(1, 2))
+        band_counts = histogram[by_category][:, :, by_stock].sum(axis=(0, 2))
+        chosen = histogram[by_category][:, by_band]
+        counts = FacetCounts(
+            categories=tuple((int(category), int(count))
+                             for category, count in zip(self.categories, category_counts) if count),
+            price_bands=tuple(PriceBand(band, low, high, int(count)) for band, (low, high, count)
+                              in enumerate(zip([0.0] + list(self.edges), list(self.edges) + [None], band_counts))),
+            in_stock=int(chosen[:, :, 1].sum()),
+        )
+
+        # Codes of the chosen filters, plus the inactive code (never allowed)
+        allowed = np.append((by_category[:, None, None] & by_band[None, :, None] & by_stock).ravel(), False)
+        return counts, int(chosen[:, :, by_stock].sum()), allowed
+
+    def select(self, category_id=None, price_band=None, in_stock=False, page=1, per_page=12):
+        """One page of matching product ids, the number of matches and every facet's counts"""
+        counts, total, allowed = self._counts(self.histogram, category_id, price_band, in_stock)
+        positions = self._scan(allowed, (page - 1) * per_page, per_page)
+        return FacetResult([int(product_id) for product_id in self.ids[positions]], total, counts)
+
+    def count(self, matches, category_id=None, price_band=None, in_stock=False):
+        """(number of matches, FacetCounts) over the given product ids only"""
+        found, positions = self._positions(np.asarray(matches, dtype=np.int64))
+        histogram = self._histogram(self.joint[positions[found]])
+        counts, total, _ = self._counts(histogram, category_id, price_band, in_stock)
+        return total, counts
+
+
+def build_index():
+    # The log position is read first, so changes racing with the load are replayed later
+    change_id = catalog_cache.newest_change()
+    edges = np.array(sorted(current_app.config['SHOP_PRICE_BANDS']), dtype=np.float64)
+    return FacetIndex(change_id, edges, **_columns(_select_rows(), edges))
+
+
+class _IndexHolder:
+    """The current index of this process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = None
+
+    def get(self, newest):
+        index = self.index
+        if index is not None and index.change_id >= newest:
+            return index
+
+        with self.lock:
+            index = self.index
+            if index is None:
+                index = build_index()
+            elif index.change_id < newest:
+                change_id, product_ids = catalog_cache.changed_products(index.change_id, FULL_RELOAD_CHANGES)
+                if product_ids is None:
+                    index = build_index()
+                elif product_ids:
+                    index = index.patched(change_id, product_ids)
+                else:
+                    index = index.refreshed(change_id)
+            self.index = index
+            return index
+
+
+_holder = _IndexHolder()
+
+
+def parse_price_band(value):
+    """A price band number from the query string, or None if there is no such band"""
+    bands = len(current_app.config['SHOP_PRICE_BANDS']) + 1
+    return value if value is not None and 0 <= value < bands else None
+
+
+def price_range(price_band):
+    """(low, high) prices of a band number (high is None for the last), None for no band"""
+    if price_band is None:
+        return None
+    edges = [0.0] + sorted(current_app.config['SHOP_PRICE_BANDS']) + [None]
+    return edges[price_band], edges[price_band + 1]
+
+
+def select(category_id=None, price_band=None, in_stock=False, page=1, per_page=12):
+    """Filter the active products. Returns a FacetResult."""
+    index = _holder.get(catalog_cache.newest_change())
+    return index.select(category_id, price_band, in_stock, page, per_page)
+
+
+def count(matches, category_id=None, price_band=None, in_stock=False):
+    """
+    (number of matches, FacetCounts) of the active products among `matches`
+    (e.g. search results) for the chosen filters
+    """
+    index = _holder.get(catalog_cache.newest_change())
+    return index.count(matches, category_id, price_band, in_stock)
@@ -1,7 +1,16 @@
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileAllowed, FileRequired
 from wtforms import StringField, PasswordField, TextAreaField, FloatField, IntegerField, SelectField, SubmitField, BooleanField
-from wtforms.validators import DataRequired, Email, Length, EqualTo, NumberRange, Optional
+from wtforms.validators import DataRequired, Email, Length, EqualTo, NumberRange, Optional, ValidationError
+import uploads
+
+
+def image_reference(form, field):
+    """Image URLs may be data:image URIs, but only small, readable ones (they're saved as files)"""
+    if field.data and uploads.is_data_uri(field.data):
+        problem = uploads.check_data_uri(field.data)
+        if problem:
+            raise ValidationError(problem)
 
 
 class LoginForm(FlaskForm):
@@ -24,7 +33,7 @@ class CategoryForm(FlaskForm):
     name = StringField('Category Name', validators=[DataRequired(), Length(min=2, max=100)])
     description = TextAreaField('Description', validators=[Optional()])
     image = FileField('Upload Image', validators=[FileAllowed(['png', 'jpg', 'jpeg', 'gif'], 'Images only!')])
-    image_url = StringField('Or Image URL', validators=[Optional()])
+    image_url = StringField('Or Image URL', validators=[Optional(), image_reference])
     is_active = BooleanField('Show to Customers', default=True)
     submit = SubmitField('Save Category')
 
@@ -36,7 +45,7 @@ class ProductForm(FlaskForm):
     stock = IntegerField('Stock Quantity', validators=[DataRequired(), NumberRange(min=0, message='Stock cannot be negative')])
     category_id = SelectField('Category', coerce=int, validators=[DataRequired()])
     image = FileField('Upload Image', validators=[FileAllowed(['png', 'jpg', 'jpeg', 'gif'], 'Images only!')])
-    image_url = StringField('Or Image URL', validators=[Optional()])
+    image_url = StringField('Or Image URL', validators=[Optional(), image_reference])
     is_active = BooleanField('Show to Customers', default=True)
     submit = SubmitField('Save Product')
 
@@ -77,6 +86,10 @@ class BulkUploadForm(FlaskForm):
                          FileRequired(message='Please select a file to upload'),
                          FileAllowed(['csv', 'xlsx', 'xls'], 'Only CSV and Excel files are allowed!')
                      ])
+    mode = SelectField('Import Mode', choices=[
+        ('insert', 'Add every row as a new product'),
+        ('upsert', 'Update matching products, add the rest')
+    ], default='insert')
     submit = SubmitField('Upload Products')
 
 
@@ -0,0 +1,89 @@
+"""
+Fragment Cache
+--------------
+Caches rendered HTML for repeated pieces of the storefront (product cards,
+category lists), so a page is assembled from ready-made markup instead of
+running the card templates for every product on every view.
+
+Templates call the cached_fragment() global with the fragment template and
+the values it renders:
+    {{ cached_fragment('fragments/product_card.html', product=product, logged_in=...) }}
+
+The values are the cache key. They must be immutable snapshots (see
+catalog_cache.py) rather than ORM objects, so a product's entry is keyed by
+its content: an admin edit changes the snapshot and therefore the key, and
+the old markup simply ages out of the LRU. Fragments must not read anything
+that isn't passed in (e.g. current_user), or it would leak between visitors.
+"""
+
+import threading
+from collections import OrderedDict
+
+from flask import current_app, render_template, request
+from markupsafe import Markup
+
+
+# Key values that hash by content; anything else is rendered without caching
+CACHEABLE_TYPES = (str, int, float, bool, type(None), tuple)
+
+
+class _FragmentLRU:
+    """Thread-safe LRU of rendered fragments"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            html = self.entries.get(key)
+            if html is not None:
+                self.entries.move_to_end(key)
+            return html
+
+    def set(self, key, html, size):
+        with self.lock:
+            self.entries[key] = html
+            self.entries.move_to_end(key)
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_fragments = _FragmentLRU()
+
+
+def _key(template_name, context):
+    values = []
+    for name, value in sorted(context.items()):
+        if isinstance(value, list):
+            value = tuple(value)
+        if not isinstance(value, CACHEABLE_TYPES):
+            return None
+        values.append((name, value))
+    # URLs in the markup depend on where the app is mounted
+    return (template_name, request.script_root, tuple(values))
+
+
+def cached_fragment(template_name, **context):
+    """Render a fragment template, reusing the markup from an earlier identical call"""
+    key = _key(template_name, context)
+    html = _fragments.get(key) if key is not None else None
+    if html is None:
+        html = Markup(render_template(template_name, **context))
+        if key is not None:
+            _fragments.set(key, html, current_app.config['FRAGMENT_CACHE_SIZE'])
+    return html
+
+
+def clear():
+    """Drop all cached fragments in this process"""
+    _fragments.clear()
+
+
+def init_app(app):
+    """Expose cached_fragment() to templates"""
+    app.add_template_global(cached_fragment)
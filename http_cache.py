@@ -0,0 +1,174 @@
+"""
+HTTP Caching
+------------
+Conditional GET for storefront pages and long-lived caching for uploads.
+
+Views marked with @catalog_page get a weak ETag built from the catalog
+version (catalog_cache.py), the templates, the signed-in user, the contents
+of their cart and the stock of the products on the page. Stock is read live
+rather than versioned, so the view passes it in (check_stock()) once it
+knows which products it shows, and a revisit to an unchanged page is
+answered with 304 Not Modified before anything is rendered.
+
+Anonymous visitors also get a Last-Modified: the latest of the catalog
+version (a change time), the newest template and the newest stock change
+of the products on the page (Product.stock_updated_at, see stock.py), so
+If-Modified-Since is honored too. If-None-Match takes precedence when a
+request sends both. Responses carry Cache-Control: no-cache, so browsers
+still revalidate every time and never show stale stock.
+
+Uploaded images with content-hashed names (uploads.py) never change, so
+they are served as public and immutable for UPLOAD_CACHE_MAX_AGE. Other
+static files keep Flask's ETag/Last-Modified revalidation.
+"""
+
+import hashlib
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+
+from models import db, Cart, CartItem
+import catalog_cache
+import uploads
+
+
+# digest: hash of every template, modified: the newest template's modification time
+Templates = namedtuple('Templates', 'digest modified')
+
+
+def _templates_state(app):
+    """Templates of the app, so a deploy that changes markup changes the validators"""
+    digest = hashlib.sha1()
+    newest = 0.0
+    folder = os.path.join(app.root_path, app.template_folder)
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, folder).encode())
+            with open(path, 'rb') as file:
+                digest.update(file.read())
+            newest = max(newest, os.path.getmtime(path))
+    return Templates(digest.hexdigest()[:12], datetime.fromtimestamp(newest, timezone.utc))
+
+
+def _cart_state(user_id):
+    rows = db.session.query(CartItem.product_id, CartItem.quantity) \
+        .join(Cart, Cart.id == CartItem.cart_id) \
+        .filter(Cart.user_id == user_id) \
+        .order_by(CartItem.product_id).all()
+    return ','.join(f'{product_id}x{quantity}' for product_id, quantity in rows)
+
+
+class _Unchanged(Exception):
+    """Raised by check_stock() to answer the request with 304 Not Modified"""
+
+
+def _etag(parts):
+    return hashlib.sha1('\0'.join(parts).encode()).hexdigest()[:20]
+
+
+def _is_modified(parts):
+    return is_resource_modified(request.environ, etag=_etag(parts), last_modified=g.get('page_last_modified'))
+
+
+def page_validators():
+    """
+    (ETag parts, Last-Modified) of the current catalog page as far as they
+    are known before its view runs, or None when it mustn't be answered from
+    the browser's copy (e.g. a flash message is due). Last-Modified is None
+    for signed-in users, whose pages also depend on their account and cart.
+    """
+    if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+        return None
+
+    version = catalog_cache.get_version()
+    if version is None:
+        return None
+
+    templates = current_app.extensions['http_cache']
+    parts = [templates.digest, str(version)]
+    if current_user.is_authenticated:
+        parts += [str(current_user.id), current_user.username, current_user.email,
+                  str(current_user.is_admin), _cart_state(current_user.id)]
+        return parts, None
+
+    # The version is the time of the last catalog change in milliseconds
+    changed = datetime.fromtimestamp(version / 1000, timezone.utc)
+    return parts, max(changed, templates.modified)
+
+
+def check_stock(stock):
+    """
+    Add the live stock levels a @catalog_page view shows (catalog_cache.StockLevels,
+    see stock_levels()) to its ETag and Last-Modified. Stock isn't part of the
+    catalog version, so views call this once they know their products and
+    before rendering; if the browser's copy is still current, the view stops
+    here and 304 Not Modified is sent.
+    """
+    parts = g.get('page_etag_parts')
+    if parts is None:
+        return
+    parts.append(','.join(f'{product_id}x{level}' for product_id, level in sorted(stock.items())))
+    if g.page_last_modified is not None and stock.updated_at is not None:
+        stock_changed = stock.updated_at.replace(tzinfo=timezone.utc)
+        g.page_last_modified = max(g.page_last_modified, stock_changed)
+    if not _is_modified(parts):
+        raise _Unchanged()
+
+
+def catalog_page(view):
+    """Answer unchanged catalog pages with 304 and tag fresh ones with validators"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        validators = page_validators()
+        if validators is None:
+            return view(*args, **kwargs)
+
+        parts, g.page_last_modified = validators
+        g.page_etag_parts = parts
+        try:
+            response = make_response(view(*args, **kwargs))
+        except _Unchanged:
+            response = current_app.response_class(status=304)
+        else:
+            if response.status_code != 200:
+                return response
+            if not _is_modified(parts):
+                response = current_app.response_class(status=304)
+
+        response.set_etag(_etag(parts), weak=True)
+        if g.page_last_modified is not None:
+            response.last_modified = g.page_last_modified
+        response.cache_control.no_cache = True
+        if current_user.is_authenticated:
+            response.cache_control.private = True
+        response.vary.add('Cookie')
+        return response
+    return wrapper
+
+
+def _cache_hashed_uploads(response):
+    filename = (request.view_args or {}).get('filename', '')
+    if request.endpoint != 'static' or not filename.startswith('uploads/') \
+            or not uploads.is_hashed_name(filename) or response.status_code not in (200, 206, 304):
+        return response
+
+    max_age = current_app.config['UPLOAD_CACHE_MAX_AGE']
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = True
+    response.expires = datetime.now(timezone.utc) + timedelta(seconds=max_age)
+    return response
+
+
+def init_app(app):
+    """Fingerprint the templates and mark hashed uploads as immutable"""
+    app.extensions['http_cache'] = _templates_state(app)
+    app.after_request(_cache_hashed_uploads)
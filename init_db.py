@@ -1,44 +1,75 @@
 from app import create_app
 from models import db, User, Category, Product
 from sqlalchemy import text, inspect
+from flask_migrate import stamp, upgrade
+import stats
+import search
+import catalog_cache
 
 
 app = create_app()
 
+# Revision that databases made by db.create_all() before migrations are at
+INITIAL_REVISION = '858aa21374df'
+# Later revisions by a table (and column) they add, newest first: db.create_all()
+# from models that already had it made that revision's whole schema
+REVISION_MARKERS = (
+    ('product', 'stock_updated_at', '9639ce83805c'),
+    ('stat_delta', None, 'ca749e336e45'),
+    ('product_change', None, 'a37f885ca6ce'),
+)
+
+
+def has_schema(inspector, table, column=None):
+    """Check whether the database has `table` (and its `column`)"""
+    if not inspector.has_table(table):
+        return False
+    return column is None or column in [col['name'] for col in inspector.get_columns(table)]
+
 
 with app.app_context():
-    # Create tables if they don't exist (won't drop existing data)
-    print("📝 Ensuring database tables exist...")
-    db.create_all()
-    
-    # ========== FIX SUBSCRIPTION TABLE (Add missing columns) ==========
-    print("\n🔧 Checking subscription table schema...")
-    try:
-        inspector = inspect(db.engine)
-        subscription_columns = [col['name'] for col in inspector.get_columns('subscription')]
-        
-        # Check if 'status' column exists
-        if 'status' not in subscription_columns:
-            db.session.execute(text("ALTER TABLE subscription ADD COLUMN status VARCHAR(20) DEFAULT 'pending'"))
-            print("✅ Added 'status' column to subscription table")
-        else:
-            print("ℹ️  'status' column already exists")
-        
-        # Check if 'admin_notes' column exists
-        if 'admin_notes' not in subscription_columns:
-            db.session.execute(text("ALTER TABLE subscription ADD COLUMN admin_notes TEXT"))
-            print("✅ Added 'admin_notes' column to subscription table")
-        else:
-            print("ℹ️  'admin_notes' column already exists")
+    inspector = inspect(db.engine)
+    if inspector.has_table('subscription') and not inspector.has_table('alembic_version'):
+        # Created with db.create_all() before there were migrations
+        # ========== FIX SUBSCRIPTION TABLE (Add missing columns) ==========
+        print("\n🔧 Checking subscription table schema...")
+        try:
+            inspector = inspect(db.engine)
+            subscription_columns = [col['name'] for col in inspector.get_columns('subscription')]
+            
+            # Check if 'status' column exists
+            if 'status' not in subscription_columns:
+                db.session.execute(text("ALTER TABLE subscription ADD COLUMN status VARCHAR(20) DEFAULT 'pending'"))
+                print("✅ Added 'status' column to subscription table")
+            else:
+                print("ℹ️  'status' column already exists")
+            
+            # Check if 'admin_notes' column exists
+            if 'admin_notes' not in subscription_columns:
+                db.session.execute(text("ALTER TABLE subscription ADD COLUMN admin_notes TEXT"))
+                print("✅ Added 'admin_notes' column to subscription table")
+            else:
+                print("ℹ️  'admin_notes' column already exists")
+            
+            # Update existing subscriptions to 'approved' status
+            db.session.execute(text("UPDATE subscription SET status = 'approved' WHERE status IS NULL OR status = ''"))
+            db.session.commit()
+            print("✅ Updated existing subscriptions")
+            
+        except Exception as e:
+            print(f"⚠️  Note: {e}")
+            db.session.rollback()
         
-        # Update existing subscriptions to 'approved' status
-        db.session.execute(text("UPDATE subscription SET status = 'approved' WHERE status IS NULL OR status = ''"))
-        db.session.commit()
-        print("✅ Updated existing subscriptions")
-        
-    except Exception as e:
-        print(f"⚠️  Note: {e}")
-        db.session.rollback()
+        revision = next((revision for table, column, revision in REVISION_MARKERS
+                         if has_schema(inspector, table, column)), INITIAL_REVISION)
+        print(f"\n🔧 Marking the existing database as schema revision {revision}...")
+        stamp(revision=revision)
+        print("✅ Stamped")
+    
+    # Create or update tables and indexes (won't drop existing data)
+    print("\n📝 Applying database migrations...")
+    upgrade()
+    print("✅ Database schema up to date")
     
     # ========== CREATE USERS (only if they don't exist) ==========
     print("\n👥 Checking users...")
@@ -375,6 +406,20 @@ with app.app_context():
     else:
         print("ℹ️  All sample products already exist")
     
+    # ========== PRODUCT SEARCH INDEX ==========
+    if search.ensure_index():
+        print("\n🔍 Product search index ready")
+    else:
+        print("\nℹ️  Full-text search not supported on this database, using basic search")
+    
+    # ========== DASHBOARD COUNTERS ==========
+    stats.rebuild()
+    print("\n📈 Dashboard counters rebuilt")
+    
+    # ========== CATALOG CACHE ==========
+    catalog_cache.clear()
+    print(f"🗂️  Catalog cache at version {catalog_cache.get_version()}")
+    
     print("\n🎉 Database initialization completed!")
     print("=" * 60)
     print("📊 CURRENT DATABASE STATUS:")
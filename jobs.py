@@ -0,0 +1,290 @@
+"""
+Background Jobs
+---------------
+Database-backed job queue for long-running admin work (bulk imports,
+subscription runs), so requests can enqueue it and return immediately.
+No broker is needed: jobs are rows in the job table.
+
+Each web process starts a small pool of worker threads (JOB_WORKERS) on its
+first request. Workers claim queued jobs with a conditional UPDATE, so a job
+runs exactly once even when several processes or hosts share the database.
+Progress and heartbeats are written on their own connection, so they are
+visible while the job's work is still in progress. A running job whose
+heartbeat stops for JOB_STALE_SECONDS (its process died) is picked up again,
+or failed once it has used up its attempts.
+
+Set JOB_WORKERS=0 to keep jobs out of the web processes and run a
+dedicated worker instead:
+    flask --app app run-jobs
+
+Defining and enqueueing a job:
+    @jobs.handler('product_import')
+    def run_import(params, report):
+        ...
+        report(rows_done)           # or report(done, total)
+        raise jobs.JobError('...')  # expected failure, shown on the job page
+        return {'created': n}       # stored in job.result
+
+    job = jobs.enqueue('product_import', {'path': ...}, user_id=current_user.id)
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, update
+from sqlalchemy.exc import OperationalError
+
+from models import db, Job
+
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+_wake = threading.Event()
+_pool_lock = threading.Lock()
+_pool_pid = None
+
+
+class JobError(Exception):
+    """Expected job failure (e.g. bad input); shown to the user and logged without a traceback"""
+
+
+class JobHandler:
+    """A registered job function and how often it may be attempted"""
+
+    def __init__(self, function, max_attempts):
+        self.function = function
+        self.max_attempts = max_attempts
+
+
+def handler(kind, max_attempts=1):
+    """
+    Register a job function for `kind`. Jobs that aren't safe to run twice
+    (e.g. plain inserts) should keep max_attempts=1, so a job interrupted by a
+    crash is marked failed instead of being re-run.
+    """
+    def decorator(function):
+        HANDLERS[kind] = JobHandler(function, max_attempts)
+        return function
+    return decorator
+
+
+def enqueue(kind, params=None, user_id=None):
+    """Queue a job and wake the local workers. Returns the Job."""
+    if kind not in HANDLERS:
+        raise ValueError(f"No job handler registered for '{kind}'")
+
+    job = Job(kind=kind, params=params or {}, created_by_id=user_id,
+              max_attempts=HANDLERS[kind].max_attempts)
+    db.session.add(job)
+    db.session.commit()
+    _wake.set()
+    return job
+
+
+# ========== CLAIMING ==========
+
+def _stale_cutoff(app):
+    return datetime.utcnow() - timedelta(seconds=app.config['JOB_STALE_SECONDS'])
+
+
+def claim_next(app, worker_name):
+    """
+    Claim the oldest runnable job (queued, or running with a stale heartbeat)
+    for `worker_name`. Returns its id, or None when there is nothing to do.
+    Nothing is written unless a candidate exists.
+    """
+    runnable = or_(
+        Job.status == 'queued',
+        and_(Job.status == 'running', Job.updated_at < _stale_cutoff(app))
+    )
+    candidates = db.session.query(Job.id, Job.attempts, Job.max_attempts) \
+        .filter(runnable).order_by(Job.id).limit(5).all()
+    db.session.commit()
+
+    for job_id, attempts, max_attempts in candidates:
+        now = datetime.utcnow()
+        # Compare-and-swap on attempts: only one worker can win each job
+        statement = update(Job).where(Job.id == job_id, Job.attempts == attempts, runnable)
+
+        if attempts >= max_attempts:
+            # Its worker died during the last allowed attempt
+            db.session.execute(statement.values(
+                status='failed', error='The worker running this job stopped responding.', finished_at=now
+            ))
+            db.session.commit()
+            continue
+
+        claimed = db.session.execute(statement.values(
+            status='running', worker=worker_name, attempts=attempts + 1,
+            started_at=now, updated_at=now, error=None
+        ))
+        db.session.commit()
+        if claimed.rowcount == 1:
+            return job_id
+    return None
+
+
+# ========== PROGRESS ==========
+
+def _touch(job_id, worker_name, **values):
+    """Update our own running job on a separate connection (best effort)"""
+    values['updated_at'] = datetime.utcnow()
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.worker == worker_name, Job.status == 'running')
+                .values(**values)
+            )
+    except OperationalError as e:
+        # e.g. SQLite busy while the job itself is writing; the next update will catch up
+        logger.debug(f"Could not update job #{job_id}: {e}")
+
+
+class Reporter:
+    """Callable handed to job functions for progress updates, throttled to one write per interval"""
+
+    def __init__(self, app, job_id, worker_name):
+        self.job_id = job_id
+        self.worker_name = worker_name
+        self.interval = app.config['JOB_PROGRESS_INTERVAL']
+        self.last_write = float('-inf')
+        self.latest = {}  # last reported values, written with the outcome even if throttled
+
+    def __call__(self, progress, total=None, force=False):
+        self.latest['progress'] = progress
+        if total is not None:
+            self.latest['total'] = total
+
+        now = time.monotonic()
+        if not force and now - self.last_write < self.interval:
+            return
+        self.last_write = now
+        _touch(self.job_id, self.worker_name, **self.latest)
+
+
+class _Heartbeat(threading.Thread):
+    """Keeps updated_at fresh while a job runs, so it isn't mistaken for a dead one"""
+
+    def __init__(self, app, job_id, worker_name):
+        super().__init__(name=f'{worker_name}-heartbeat', daemon=True)
+        self.app = app
+        self.job_id = job_id
+        self.worker_name = worker_name
+        self.stopped = threading.Event()
+        self.interval = max(1, app.config['JOB_STALE_SECONDS'] // 4)
+
+    def run(self):
+        with self.app.app_context():
+            while not self.stopped.wait(self.interval):
+                _touch(self.job_id, self.worker_name)
+
+    def stop(self):
+        self.stopped.set()
+
+
+# ========== RUNNING ==========
+
+def run_job(app, job_id, worker_name):
+    """Run a claimed job and record its outcome"""
+    job = db.session.get(Job, job_id)
+    kind = job.kind
+    job_handler = HANDLERS.get(kind)
+    params = dict(job.params or {})
+    db.session.rollback()  # don't hold a read transaction while the job works
+
+    report = Reporter(app, job_id, worker_name)
+    heartbeat = _Heartbeat(app, job_id, worker_name)
+    heartbeat.start()
+    try:
+        if job_handler is None:
+            raise JobError(f"No job handler registered for '{kind}'")
+        result = job_handler.function(params, report)
+        db.session.commit()
+        outcome = dict(report.latest, status='done', result=result)
+    except JobError as e:
+        db.session.rollback()
+        logger.warning(f"Job #{job_id} ({kind}) failed: {e}")
+        outcome = dict(report.latest, status='failed', error=str(e))
+    except Exception as e:
+        db.session.rollback()
+        logger.exception(f"Job #{job_id} ({kind}) failed")
+        outcome = dict(report.latest, status='failed', error=str(e) or type(e).__name__)
+    finally:
+        heartbeat.stop()
+
+    # The final write must not be lost, so retry it if the database is busy
+    for attempt in range(5):
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    update(Job)
+                    .where(Job.id == job_id, Job.worker == worker_name)
+                    .values(finished_at=datetime.utcnow(), updated_at=datetime.utcnow(), **outcome)
+                )
+            break
+        except OperationalError:
+            if attempt == 4:
+                raise
+            time.sleep(0.5 * (attempt + 1))
+
+
+def work(app, worker_name, stop=None):
+    """Worker loop: claim and run jobs, sleeping until woken or polled when idle"""
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        with app.app_context():
+            try:
+                job_id = claim_next(app, worker_name)
+            except Exception:
+                db.session.rollback()
+                logger.exception("Could not claim a job")
+                job_id = None
+
+            if job_id is not None:
+                try:
+                    run_job(app, job_id, worker_name)
+                except Exception:
+                    # The job is left running and will be failed once its heartbeat goes stale
+                    db.session.rollback()
+                    logger.exception(f"Could not record the outcome of job #{job_id}")
+                continue
+
+        _wake.wait(app.config['JOB_POLL_INTERVAL'])
+        _wake.clear()
+
+
+def start_workers(app):
+    """Start this process's worker threads once (safe to call on every request)"""
+    global _pool_pid
+    if _pool_pid == os.getpid() or not app.config['JOB_WORKERS']:
+        return
+
+    with _pool_lock:
+        # Checked again under the lock; the pid check also covers forked processes
+        if _pool_pid == os.getpid():
+            return
+        _pool_pid = os.getpid()
+        for number in range(app.config['JOB_WORKERS']):
+            name = f'{socket.gethostname()}:{os.getpid()}:{number}'
+            threading.Thread(target=work, args=(app, name), name=f'job-worker-{number}', daemon=True).start()
+        logger.info(f"Started {app.config['JOB_WORKERS']} job workers in process {os.getpid()}")
+
+
+def init_app(app):
+    """Start workers lazily on the first request and register the run-jobs CLI command"""
+    @app.before_request
+    def _start_job_workers():
+        start_workers(app)
+
+    @app.cli.command('run-jobs')
+    def run_jobs_command():
+        """Run a foreground job worker (use with JOB_WORKERS=0 on web processes)."""
+        print("Job worker started, press Ctrl+C to stop")
+        work(app, f'{socket.gethostname()}:{os.getpid()}:cli')
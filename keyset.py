@@ -0,0 +1,123 @@
+"""
+Keyset Pagination
+-----------------
+Newest-first listings (orders, products, subscriptions) paged on
+(created_at, id) instead of OFFSET. Each page continues from a cursor
+holding the last row's key, so with an index on those columns page 10,000
+reads the same few rows as page 1, and rows inserted meanwhile don't shift
+later pages.
+
+There are no page numbers. Views pass the total in separately, usually
+from the materialized counters (stats.py), so no COUNT(*) runs either.
+Set LISTING_PAGINATION=offset to get the numbered Flask-SQLAlchemy pages
+back.
+
+In views:
+    orders = keyset.paginate(Order.query, Order, per_page=10, total=lambda: counters.count('orders'))
+In templates:
+    {% from 'macros/pagination.html' import keyset_nav %}
+    {{ keyset_nav(orders, 'admin.orders') }}
+"""
+
+import base64
+import binascii
+from datetime import datetime
+
+from flask import current_app, request
+from sqlalchemy import bindparam, tuple_
+
+
+class KeysetPagination:
+    """One page of a keyset listing, with cursors for the neighbouring pages"""
+
+    is_keyset = True
+
+    def __init__(self, items, per_page, total, next_cursor, prev_cursor, is_first):
+        self.items = items
+        self.per_page = per_page
+        self.total = total
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.is_first = is_first
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return not self.is_first
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def encode_cursor(row):
+    key = f'{row.created_at.isoformat()}|{row.id}'
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(created_at, id) from a cursor, or None if it is missing or malformed"""
+    if not cursor:
+        return None
+    try:
+        key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, row_id = key.split('|')
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+def _key_bound(model, key):
+    created_at, row_id = key
+    return tuple_(bindparam(None, created_at, type_=model.created_at.type),
+                  bindparam(None, row_id, type_=model.id.type))
+
+
+def keyset_paginate(query, model, per_page, after=None, before=None, total=None):
+    """
+    Page `query` newest first. `after` continues to older rows, `before`
+    goes back to newer ones; with neither, the newest page is returned.
+    """
+    key = tuple_(model.created_at, model.id)
+    after, before = decode_cursor(after), decode_cursor(before)
+
+    if before is not None:
+        rows = query.filter(key > _key_bound(model, before)) \
+            .order_by(model.created_at.asc(), model.id.asc()).limit(per_page + 1).all()
+        if rows:
+            is_first = len(rows) <= per_page
+            rows = rows[:per_page][::-1]
+            return KeysetPagination(rows, per_page, total, encode_cursor(rows[-1]),
+                                    None if is_first else encode_cursor(rows[0]), is_first)
+        after = None  # nothing newer any more: show the first page
+
+    newest_first = query.order_by(model.created_at.desc(), model.id.desc())
+    if after is not None:
+        newest_first = newest_first.filter(key < _key_bound(model, after))
+    rows = newest_first.limit(per_page + 1).all()
+
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    return KeysetPagination(
+        rows, per_page, total,
+        encode_cursor(rows[-1]) if has_next else None,
+        encode_cursor(rows[0]) if after is not None and rows else None,
+        is_first=after is None
+    )
+
+
+def paginate(query, model, per_page, total=None):
+    """
+    Page a newest-first listing from the request's cursor (or page number in
+    offset mode). `total` is a callable, only used in keyset mode.
+    """
+    if current_app.config['LISTING_PAGINATION'] == 'offset':
+        page = request.args.get('page', 1, type=int)
+        return query.order_by(model.created_at.desc(), model.id.desc()) \
+            .paginate(page=page, per_page=per_page, error_out=False)
+
+    return keyset_paginate(query, model, per_page,
+                           after=request.args.get('after'), before=request.args.get('before'),
+                           total=total() if total else None)
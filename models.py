@@ -2,8 +2,17 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
+from collections import namedtuple
+from database import RoutingSession
 
-db = SQLAlchemy()
+# Reads in @read_only views may go to a replica (see database.py)
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+# Precomputed per-subscription figures for list pages
+SubscriptionSummary = namedtuple('SubscriptionSummary', ['item_count', 'total_amount'])
+OrderSummary = namedtuple('OrderSummary', ['item_count', 'preview'])
+OrderItemPreview = namedtuple('OrderItemPreview', ['name', 'image'])
 
 
 class User(UserMixin, db.Model):
@@ -51,6 +60,12 @@ class Category(db.Model):
     # Relationships
     products = db.relationship('Product', backref='category', lazy='dynamic', cascade='all, delete-orphan')
     
+    @staticmethod
+    def product_counts():
+        """Number of products in every category in one grouped query: {category_id: count}"""
+        rows = db.session.query(Product.category_id, db.func.count(Product.id)).group_by(Product.category_id)
+        return dict(rows.all())
+    
     def __repr__(self):
         return f'<Category {self.name}>'
 
@@ -58,12 +73,22 @@ class Category(db.Model):
 class Product(db.Model):
     """Product model"""
     __tablename__ = 'product'
+    __table_args__ = (
+        # Natural key used to match bulk upload rows when there is no SKU
+        db.Index('ix_product_name_category', 'name', 'category_id'),
+        # Newest-first admin listing (keyset.py)
+        db.Index('ix_product_created', 'created_at', 'id'),
+        # Shop pages and related products: active products, optionally in one category
+        db.Index('ix_product_active_category', 'is_active', 'category_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
+    sku = db.Column(db.String(64), unique=True, index=True)  # Optional supplier stock-keeping unit
     name = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text)
     price = db.Column(db.Float, nullable=False)
     stock = db.Column(db.Integer, nullable=False, default=0)
+    stock_updated_at = db.Column(db.DateTime)  # last stock change, for Last-Modified (stock.py)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
     image = db.Column(db.String(500))
     is_active = db.Column(db.Boolean, default=True)
@@ -91,6 +116,10 @@ class Cart(db.Model):
 class CartItem(db.Model):
     """Cart item model"""
     __tablename__ = 'cart_item'
+    __table_args__ = (
+        # A cart's items, and the "already in cart?" check on add to cart
+        db.Index('ix_cart_item_cart_product', 'cart_id', 'product_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     cart_id = db.Column(db.Integer, db.ForeignKey('cart.id'), nullable=False)
@@ -107,6 +136,13 @@ class CartItem(db.Model):
 class Order(db.Model):
     """Order model"""
     __tablename__ = 'order'
+    __table_args__ = (
+        # Newest-first listings, all orders and per customer (keyset.py)
+        db.Index('ix_order_created', 'created_at', 'id'),
+        db.Index('ix_order_user_created', 'user_id', 'created_at', 'id'),
+        # Counts and revenue per status (stats.py rebuild) without reading the rows
+        db.Index('ix_order_status', 'status', 'total_amount'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -119,6 +155,39 @@ class Order(db.Model):
     
     # Relationships
     items = db.relationship('OrderItem', backref='order', lazy='dynamic', cascade='all, delete-orphan')
+    # The same items as a plain list, so a page of orders can load them in one query (selectinload)
+    item_list = db.relationship('OrderItem', viewonly=True, order_by='OrderItem.id')
+    
+    @staticmethod
+    def summaries_for(order_ids, preview_size=3):
+        """
+        Item count and the first `preview_size` items (name, image) of many orders,
+        in one grouped and one windowed query. Returns {order_id: OrderSummary}.
+        """
+        summaries = {order_id: OrderSummary(0, []) for order_id in order_ids}
+        if not summaries:
+            return summaries
+        
+        counts = db.session.query(OrderItem.order_id, db.func.count(OrderItem.id)).filter(
+            OrderItem.order_id.in_(summaries)
+        ).group_by(OrderItem.order_id)
+        for order_id, item_count in counts:
+            summaries[order_id] = OrderSummary(item_count, [])
+        
+        # Number each order's items and keep the first few
+        position = db.func.row_number().over(partition_by=OrderItem.order_id, order_by=OrderItem.id)
+        numbered = db.session.query(
+            OrderItem.order_id, Product.name, Product.image, position.label('position')
+        ).join(Product, OrderItem.product_id == Product.id).filter(
+            OrderItem.order_id.in_(summaries)
+        ).subquery()
+        first_items = db.session.query(numbered.c.order_id, numbered.c.name, numbered.c.image).filter(
+            numbered.c.position <= preview_size
+        ).order_by(numbered.c.order_id, numbered.c.position)
+        
+        for order_id, name, image in first_items:
+            summaries[order_id].preview.append(OrderItemPreview(name, image))
+        return summaries
     
     def __repr__(self):
         return f'<Order #{self.id} User:{self.user_id}>'
@@ -127,6 +196,10 @@ class Order(db.Model):
 class OrderItem(db.Model):
     """Order item model"""
     __tablename__ = 'order_item'
+    __table_args__ = (
+        # An order's items (order pages, eager loading in order history)
+        db.Index('ix_order_item_order_product', 'order_id', 'product_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
@@ -144,6 +217,15 @@ class OrderItem(db.Model):
 class Subscription(db.Model):
     """Customer subscription for recurring orders"""
     __tablename__ = 'subscription'
+    __table_args__ = (
+        # Newest-first admin listing, unfiltered and by status (keyset.py)
+        db.Index('ix_subscription_created', 'created_at', 'id'),
+        db.Index('ix_subscription_status_created', 'status', 'created_at', 'id'),
+        # A customer's subscriptions, newest first
+        db.Index('ix_subscription_user_created', 'user_id', 'created_at'),
+        # Due subscriptions scanned by the scheduler (scheduler._due_filter)
+        db.Index('ix_subscription_due', 'is_active', 'status', 'next_delivery'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -160,17 +242,52 @@ class Subscription(db.Model):
     # Relationships
     items = db.relationship('SubscriptionItem', backref='subscription', lazy='dynamic', cascade='all, delete-orphan')
     
+    # Delivery interval per frequency
+    FREQUENCY_INTERVALS = {
+        'daily': timedelta(days=1),
+        'weekly': timedelta(weeks=1),
+    }
+    
+    @classmethod
+    def next_delivery_for(cls, frequency, start=None):
+        """Return the delivery date following `start` (default: now) for a frequency, or None if unknown"""
+        interval = cls.FREQUENCY_INTERVALS.get(frequency)
+        if interval is None:
+            return None
+        return (start or datetime.utcnow()) + interval
+    
     def calculate_next_delivery(self):
         """Calculate next delivery date based on frequency"""
-        if self.frequency == 'daily':
-            self.next_delivery = datetime.utcnow() + timedelta(days=1)
-        elif self.frequency == 'weekly':
-            self.next_delivery = datetime.utcnow() + timedelta(weeks=1)
+        next_delivery = self.next_delivery_for(self.frequency)
+        if next_delivery is not None:
+            self.next_delivery = next_delivery
     
     def get_total_amount(self):
         """Calculate total amount for subscription"""
         return sum(item.quantity * item.product.price for item in self.items)
     
+    @staticmethod
+    def summaries_for(subscription_ids):
+        """
+        Item count and total amount for many subscriptions in one grouped query.
+        Returns {subscription_id: SubscriptionSummary}, with zeros for subscriptions without items.
+        """
+        summaries = {subscription_id: SubscriptionSummary(0, 0.0) for subscription_id in subscription_ids}
+        if not summaries:
+            return summaries
+        
+        rows = db.session.query(
+            SubscriptionItem.subscription_id,
+            db.func.count(SubscriptionItem.id),
+            db.func.sum(SubscriptionItem.quantity * Product.price)
+        ).outerjoin(Product, SubscriptionItem.product_id == Product.id).filter(
+            SubscriptionItem.subscription_id.in_(summaries)
+        ).group_by(SubscriptionItem.subscription_id)
+        
+        for subscription_id, item_count, total_amount in rows:
+            summaries[subscription_id] = SubscriptionSummary(item_count, total_amount or 0.0)
+        return summaries
+    
     def __repr__(self):
         return f'<Subscription #{self.id} {self.name}>'
 
@@ -178,6 +295,10 @@ class Subscription(db.Model):
 class SubscriptionItem(db.Model):
     """Items in a subscription"""
     __tablename__ = 'subscription_item'
+    __table_args__ = (
+        # A subscription's items, and the duplicate-product check when adding one
+        db.Index('ix_subscription_item_subscription_product', 'subscription_id', 'product_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     subscription_id = db.Column(db.Integer, db.ForeignKey('subscription.id'), nullable=False)
@@ -189,3 +310,132 @@ class SubscriptionItem(db.Model):
     
     def __repr__(self):
         return f'<SubscriptionItem Subscription:{self.subscription_id} Product:{self.product_id}>'
+
+
+class StatCounter(db.Model):
+    """Materialized dashboard counter, kept up to date incrementally by stats.py"""
+    __tablename__ = 'stat_counter'
+    
+    key = db.Column(db.String(100), primary_key=True)
+    value = db.Column(db.Float, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<StatCounter {self.key}={self.value}>'
+
+
+class StatDelta(db.Model):
+    """Change to a StatCounter not folded into it yet (stats.py); writers only append these"""
+    __tablename__ = 'stat_delta'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(100), nullable=False)
+    value = db.Column(db.Float, nullable=False)
+    
+    def __repr__(self):
+        return f'<StatDelta {self.key}{self.value:+}>'
+
+
+class ProductChange(db.Model):
+    """Product touched by a catalog write, so in-memory indexes can refresh incrementally (catalog_cache.py)"""
+    __tablename__ = 'product_change'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, nullable=False)  # no foreign key: deletions are logged too
+    stock_only = db.Column(db.Boolean, nullable=False, default=False)  # only the stock changed
+    
+    def __repr__(self):
+        return f'<ProductChange {self.id} Product:{self.product_id}>'
+
+
+class ProductRecommendation(db.Model):
+    """Product often bought together with another, precomputed by recommendations.py"""
+    __tablename__ = 'product_recommendation'
+    
+    # No foreign keys: rows naming deleted products are skipped on read and dropped by the next full build
+    product_id = db.Column(db.Integer, primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True, autoincrement=False)  # 0 = best
+    recommended_id = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Float, nullable=False)  # cosine similarity of the two products' orders
+    
+    def __repr__(self):
+        return f'<ProductRecommendation Product:{self.product_id} #{self.rank} -> {self.recommended_id}>'
+
+
+class UserOrderSummary(db.Model):
+    """Per-customer order totals for the profile page, kept up to date incrementally by stats.py"""
+    __tablename__ = 'user_order_summary'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    delivered_count = db.Column(db.Integer, nullable=False, default=0)
+    total_spent = db.Column(db.Float, nullable=False, default=0)  # delivered orders only
+    
+    def __repr__(self):
+        return f'<UserOrderSummary User:{self.user_id} Orders:{self.order_count}>'
+
+
+class Job(db.Model):
+    """Background job row, claimed and run by the worker pool in jobs.py"""
+    __tablename__ = 'job'
+    
+    STATUSES = ('queued', 'running', 'done', 'failed')
+    KIND_LABELS = {
+        'product_import': 'Product Import',
+        'process_subscriptions': 'Subscription Processing',
+        'image_variants': 'Image Resizing',
+    }
+    
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    params = db.Column(db.JSON)
+    result = db.Column(db.JSON)
+    error = db.Column(db.Text)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)  # None when the amount of work isn't known up front
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=1)
+    worker = db.Column(db.String(100))
+    created_by_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)  # heartbeat while running
+    
+    created_by = db.relationship('User')
+    
+    @property
+    def label(self):
+        return self.KIND_LABELS.get(self.kind, self.kind.replace('_', ' ').title())
+    
+    @property
+    def is_finished(self):
+        return self.status in ('done', 'failed')
+    
+    @property
+    def percent(self):
+        """Progress as a percentage, or None when the total is unknown"""
+        if self.status == 'done':
+            return 100
+        if not self.total:
+            return None
+        return min(100, int(self.progress * 100 / self.total))
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'label': self.label,
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'percent': self.percent,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+    
+    def __repr__(self):
+        return f'<Job #{self.id} {self.kind} {self.status}>'
@@ -0,0 +1,433 @@
+"""
+Bulk Product Import
+-------------------
+Vectorized import pipeline behind admin.bulk_upload_products.
+
+Instead of walking the DataFrame row by row, every column is coerced and
+validated with pandas operations, category ids are checked with a single
+IN query, and valid rows are written with Core executemany statements.
+Files are streamed in chunks of PRODUCT_IMPORT_CHUNK_SIZE rows (CSV via
+pandas chunksize, .xlsx via openpyxl read-only mode), each committed before
+the next is read. Invalid rows are skipped with per-row messages
+("Row N: ..."), numbered as in the spreadsheet (header = row 1).
+
+Two modes are supported:
+    insert - every valid row becomes a new product
+    upsert - rows are matched to existing products by SKU, or else by
+             name + category; only rows that differ are updated, and
+             unmatched rows are inserted. Columns missing from the file
+             are left untouched on existing products.
+"""
+
+import itertools
+
+import numpy as np
+import openpyxl
+import pandas as pd
+from flask import current_app
+from sqlalchemy import bindparam, or_
+
+from models import db, Product, Category
+import catalog_cache
+import search
+import stats
+import uploads
+
+
+MODE_INSERT = 'insert'
+MODE_UPSERT = 'upsert'
+
+REQUIRED_COLUMNS = ['name', 'price', 'category_id']
+OPTIONAL_COLUMNS = ['description', 'stock', 'image', 'sku']
+
+# Columns compared as text, where NULL and '' mean the same thing
+TEXT_COLUMNS = {'description', 'image'}
+
+
+class MissingColumns(Exception):
+    """Raised when an uploaded file lacks required columns"""
+
+    def __init__(self, columns):
+        super().__init__(f"Missing columns: {', '.join(columns)}")
+        self.columns = columns
+
+
+class EmptyFile(Exception):
+    """Raised when an uploaded file has no header row or no rows after it"""
+
+
+class ImportResult:
+    """Outcome of an import: counts plus per-row error messages"""
+
+    def __init__(self):
+        self.created_count = 0
+        self.updated_count = 0
+        self.unchanged_count = 0
+        self.error_count = 0
+        self.error_messages = []
+
+    @property
+    def success_count(self):
+        return self.created_count + self.updated_count
+
+    def add_errors(self, messages):
+        self.error_count += len(messages)
+        self.error_messages.extend(messages)
+
+
+def missing_columns(df):
+    """Return the required columns absent from the file"""
+    return [col for col in REQUIRED_COLUMNS if col not in df.columns]
+
+
+def _text_column(df, col):
+    """Stripped string column, '' for empty cells or an absent column"""
+    if col not in df.columns:
+        return pd.Series('', index=df.index, dtype=object)
+    values = df[col]
+    return values.where(values.notna(), '').astype(str).str.strip()
+
+
+def _number_column(df, col):
+    """Numeric column; blanks, text and infinities become NaN"""
+    numeric = pd.to_numeric(df[col], errors='coerce').astype(float)
+    return numeric.where(np.isfinite(numeric))
+
+
+def _sku_column(df):
+    """SKU column with None for blank cells (numeric SKUs like 1001.0 become '1001')"""
+    if 'sku' not in df.columns:
+        return pd.Series(None, index=df.index, dtype=object)
+    values = df['sku']
+    whole = _number_column(df, 'sku')
+    whole = whole.where(whole % 1 == 0)
+    text = values.astype(str).str.strip().where(whole.isna(), whole.astype('Int64').astype(str))
+    return text.where(values.notna() & (text != ''), None)
+
+
+class _Validator:
+    """Collects the first error of each row while columns are checked in bulk"""
+
+    def __init__(self, df):
+        self.df = df
+        self.bad = pd.Series(False, index=df.index)
+        self.errors = []
+
+    def reject(self, mask, message, values=None):
+        """Mark rows in `mask` invalid. `message` may use {value}, taken from the `values` Series."""
+        mask = mask & ~self.bad
+        if not mask.any():
+            return
+        for index in self.df.index[mask]:
+            value = values.at[index] if values is not None else None
+            self.errors.append((index, f"Row {index + 2}: {message.format(value=value)}"))
+        self.bad |= mask
+
+    def messages(self):
+        return [message for _, message in sorted(self.errors, key=lambda error: error[0])]
+
+
+def _extract_inline_images(image, check):
+    """Save data:image cells as upload files and return the column with their file names"""
+    inline = image.str[:5].str.lower().eq('data:') & ~check.bad
+    if not inline.any():
+        return image
+
+    image = image.copy()
+    for index in image.index[inline]:
+        problem = uploads.check_data_uri(image.at[index])
+        if problem:
+            check.reject(image.index == index, problem)
+            continue
+        filename = uploads.save_data_uri(image.at[index], 'products')
+        # Imports already run in a background job, so resize here
+        if not uploads.has_variants('products', filename):
+            uploads.generate_variants('products', filename)
+        image.at[index] = filename
+    return image
+
+
+def validate_frame(df, mode=MODE_INSERT):
+    """
+    Coerce and validate an uploaded DataFrame.
+    Returns (rows ready to write as a DataFrame, list of error messages).
+    """
+    check = _Validator(df)
+
+    name = _text_column(df, 'name')
+    check.reject(name == '', "Name is required")
+
+    price = _number_column(df, 'price')
+    check.reject(df['price'].isna(), "Price is required")
+    check.reject(price.isna(), "Invalid data format - price '{value}' is not a number", df['price'])
+    check.reject(price < 0, "Price must be positive")
+
+    category_id = _number_column(df, 'category_id')
+    check.reject(df['category_id'].isna(), "Category ID is required")
+    check.reject(category_id.isna() | (category_id % 1 != 0),
+                 "Invalid data format - category ID '{value}' is not a whole number", df['category_id'])
+
+    if 'stock' in df.columns:
+        stock = _number_column(df, 'stock')
+        check.reject(df['stock'].notna() & (stock.isna() | (stock % 1 != 0)),
+                     "Invalid data format - stock '{value}' is not a whole number", df['stock'])
+        check.reject(stock < 0, "Stock cannot be negative")
+    else:
+        stock = pd.Series(0.0, index=df.index)
+
+    sku = _sku_column(df)
+    check.reject(sku.str.len() > Product.sku.type.length, "SKU '{value}' is too long", sku)
+    check.reject(sku.notna() & sku.duplicated(), "Duplicate SKU '{value}' in file", sku)
+
+    # One query checks every distinct category id in the file
+    category_id = category_id.where(~check.bad, -1).astype('int64')
+    candidate_ids = category_id[~check.bad].unique().tolist()
+    existing_ids = set(db.session.execute(
+        db.select(Category.id).where(Category.id.in_(candidate_ids))
+    ).scalars()) if candidate_ids else set()
+    check.reject(~category_id.isin(existing_ids), "Category ID {value} does not exist", category_id)
+
+    if mode == MODE_UPSERT:
+        # Without a SKU, name + category is the key, so it must be unique in the file
+        keys = pd.DataFrame({'name': name, 'category_id': category_id})
+        unkeyed = sku.isna() & ~check.bad
+        duplicate = keys[unkeyed].duplicated().reindex(df.index, fill_value=False)
+        check.reject(duplicate, "Duplicate product '{value}' in file", name)
+
+    # Last, so only rows that will be written get their inline images saved
+    image = _extract_inline_images(_text_column(df, 'image'), check)
+
+    valid = ~check.bad
+    rows = pd.DataFrame({
+        'sku': sku[valid],
+        'name': name[valid],
+        'description': _text_column(df, 'description')[valid],
+        'price': price[valid],
+        'stock': stock[valid].fillna(0).astype('int64'),
+        'category_id': category_id[valid],
+        'image': image[valid],
+        'is_active': True,
+    })
+    return rows, check.messages()
+
+
+def insert_rows(rows):
+    """
+    Insert validated rows with one Core executemany within the current
+    transaction, keeping the search index, dashboard counters and catalog
+    cache in step.
+    Returns the new product ids.
+    """
+    if not len(rows):
+        return []
+
+    product_table = Product.__table__
+    product_ids = db.session.execute(
+        product_table.insert().returning(product_table.c.id, sort_by_parameter_order=True),
+        rows.to_dict('records')
+    ).scalars().all()
+
+    # Core inserts skip the ORM events that normally maintain these
+    search.index_products(db.session.connection(), product_ids)
+    stats.add_to_counters({'products': len(product_ids), 'products.active': len(product_ids)})
+    catalog_cache.bump_version(product_ids)
+    return product_ids
+
+
+def _insert_chunk(rows, result):
+    """Insert mode: add every row, rejecting SKUs that already exist"""
+    check = _Validator(rows)
+    skus = rows['sku'].dropna().tolist()
+    if skus:
+        taken = set(db.session.execute(
+            db.select(Product.sku).where(Product.sku.in_(skus))
+        ).scalars())
+        check.reject(rows['sku'].isin(taken), "SKU '{value}' already exists", rows['sku'])
+
+    result.add_errors(check.messages())
+    result.created_count += len(insert_rows(rows[~check.bad]))
+
+
+def _load_matches(rows, columns):
+    """Load existing products sharing a SKU or name with `rows`, oldest first (one indexed query)"""
+    fields = ['id', 'sku', 'name', 'category_id'] + [col for col in columns if col not in ('sku', 'name', 'category_id')]
+    product_table = Product.__table__
+
+    conditions = [product_table.c.name.in_(rows['name'].unique().tolist())]
+    skus = rows['sku'].dropna().tolist()
+    if skus:
+        conditions.append(product_table.c.sku.in_(skus))
+
+    found = db.session.execute(
+        db.select(*[product_table.c[field] for field in fields])
+        .where(or_(*conditions))
+        .order_by(product_table.c.id)
+    ).all()
+    return pd.DataFrame(found, columns=fields)
+
+
+def _match_ids(rows, existing):
+    """
+    Existing product id for each row (NaN when new). A SKU match wins; otherwise
+    name + category picks the oldest product, and a row carrying a SKU may only
+    claim a product that doesn't have one yet.
+    """
+    by_sku = existing.dropna(subset=['sku']).set_index('sku')['id']
+    matched = rows['sku'].map(by_sku).astype(float)
+
+    key = pd.MultiIndex.from_frame(rows[['name', 'category_id']])
+    by_name = existing.drop_duplicates(['name', 'category_id']).set_index(['name', 'category_id'])['id']
+    without_sku = existing[existing['sku'].isna()].drop_duplicates(['name', 'category_id'])
+    without_sku = without_sku.set_index(['name', 'category_id'])['id']
+
+    name_match = np.where(
+        rows['sku'].isna(),
+        by_name.reindex(key).to_numpy(dtype=float),
+        without_sku.reindex(key).to_numpy(dtype=float)
+    )
+    return matched.fillna(pd.Series(name_match, index=rows.index))
+
+
+def _changed(incoming, current):
+    """Boolean Series: rows where any column differs from the stored product"""
+    changed = pd.Series(False, index=incoming.index)
+    for col in incoming.columns:
+        new, old = incoming[col], current[col]
+        if col in TEXT_COLUMNS:
+            new, old = new.fillna(''), old.fillna('')
+        changed |= new.ne(old)
+    return changed
+
+
+def _upsert_chunk(rows, columns, result):
+    """Upsert mode: diff rows against stored products, update changed ones, insert new ones"""
+    existing = _load_matches(rows, columns)
+    matched = _match_ids(rows, existing)
+
+    check = _Validator(rows)
+    check.reject(matched.notna() & matched.duplicated(), "Matches the same product as an earlier row")
+    result.add_errors(check.messages())
+
+    found = matched[matched.notna() & ~check.bad].astype('int64')
+    current = existing.set_index('id').loc[found, columns]
+    current.index = found.index
+
+    # A blank SKU cell never clears a product's SKU
+    incoming = rows.loc[found.index, columns]
+    if 'sku' in columns:
+        incoming['sku'] = incoming['sku'].where(incoming['sku'].notna(), current['sku'])
+
+    changed = _changed(incoming, current)
+    updates = incoming[changed].assign(product_id=found[changed])
+
+    if len(updates):
+        product_table = Product.__table__
+        db.session.execute(
+            product_table.update().where(product_table.c.id == bindparam('product_id')),
+            updates.to_dict('records')
+        )
+        search.index_products(db.session.connection(), updates['product_id'].tolist())
+        catalog_cache.bump_version(updates['product_id'].tolist())
+
+    result.updated_count += len(updates)
+    result.unchanged_count += len(found) - len(updates)
+    result.created_count += len(insert_rows(rows[matched.isna() & ~check.bad]))
+
+
+# ========== READING FILES ==========
+
+def is_supported(filename):
+    """Check whether the uploaded file type can be imported"""
+    return filename.lower().endswith(('.csv', '.xlsx', '.xls'))
+
+
+def read_chunks(file, filename, chunk_size):
+    """
+    Yield the rows of an uploaded file as DataFrames of at most `chunk_size`
+    rows, indexed by data row number (0 = first row after the header), without
+    loading the whole file. Legacy .xls files have no streaming reader and are
+    read in one go.
+    """
+    filename = filename.lower()
+    if filename.endswith('.csv'):
+        try:
+            reader = pd.read_csv(file, chunksize=chunk_size)
+        except pd.errors.EmptyDataError:
+            raise EmptyFile("The file is empty or is missing its header row") from None
+        yield from reader
+    elif filename.endswith('.xlsx'):
+        yield from _read_xlsx_chunks(file, chunk_size)
+    else:
+        df = pd.read_excel(file)
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start + chunk_size]
+
+
+def _read_xlsx_chunks(file, chunk_size):
+    """Stream the first worksheet of an .xlsx file with openpyxl's read-only mode"""
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(value).strip() if value is not None else '' for value in header]
+
+        # Keep sheet row numbers for error messages even when blank rows are skipped
+        numbered = ((number, row) for number, row in enumerate(rows) if any(value is not None for value in row))
+        while True:
+            batch = list(itertools.islice(numbered, chunk_size))
+            if not batch:
+                break
+            index = [number for number, _ in batch]
+            values = [row[:len(columns)] + (None,) * (len(columns) - len(row)) for _, row in batch]
+            yield pd.DataFrame(values, columns=columns, index=index)
+    finally:
+        workbook.close()
+
+
+# ========== IMPORTING ==========
+
+def import_file(file, filename, mode=MODE_INSERT, chunk_size=None, result=None, progress=None):
+    """
+    Stream an uploaded CSV/Excel file into the catalog. Each chunk is read,
+    validated, written and committed before the next one is read, so memory
+    use stays flat however large the file is. Duplicate keys are caught
+    within a chunk; across chunks, insert mode reports the SKU as existing
+    and upsert mode lets the later row win.
+    Pass `result` to keep the counts of committed chunks if a later one fails,
+    and `progress` to be called with the number of rows read after each chunk.
+    Raises MissingColumns if the header lacks a required column, and EmptyFile
+    if there is no header row or no rows after it.
+    """
+    chunk_size = chunk_size or current_app.config['PRODUCT_IMPORT_CHUNK_SIZE']
+    result = result if result is not None else ImportResult()
+    columns = None
+    rows_read = 0
+
+    for df in read_chunks(file, filename, chunk_size):
+        if columns is None:
+            missing = missing_columns(df)
+            if missing:
+                raise MissingColumns(missing)
+            # Upserts only overwrite the columns the file actually has
+            columns = REQUIRED_COLUMNS + [col for col in OPTIONAL_COLUMNS if col in df.columns]
+
+        rows, errors = validate_frame(df, mode)
+        result.add_errors(errors)
+        if len(rows):
+            if mode == MODE_UPSERT:
+                _upsert_chunk(rows, columns, result)
+            else:
+                _insert_chunk(rows, result)
+            db.session.commit()
+
+        rows_read += len(df)
+        if progress:
+            progress(rows_read)
+
+    if columns is None:
+        raise EmptyFile("The file is empty or is missing its header row")
+    if not rows_read:
+        raise EmptyFile("The file has a header row but no products")
+    return result
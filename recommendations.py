@@ -0,0 +1,215 @@
+"""
+Recommendations
+---------------
+"Frequently bought together" products for the product page.
+
+A batch build counts how often two products were bought in the same order
+(order_item grouped by order_id). With B the orders x products 0/1 matrix
+(scipy.sparse), the co-occurrence counts are C = BᵀB, and C[i, i] is the
+number of orders containing product i. Pairs bought together in at least
+RECOMMENDATION_MIN_ORDERS orders are scored by cosine similarity,
+C[i, j] / sqrt(C[i, i] * C[j, j]), so staples bought with everything don't
+crowd out real companions, and the best RECOMMENDATION_TOP_K per product
+are stored in product_recommendation. Product pages read them with one
+primary-key query and top up from the same category.
+
+Builds are incremental: C is saved to RECOMMENDATION_STATE_PATH along with
+the last order it covers, so the next run only reads newer orders, adds
+their BᵀB and re-ranks the products in them (other products keep their
+lists, slightly stale as neighbours gain orders). Everything is recounted when
+the file is missing or doesn't match the table (e.g. a run on another
+host), or with --full. Cancelled orders are left out; an order cancelled
+after it was counted stays in until the next full build. Run from cron:
+
+    flask --app app build-recommendations          # e.g. hourly
+    flask --app app build-recommendations --full   # e.g. weekly
+"""
+
+import itertools
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import click
+import numpy as np
+from flask import current_app
+
+from models import db, Order, OrderItem, Product, ProductRecommendation, StatCounter
+import catalog_cache
+
+
+# stat_counter row holding the last order id reflected in product_recommendation
+MARKER = 'recommendations.last_order_id'
+
+# Orders younger than this may still be committing with lower ids, so they wait for the next run
+SETTLE_SECONDS = 60
+
+# Rows fetched, deleted or inserted per statement
+CHUNK_SIZE = 50000
+
+State = namedtuple('State', 'matrix last_order_id')
+
+
+# ========== BUILD ==========
+
+def _load_items(after, upto):
+    """Order and product id arrays of the items of orders after .. upto, cancelled orders left out"""
+    # Core rows straight into flat arrays: ORM rows and np.array(rows) are several times slower here
+    result = db.session.connection().execute(
+        db.select(OrderItem.order_id, OrderItem.product_id)
+        .join(Order, Order.id == OrderItem.order_id)
+        .where(Order.id > after, Order.id <= upto, Order.status != 'Cancelled'),
+        execution_options={'stream_results': True, 'yield_per': CHUNK_SIZE}
+    )
+    chunks = [np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=2 * len(rows))
+              for rows in result.partitions()]
+    items = np.concatenate(chunks).reshape(-1, 2) if chunks else np.zeros((0, 2), dtype=np.int64)
+    return items[:, 0], items[:, 1]
+
+
+def _cooccurrence(order_ids, product_ids, size):
+    """BᵀB for the given order items, as a size x size CSR matrix"""
+    from scipy import sparse
+
+    _, orders = np.unique(order_ids, return_inverse=True)
+    baskets = sparse.csr_matrix(
+        (np.ones(len(orders), dtype=np.int32), (orders, product_ids)),
+        shape=(orders.max() + 1 if len(orders) else 0, size)
+    )
+    # A product listed twice in one order still counts once
+    baskets.sum_duplicates()
+    baskets.data[:] = 1
+    return (baskets.T @ baskets).tocsr()
+
+
+def _top_neighbours(matrix, products, top_k, min_orders):
+    """(product, rank, recommended product, score) arrays of the best neighbours of `products`"""
+    block = matrix[products].tocoo()
+    rows, columns, shared = block.row, block.col, block.data
+    keep = (columns != products[rows]) & (shared >= min_orders)
+    rows, columns, shared = rows[keep], columns[keep], shared[keep]
+
+    orders = matrix.diagonal().astype(np.float64)
+    scores = shared / np.sqrt(orders[products[rows]] * orders[columns])
+
+    # Best first within each product; rank = position within the product's run
+    order = np.lexsort((columns, -scores, rows))
+    rows, columns, scores = rows[order], columns[order], scores[order]
+    ranks = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = ranks < top_k
+    return products[rows[keep]], ranks[keep], columns[keep], scores[keep]
+
+
+def _write(products, neighbours, full):
+    table = ProductRecommendation.__table__
+    if full:
+        db.session.execute(table.delete())
+    else:
+        for start in range(0, len(products), CHUNK_SIZE):
+            chunk = products[start:start + CHUNK_SIZE].tolist()
+            db.session.execute(table.delete().where(table.c.product_id.in_(chunk)))
+
+    rows = [
+        {'product_id': product_id, 'rank': rank, 'recommended_id': recommended_id, 'score': score}
+        for product_id, rank, recommended_id, score in zip(*(column.tolist() for column in neighbours))
+    ]
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(table.insert(), rows[start:start + CHUNK_SIZE])
+    return len(rows)
+
+
+def _load_state(path):
+    from scipy import sparse
+
+    try:
+        with np.load(path, allow_pickle=False) as saved:
+            matrix = sparse.csr_matrix((saved['data'], saved['indices'], saved['indptr']), shape=tuple(saved['shape']))
+            return State(matrix, int(saved['last_order_id']))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _save_state(path, state):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as file:
+        np.savez(file, data=state.matrix.data, indices=state.matrix.indices, indptr=state.matrix.indptr,
+                 shape=np.array(state.matrix.shape), last_order_id=np.array(state.last_order_id))
+    os.replace(temporary, path)
+
+
+def build(full=False):
+    """
+    Bring product_recommendation up to date with the orders placed since the
+    last build (all orders if full=True or the saved counts can't be used).
+    Returns a summary dict.
+    """
+    config = current_app.config
+    settled = datetime.utcnow() - timedelta(seconds=SETTLE_SECONDS)
+    upto = db.session.execute(db.select(db.func.max(Order.id)).where(Order.created_at <= settled)).scalar() or 0
+    marker = db.session.get(StatCounter, MARKER)
+
+    state = None if full or marker is None else _load_state(config['RECOMMENDATION_STATE_PATH'])
+    full = state is None or state.last_order_id != int(marker.value)
+    after = 0 if full else state.last_order_id
+    if upto <= after:
+        return {'full': full, 'orders_after': after, 'items': 0, 'products': 0, 'recommendations': 0}
+
+    order_ids, product_ids = _load_items(after, upto)
+    size = int(max(product_ids.max() + 1 if len(product_ids) else 0, 0 if full else state.matrix.shape[0]))
+    matrix = _cooccurrence(order_ids, product_ids, size)
+    if full:
+        products = np.flatnonzero(matrix.diagonal())
+    else:
+        previous = state.matrix
+        previous.resize((size, size))
+        matrix = previous + matrix
+        products = np.unique(product_ids)
+
+    neighbours = _top_neighbours(matrix, products, config['RECOMMENDATION_TOP_K'], config['RECOMMENDATION_MIN_ORDERS'])
+    written = _write(products, neighbours, full)
+    db.session.merge(StatCounter(key=MARKER, value=upto))
+    # Product pages are cached per catalog version
+    catalog_cache.bump_version()
+    db.session.commit()
+
+    # Saved after the commit: if this fails, the next run just rebuilds in full
+    _save_state(config['RECOMMENDATION_STATE_PATH'], State(matrix, upto))
+    return {'full': full, 'orders_after': after, 'items': len(order_ids), 'products': len(products),
+            'recommendations': written}
+
+
+# ========== PRODUCT PAGE ==========
+
+def related_products(product, limit=4):
+    """
+    (products, how many of them are bought-together recommendations) for
+    `product`'s page: its best active neighbours, then same-category products
+    """
+    recommended = Product.query \
+        .join(ProductRecommendation, ProductRecommendation.recommended_id == Product.id) \
+        .filter(ProductRecommendation.product_id == product.id, Product.is_active == True) \
+        .order_by(ProductRecommendation.rank) \
+        .limit(limit).all()
+    if len(recommended) == limit:
+        return recommended, limit
+
+    shown = [product.id] + [related.id for related in recommended]
+    same_category = Product.query \
+        .filter(Product.category_id == product.category_id, Product.is_active == True, Product.id.notin_(shown)) \
+        .limit(limit - len(recommended)).all()
+    return recommended + same_category, len(recommended)
+
+
+def init_app(app):
+    """Register the build-recommendations CLI command"""
+    @app.cli.command('build-recommendations')
+    @click.option('--full', is_flag=True, help='Recount all orders instead of only the new ones.')
+    def build_recommendations_command(full):
+        """Update "frequently bought together" products from the orders placed since the last run."""
+        result = build(full=full)
+        kind = 'Full' if result['full'] else 'Incremental'
+        print(f"{kind} build: {result['items']} order items read, "
+              f"{result['recommendations']} recommendations for {result['products']} products")
@@ -1,11 +1,16 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash, make_response
+from flask import Blueprint, render_template, redirect, url_for, request, flash, make_response, jsonify
 from flask_login import login_required, current_user
 from functools import wraps
-from models import User, Category, Product, Order, OrderItem, Subscription, SubscriptionItem, db
+from models import User, Category, Product, Order, OrderItem, Subscription, SubscriptionItem, Job, db
 from forms import CategoryForm, ProductForm, BulkUploadForm
+import stats
+import product_import
+import exports
+import tasks
+import keyset
+import database
 from werkzeug.utils import secure_filename
-import os
-import pandas as pd
+from sqlalchemy.orm import joinedload
 import io
 
 
@@ -25,36 +30,39 @@ def admin_required(f):
 @admin_bp.route('/dashboard')
 @login_required
 @admin_required
+@database.read_only
 def dashboard():
+    # All counters come from the materialized stat_counter table (see stats.py)
+    counters = stats.get_counters()
+    
     # User stats
-    total_users = User.query.count()
-    active_users = User.query.filter_by(is_active=True).count()
+    total_users = counters.count('users')
+    active_users = counters.count('users.active')
     
     # Category stats
-    total_categories = Category.query.count()
-    active_categories = Category.query.filter_by(is_active=True).count()
+    total_categories = counters.count('categories')
+    active_categories = counters.count('categories.active')
     
     # Product stats
-    total_products = Product.query.count()
-    active_products = Product.query.filter_by(is_active=True).count()
+    total_products = counters.count('products')
+    active_products = counters.count('products.active')
     
     # Order stats
-    total_orders = Order.query.count()
-    pending_orders = Order.query.filter_by(status='Pending').count()
+    total_orders = counters.count('orders')
+    pending_orders = counters.count('orders.status.Pending')
     
-    # Calculate total sales from all delivered orders
-    delivered_orders = Order.query.filter_by(status='Delivered').all()
-    total_sales = sum(order.total_amount for order in delivered_orders)
+    # Total sales from all delivered orders
+    total_sales = counters.amount('revenue.delivered')
     
     # Subscription stats (NEW!)
-    subscription_count = Subscription.query.filter_by(is_active=True, status='approved').count()
-    pending_subscriptions = Subscription.query.filter_by(status='pending').count()
+    subscription_count = counters.count('subscriptions.active')
+    pending_subscriptions = counters.count('subscriptions.status.pending')
     
     # Get recent orders
-    recent_orders = Order.query.order_by(Order.created_at.desc()).limit(5).all()
+    recent_orders = Order.query.options(joinedload(Order.user)).order_by(Order.created_at.desc()).limit(5).all()
     
     # Get recent subscriptions (NEW!)
-    recent_subscriptions = Subscription.query.order_by(Subscription.created_at.desc()).limit(5).all()
+    recent_subscriptions = Subscription.query.options(joinedload(Subscription.user)).order_by(Subscription.created_at.desc()).limit(5).all()
     
     return render_template('admin/dashboard.html',
                          total_users=total_users,
@@ -77,9 +85,12 @@ def dashboard():
 @admin_bp.route('/categories')
 @login_required
 @admin_required
+@database.read_only
 def categories():
     categories = Category.query.all()
-    return render_template('admin/categories.html', categories=categories)
+    # Product counts for all categories in one grouped query
+    product_counts = Category.product_counts()
+    return render_template('admin/categories.html', categories=categories, product_counts=product_counts)
 
 
 @admin_bp.route('/add_category', methods=['GET', 'POST'])
@@ -92,11 +103,9 @@ def add_category():
         image_value = None
         
         if form.image_url.data:
-            image_value = form.image_url.data
+            image_value = tasks.save_image_url(form.image_url.data, 'categories', user_id=current_user.id)
         elif form.image.data and hasattr(form.image.data, 'filename'):
-            filename = secure_filename(form.image.data.filename)
-            form.image.data.save(os.path.join('static/uploads/categories', filename))
-            image_value = filename
+            image_value = tasks.save_image_upload(form.image.data, 'categories', user_id=current_user.id)
         
         category = Category(
             name=form.name.data,
@@ -126,11 +135,9 @@ def edit_category(id):
         
         # Handle image - Priority: URL > Upload > Keep existing
         if form.image_url.data:
-            category.image = form.image_url.data
+            category.image = tasks.save_image_url(form.image_url.data, 'categories', user_id=current_user.id)
         elif form.image.data and hasattr(form.image.data, 'filename'):
-            filename = secure_filename(form.image.data.filename)
-            form.image.data.save(os.path.join('static/uploads/categories', filename))
-            category.image = filename
+            category.image = tasks.save_image_upload(form.image.data, 'categories', user_id=current_user.id)
         
         db.session.commit()
         flash('Category updated successfully!', 'success')
@@ -159,9 +166,10 @@ def delete_category(id):
 @admin_bp.route('/products')
 @login_required
 @admin_required
+@database.read_only
 def products():
-    page = request.args.get('page', 1, type=int)
-    products = Product.query.paginate(page=page, per_page=10, error_out=False)
+    products = keyset.paginate(Product.query, Product, per_page=10,
+                               total=lambda: stats.get_counters().count('products'))
     return render_template('admin/products.html', products=products)
 
 
@@ -177,11 +185,9 @@ def add_product():
         image_value = None
         
         if form.image_url.data:
-            image_value = form.image_url.data
+            image_value = tasks.save_image_url(form.image_url.data, 'products', user_id=current_user.id)
         elif form.image.data and hasattr(form.image.data, 'filename'):
-            filename = secure_filename(form.image.data.filename)
-            form.image.data.save(os.path.join('static/uploads/products', filename))
-            image_value = filename
+            image_value = tasks.save_image_upload(form.image.data, 'products', user_id=current_user.id)
         
         product = Product(
             name=form.name.data,
@@ -218,11 +224,9 @@ def edit_product(id):
         
         # Handle image - Priority: URL > Upload > Keep existing
         if form.image_url.data:
-            product.image = form.image_url.data
+            product.image = tasks.save_image_url(form.image_url.data, 'products', user_id=current_user.id)
         elif form.image.data and hasattr(form.image.data, 'filename'):
-            filename = secure_filename(form.image.data.filename)
-            form.image.data.save(os.path.join('static/uploads/products', filename))
-            product.image = filename
+            product.image = tasks.save_image_upload(form.image.data, 'products', user_id=current_user.id)
         
         db.session.commit()
         flash('Product updated successfully!', 'success')
@@ -255,76 +259,14 @@ def bulk_upload_products():
         file = form.file.data
         filename = secure_filename(file.filename)
         
-        try:
-            # Read CSV or Excel file
-            if filename.endswith('.csv'):
-                df = pd.read_csv(file)
-            elif filename.endswith('.xlsx') or filename.endswith('.xls'):
-                df = pd.read_excel(file)
-            else:
-                flash('Invalid file format. Please upload CSV or Excel file.', 'danger')
-                return redirect(url_for('admin.bulk_upload_products'))
-            
-            # Expected columns
-            required_columns = ['name', 'price', 'category_id']
-            
-            # Check if required columns exist
-            if not all(col in df.columns for col in required_columns):
-                flash(f'CSV must have these columns: {", ".join(required_columns)}', 'danger')
-                return redirect(url_for('admin.bulk_upload_products'))
-            
-            # Add products
-            success_count = 0
-            error_count = 0
-            error_messages = []
-            
-            for index, row in df.iterrows():
-                try:
-                    # Validate category exists
-                    category = Category.query.get(int(row['category_id']))
-                    if not category:
-                        error_messages.append(f"Row {index + 2}: Category ID {row['category_id']} does not exist")
-                        error_count += 1
-                        continue
-                    
-                    # Create product
-                    product = Product(
-                        name=str(row['name']).strip(),
-                        description=str(row.get('description', '')).strip() if pd.notna(row.get('description')) else '',
-                        price=float(row['price']),
-                        stock=int(row.get('stock', 0)) if pd.notna(row.get('stock')) else 0,
-                        category_id=int(row['category_id']),
-                        image=str(row.get('image', '')).strip() if pd.notna(row.get('image')) else '',
-                        is_active=True
-                    )
-                    
-                    db.session.add(product)
-                    success_count += 1
-                    
-                except ValueError as e:
-                    error_messages.append(f"Row {index + 2}: Invalid data format - {str(e)}")
-                    error_count += 1
-                except Exception as e:
-                    error_messages.append(f"Row {index + 2}: {str(e)}")
-                    error_count += 1
-                    continue
-            
-            # Commit all products
-            if success_count > 0:
-                db.session.commit()
-                flash(f'✅ Successfully uploaded {success_count} products!', 'success')
-            
-            if error_count > 0:
-                flash(f'⚠️ {error_count} products failed to upload.', 'warning')
-                for msg in error_messages[:5]:
-                    flash(msg, 'danger')
-            
-            return redirect(url_for('admin.products'))
-            
-        except Exception as e:
-            db.session.rollback()
-            flash(f'Error processing file: {str(e)}', 'danger')
+        if not product_import.is_supported(filename):
+            flash('Invalid file format. Please upload CSV or Excel file.', 'danger')
             return redirect(url_for('admin.bulk_upload_products'))
+        
+        # Import in the background; the job page shows progress and the outcome
+        job = tasks.enqueue_product_import(file, filename, form.mode.data, user_id=current_user.id)
+        flash('📥 File received. Products are being imported in the background.', 'info')
+        return redirect(url_for('admin.job_detail', id=job.id))
     
     return render_template('admin/bulk_upload.html', form=form)
 
@@ -358,10 +300,14 @@ Basmati Rice,Premium quality basmati rice 5kg,350,50,{category_examples[0][0]},h
 @admin_bp.route('/orders')
 @login_required
 @admin_required
+@database.read_only
 def orders():
-    page = request.args.get('page', 1, type=int)
-    orders = Order.query.order_by(Order.created_at.desc()).paginate(page=page, per_page=10, error_out=False)
-    return render_template('admin/orders.html', orders=orders)
+    # Customer loaded in the same query for the table rows
+    orders = keyset.paginate(Order.query.options(joinedload(Order.user)), Order, per_page=10,
+                             total=lambda: stats.get_counters().count('orders'))
+    # Item counts and first items for the whole page: one grouped and one windowed query
+    summaries = Order.summaries_for([order.id for order in orders.items])
+    return render_template('admin/orders.html', orders=orders, summaries=summaries)
 
 
 @admin_bp.route('/order/<int:id>')
@@ -399,6 +345,7 @@ def print_order(id):
 @admin_bp.route('/users')
 @login_required
 @admin_required
+@database.read_only
 def users():
     users = User.query.order_by(User.is_admin.desc(), User.created_at.desc()).all()
     return render_template('admin/users.html', users=users)
@@ -425,32 +372,38 @@ def toggle_user(id):
 @admin_bp.route('/subscriptions')
 @login_required
 @admin_required
+@database.read_only
 def subscriptions():
     """View all customer subscriptions"""
-    page = request.args.get('page', 1, type=int)
     status_filter = request.args.get('status', 'all')
+    counters = stats.get_counters()
     
-    # Base query
-    query = Subscription.query
+    # Base query (customer loaded in the same query for the table rows)
+    query = Subscription.query.options(joinedload(Subscription.user))
     
     # Apply status filter
+    total_key = 'subscriptions'
     if status_filter != 'all':
         query = query.filter_by(status=status_filter)
+        total_key = f'subscriptions.status.{status_filter}'
     
     # Paginate
-    subscriptions = query.order_by(Subscription.created_at.desc()).paginate(
-        page=page, per_page=20, error_out=False
-    )
+    subscriptions = keyset.paginate(query, Subscription, per_page=20,
+                                    total=lambda: counters.count(total_key))
     
     # Get statistics
-    total_subscriptions = Subscription.query.count()
-    pending_count = Subscription.query.filter_by(status='pending').count()
-    approved_count = Subscription.query.filter_by(status='approved').count()
-    rejected_count = Subscription.query.filter_by(status='rejected').count()
-    active_count = Subscription.query.filter_by(is_active=True, status='approved').count()
+    total_subscriptions = counters.count('subscriptions')
+    pending_count = counters.count('subscriptions.status.pending')
+    approved_count = counters.count('subscriptions.status.approved')
+    rejected_count = counters.count('subscriptions.status.rejected')
+    active_count = counters.count('subscriptions.active')
+    
+    # Item counts and totals for the whole page in one grouped query
+    summaries = Subscription.summaries_for([s.id for s in subscriptions.items])
     
     return render_template('admin/subscriptions.html',
                           subscriptions=subscriptions,
+                          summaries=summaries,
                           status_filter=status_filter,
                           total_subscriptions=total_subscriptions,
                           pending_count=pending_count,
@@ -459,6 +412,16 @@ def subscriptions():
                           active_count=active_count)
 
 
+@admin_bp.route('/subscriptions/process', methods=['POST'])
+@login_required
+@admin_required
+def process_subscriptions():
+    """Create orders for all due subscriptions in a background job"""
+    job = tasks.enqueue_subscription_processing(user_id=current_user.id)
+    flash('🔄 Processing due subscriptions in the background.', 'info')
+    return redirect(url_for('admin.job_detail', id=job.id))
+
+
 @admin_bp.route('/subscription/<int:id>')
 @login_required
 @admin_required
@@ -542,3 +505,70 @@ def delete_subscription(id):
     
     flash('Subscription deleted successfully!', 'success')
     return redirect(url_for('admin.subscriptions'))
+
+
+# ==================== EXPORTS ====================
+
+# List page to go back to when an export request is invalid
+EXPORT_PAGES = {
+    'orders': 'admin.orders',
+    'order_items': 'admin.orders',
+    'products': 'admin.products',
+    'subscriptions': 'admin.subscriptions',
+}
+
+
+@admin_bp.route('/export')
+@login_required
+@admin_required
+@database.read_only
+def export():
+    """Stream orders, order items, products or subscriptions as CSV or Excel"""
+    kind = request.args.get('kind', 'orders')
+    file_format = request.args.get('format', 'csv')
+    status = request.args.get('status') or None
+    
+    if kind not in exports.EXPORTS or file_format not in exports.FORMATS:
+        flash('Unknown export.', 'danger')
+        return redirect(url_for('admin.dashboard'))
+    back = url_for(EXPORT_PAGES[kind])
+    if status is not None and status not in exports.EXPORTS[kind].statuses:
+        flash(f'Unknown status "{status}".', 'danger')
+        return redirect(back)
+    try:
+        date_from = exports.parse_date(request.args.get('date_from'))
+        date_to = exports.parse_date(request.args.get('date_to'))
+    except ValueError:
+        flash('Dates must be given as YYYY-MM-DD.', 'danger')
+        return redirect(back)
+    
+    return exports.stream(kind, file_format, date_from, date_to, status)
+
+
+# ==================== BACKGROUND JOBS ====================
+
+@admin_bp.route('/jobs')
+@login_required
+@admin_required
+def jobs():
+    """Recent background jobs"""
+    recent_jobs = Job.query.options(joinedload(Job.created_by)).order_by(Job.id.desc()).limit(50).all()
+    return render_template('admin/jobs.html', jobs=recent_jobs)
+
+
+@admin_bp.route('/jobs/<int:id>')
+@login_required
+@admin_required
+def job_detail(id):
+    """Job progress page (polls job_status until the job finishes)"""
+    job = Job.query.get_or_404(id)
+    return render_template('admin/job_detail.html', job=job)
+
+
+@admin_bp.route('/jobs/<int:id>/status')
+@login_required
+@admin_required
+def job_status(id):
+    """Job status as JSON, for polling"""
+    job = Job.query.get_or_404(id)
+    return jsonify(job.to_dict())
@@ -1,7 +1,18 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash
+from flask import Blueprint, render_template, redirect, url_for, request, flash, jsonify, current_app
 from flask_login import login_required, current_user
+from sqlalchemy.orm import joinedload, selectinload
 from models import Category, Product, Cart, CartItem, Order, OrderItem, User, Subscription, SubscriptionItem, db
 from forms import CheckoutForm, ProfileForm, SubscriptionForm, AddSubscriptionItemForm
+from stock import reserve_stock, run_with_retry, InsufficientStock
+import search as product_search
+import suggest as product_suggest
+import facets
+import recommendations
+import catalog_cache
+import http_cache
+import keyset
+import database
+import stats
 from datetime import datetime, timedelta
 
 
@@ -11,46 +22,104 @@ customer_bp = Blueprint('customer', __name__)
 # ==================== SHOP & PRODUCTS ====================
 
 
+SHOP_PAGE_SIZE = 12
+
+
+def _load_products(product_ids):
+    """Snapshot products in the given order (ids that no longer exist are left out)"""
+    products = Product.query.options(joinedload(Product.category)).filter(Product.id.in_(product_ids)).all()
+    by_id = {product.id: product for product in products}
+    return [catalog_cache.snapshot_product(by_id[product_id]) for product_id in product_ids if product_id in by_id]
+
+
+def _load_active_categories():
+    return [catalog_cache.snapshot_category(category)
+            for category in Category.query.filter_by(is_active=True).all()]
+
+
 @customer_bp.route('/shop')
+@database.read_only
+@http_cache.catalog_page
 def shop():
-    page = request.args.get('page', 1, type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
     category_id = request.args.get('category', type=int)
     search = request.args.get('search', '')
+    price_band = facets.parse_price_band(request.args.get('price', type=int))
+    in_stock = request.args.get('in_stock', type=int) == 1
     
-    # Only show active products
-    query = Product.query.filter_by(is_active=True)
-    
-    if category_id:
-        query = query.filter_by(category_id=category_id)
-    
+    # Filtered live: the in-stock counts move when products sell out, without a new catalog version
     if search:
-        query = query.filter(Product.name.contains(search))
+        # Full-text match on name, description and category: the SEARCH_MATCH_LIMIT
+        # best matches are ranked once, then counted for the filters and paged.
+        # Search terms rarely repeat, so they stay out of the shared cache tier.
+        limit = current_app.config['SEARCH_MATCH_LIMIT']
+        matches = catalog_cache.cached('search', product_search.matching_ids, search, limit, shared=False)
+        total, counts = facets.count(matches, category_id, price_band, in_stock)
+        product_ids = product_search.page_ids(matches, category_id, facets.price_range(price_band), in_stock,
+                                              page=page, per_page=SHOP_PAGE_SIZE)
+        # A broad search filled the limit: its counts are a lower bound, and the page says so
+        match_limit = limit if len(matches) >= limit else None
+    else:
+        product_ids, total, counts = facets.select(category_id, price_band, in_stock, page=page,
+                                                   per_page=SHOP_PAGE_SIZE)
+        match_limit = None
     
-    products = query.paginate(page=page, per_page=12, error_out=False)
+    # Only the products shown are read from the database, stock always live
+    items = catalog_cache.cached('products', _load_products, tuple(product_ids))
+    stock = catalog_cache.stock_levels(product_ids)
+    http_cache.check_stock(stock)
+    products = catalog_cache.SnapshotPagination(page=page, per_page=SHOP_PAGE_SIZE, error_out=False,
+                                                items=items, total=total)
     
     # Only show active categories
-    categories = Category.query.filter_by(is_active=True).all()
+    categories = catalog_cache.cached('categories', _load_active_categories)
+    
+    # Filters kept when another one is picked (None values are left out of links)
+    filters = {'search': search or None, 'price': price_band, 'in_stock': 1 if in_stock else None}
     
     return render_template('customer/shop.html', 
                          products=products, 
+                         stock=stock,
                          categories=categories,
                          current_category=category_id,
-                         search=search)
+                         search=search,
+                         price_band=price_band,
+                         in_stock=in_stock,
+                         counts=counts,
+                         match_limit=match_limit,
+                         filters=filters)
+
+
+@customer_bp.route('/api/suggest')
+@database.read_only
+def suggest():
+    """Search-as-you-type results for the shop search box (see suggest.py)"""
+    query = request.args.get('q', '')[:100]
+    response = jsonify(query=query, results=product_suggest.suggest(query))
+    if product_suggest.ready():
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['SUGGEST_MAX_AGE']
+    else:
+        response.cache_control.no_store = True
+    return response
 
 
 @customer_bp.route('/product/<int:id>')
+@database.read_only
+@http_cache.catalog_page
 def product_detail(id):
     product = Product.query.get_or_404(id)
     if not product.is_active:
         flash('This product is currently unavailable', 'warning')
         return redirect(url_for('customer.shop'))
     
-    related_products = Product.query.filter_by(
-        category_id=product.category_id, 
-        is_active=True
-    ).filter(Product.id != id).limit(4).all()
+    http_cache.check_stock(catalog_cache.StockLevels({product.id: product.stock}, product.stock_updated_at))
+    
+    # Frequently bought together first, topped up from the same category
+    related_products, bought_together = recommendations.related_products(product)
     
-    return render_template('customer/product_detail.html', product=product, related_products=related_products)
+    return render_template('customer/product_detail.html', product=product, related_products=related_products,
+                           bought_together=bought_together)
 
 
 # ==================== CART MANAGEMENT ====================
@@ -139,6 +208,9 @@ def remove_from_cart(item_id):
 # ==================== CHECKOUT & ORDERS ====================
 
 
+ORDERS_PAGE_SIZE = 10
+
+
 @customer_bp.route('/checkout', methods=['GET', 'POST'])
 @login_required
 def checkout():
@@ -155,33 +227,45 @@ def checkout():
         # Get payment method from form
         payment_method = request.form.get('payment_method', 'cod')
         
-        # Create order with payment method
-        order = Order(
-            user_id=current_user.id,
-            total_amount=total,
-            delivery_address=form.delivery_address.data,
-            phone=form.phone.data,
-            payment_method=payment_method  # Save payment method
-        )
-        db.session.add(order)
-        db.session.commit()
-        
-        # Create order items and update stock
-        for cart_item, product in cart_items:
-            order_item = OrderItem(
-                order_id=order.id,
-                product_id=product.id,
-                quantity=cart_item.quantity,
-                price=product.price
+        def place_order():
+            # Reserve stock first: conditional decrements fail instead of overselling
+            reserve_stock((product.id, cart_item.quantity) for cart_item, product in cart_items)
+            
+            # Create order with payment method
+            order = Order(
+                user_id=current_user.id,
+                total_amount=total,
+                delivery_address=form.delivery_address.data,
+                phone=form.phone.data,
+                payment_method=payment_method  # Save payment method
             )
-            product.stock -= cart_item.quantity
-            db.session.add(order_item)
-        
-        # Clear cart
-        for cart_item, _ in cart_items:
-            db.session.delete(cart_item)
+            db.session.add(order)
+            db.session.flush()
+            
+            # Create order items
+            for cart_item, product in cart_items:
+                order_item = OrderItem(
+                    order_id=order.id,
+                    product_id=product.id,
+                    quantity=cart_item.quantity,
+                    price=product.price
+                )
+                db.session.add(order_item)
+            
+            # Clear cart
+            for cart_item, _ in cart_items:
+                db.session.delete(cart_item)
+            
+            # Order, items, stock and cart change together or not at all
+            db.session.commit()
         
-        db.session.commit()
+        try:
+            run_with_retry(place_order)
+        except InsufficientStock as e:
+            db.session.rollback()
+            product_name = next(product.name for _, product in cart_items if product.id == e.product_id)
+            flash(f'Sorry, {product_name} no longer has enough stock. Please update your cart.', 'danger')
+            return redirect(url_for('customer.cart'))
         
         # Show success message based on payment method
         if payment_method == 'cod':
@@ -209,7 +293,11 @@ def checkout():
 @customer_bp.route('/orders')
 @login_required
 def orders():
-    orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).all()
+    # Items and their products for the visible page only, one query each
+    query = Order.query.filter_by(user_id=current_user.id) \
+        .options(selectinload(Order.item_list).selectinload(OrderItem.product))
+    orders = keyset.paginate(query, Order, per_page=ORDERS_PAGE_SIZE,
+                             total=lambda: stats.get_user_summary(current_user.id).order_count)
     return render_template('customer/orders.html', orders=orders)
 
 
@@ -267,21 +355,15 @@ def profile():
             flash('An error occurred. Please try again.', 'danger')
             return redirect(url_for('customer.profile'))
     
-    # Get user statistics
-    total_orders = Order.query.filter_by(user_id=current_user.id).count()
-    completed_orders = Order.query.filter_by(user_id=current_user.id, status='Delivered').count()
-    
-    # Calculate total spent (only from delivered orders)
-    total_spent = db.session.query(db.func.sum(Order.total_amount)).filter_by(
-        user_id=current_user.id, 
-        status='Delivered'
-    ).scalar() or 0.0
+    # User statistics from the incrementally maintained summary (see stats.py);
+    # total spent counts delivered orders only
+    summary = stats.get_user_summary(current_user.id)
     
     return render_template('customer/profile.html', 
                           form=form,
-                          total_orders=total_orders,
-                          completed_orders=completed_orders,
-                          total_spent=total_spent)
+                          total_orders=summary.order_count,
+                          completed_orders=summary.delivered_count,
+                          total_spent=summary.total_spent)
 
 
 # ==================== SUBSCRIPTION MANAGEMENT ====================
@@ -292,7 +374,8 @@ def profile():
 def subscriptions():
     """View all user subscriptions"""
     subscriptions = Subscription.query.filter_by(user_id=current_user.id).order_by(Subscription.created_at.desc()).all()
-    return render_template('customer/subscriptions.html', subscriptions=subscriptions)
+    summaries = Subscription.summaries_for([s.id for s in subscriptions])
+    return render_template('customer/subscriptions.html', subscriptions=subscriptions, summaries=summaries)
 
 
 @customer_bp.route('/create_subscription', methods=['GET', 'POST'])
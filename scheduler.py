@@ -6,6 +6,14 @@ for customers based on their subscription frequency (daily/weekly).
 
 Usage:
     python scheduler.py
+    python scheduler.py --batch                    # set-based batch mode for large volumes
+    python scheduler.py --batch --chunk-size 1000  # commit every 1000 subscriptions
+    python scheduler.py --workers 4                # 4 processes, each owning a user_id shard
+    python scheduler.py --batch --shard 0/4        # only shard 0 of 4 (e.g. one per host)
+
+Batch and worker runs may overlap safely: each chunk claims its subscriptions before creating
+orders (SELECT ... FOR UPDATE SKIP LOCKED on PostgreSQL, the database write
+lock on SQLite), so a subscription is never ordered twice.
 
 Schedule with Cron (Linux/Mac):
     # Run daily at 6 AM
@@ -20,26 +28,42 @@ Schedule with Task Scheduler (Windows):
 
 import sys
 import os
+import argparse
+import multiprocessing
+from collections import defaultdict
 from datetime import datetime
 import logging
 
 # Add the project directory to the Python path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+from sqlalchemy import insert, bindparam
 from app import app, db
 from models import Subscription, SubscriptionItem, Order, OrderItem, Product, User
+from stock import reserve_stock, run_with_retry, is_contention_error, InsufficientStock
+import stats
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('subscription_scheduler.log'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+# How often a batch chunk is replanned when concurrent writers change stock under it
+CHUNK_ATTEMPTS = 3
+
+
+def configure_logging():
+    """
+    Log to subscription_scheduler.log and the console. Only called when run
+    from the command line: the web app's job workers import this module too
+    and keep their own logging setup.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('subscription_scheduler.log'),
+            logging.StreamHandler()
+        ]
+    )
+
 
 def process_subscriptions():
     """
@@ -169,6 +193,372 @@ def process_subscriptions():
         }
 
 
+def process_subscriptions_batch(chunk_size=None, shard=None, progress=None):
+    """
+    Set-based version of process_subscriptions() for large subscription volumes.
+    Due subscriptions are loaded together with their items, users and products
+    in a few bulk queries per chunk, stock is reserved in memory for the whole
+    chunk and orders are written with bulk inserts, committing once per chunk.
+    Skip/fail reporting is the same as in process_subscriptions().
+    
+    `shard` is an optional (index, count) pair: only subscriptions whose
+    user_id % count == index are processed, so several workers can split
+    the run between them. `progress(done, total)` is called after each chunk.
+    """
+    with app.app_context():
+        chunk_size = chunk_size or app.config['SUBSCRIPTION_BATCH_SIZE']
+        now = datetime.utcnow()
+        
+        query = db.session.query(Subscription.id).filter(*_due_filter(now))
+        if shard:
+            shard_index, shard_count = shard
+            query = query.filter(Subscription.user_id % shard_count == shard_index)
+        due_ids = [row.id for row in query.order_by(Subscription.id)]
+        db.session.rollback()  # end the read before chunks start claiming
+        
+        label = f" [shard {shard[0]}/{shard[1]}]" if shard else ""
+        logger.info(f"Found {len(due_ids)} approved subscriptions due for delivery{label}")
+        logger.info(f"Batch mode: processing in chunks of {chunk_size}{label}")
+        
+        totals = {'processed': 0, 'failed': 0, 'skipped': 0}
+        
+        for start in range(0, len(due_ids), chunk_size):
+            chunk_ids = due_ids[start:start + chunk_size]
+            result = _process_subscription_chunk(chunk_ids, now)
+            for key in totals:
+                totals[key] += result[key]
+            if progress:
+                progress(start + len(chunk_ids), len(due_ids))
+        
+        # Summary
+        logger.info("=" * 60)
+        logger.info(f"Subscription Processing Summary (batch mode){label}")
+        logger.info("=" * 60)
+        logger.info(f"Total subscriptions found: {len(due_ids)}")
+        logger.info(f"Successfully processed: {totals['processed']}")
+        logger.info(f"Failed: {totals['failed']}")
+        logger.info(f"Skipped: {totals['skipped']}")
+        logger.info("=" * 60)
+        
+        return {
+            'total': len(due_ids),
+            'processed': totals['processed'],
+            'failed': totals['failed'],
+            'skipped': totals['skipped']
+        }
+
+
+def process_subscriptions_parallel(workers, chunk_size=None):
+    """
+    Run the batch engine in `workers` processes, each owning a disjoint
+    user_id shard of the due subscriptions. Returns the combined statistics.
+    """
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers) as pool:
+        results = pool.map(_run_shard, [(index, workers, chunk_size) for index in range(workers)])
+    
+    combined = {key: sum(result[key] for result in results)
+                for key in ('total', 'processed', 'failed', 'skipped')}
+    
+    logger.info("=" * 60)
+    logger.info(f"Combined Summary ({workers} workers)")
+    logger.info("=" * 60)
+    logger.info(f"Total subscriptions found: {combined['total']}")
+    logger.info(f"Successfully processed: {combined['processed']}")
+    logger.info(f"Failed: {combined['failed']}")
+    logger.info(f"Skipped: {combined['skipped']}")
+    logger.info("=" * 60)
+    
+    return combined
+
+
+def _run_shard(args):
+    """Worker process entry point for process_subscriptions_parallel()"""
+    configure_logging()  # spawned processes don't run the __main__ block
+    shard_index, shard_count, chunk_size = args
+    return process_subscriptions_batch(chunk_size=chunk_size, shard=(shard_index, shard_count))
+
+
+def _parse_shard(value):
+    """--shard INDEX/COUNT as an (index, count) pair; argparse reports bad values as a usage error"""
+    try:
+        shard_index, shard_count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected INDEX/COUNT, e.g. 0/4, not '{value}'")
+    if shard_count <= 0:
+        raise argparse.ArgumentTypeError(f"the shard count must be at least 1, not {shard_count}")
+    if not 0 <= shard_index < shard_count:
+        raise argparse.ArgumentTypeError(f"the shard index must be from 0 to {shard_count - 1}, not {shard_index}")
+    return shard_index, shard_count
+
+
+def _due_filter(now):
+    """Filter criteria for active, approved subscriptions due at `now`"""
+    return (
+        Subscription.is_active == True,
+        Subscription.status == 'approved',
+        Subscription.next_delivery <= now
+    )
+
+
+def _process_subscription_chunk(subscription_ids, now):
+    """
+    Create orders for one chunk of due subscriptions in a single transaction,
+    retrying the chunk if another process changed stock underneath it. If the
+    bulk write fails, the chunk is written again one subscription at a time,
+    so a single bad subscription doesn't fail the others.
+    Returns processed/failed/skipped counts for the chunk.
+    """
+    def write_and_commit():
+        outcome = _write_subscription_chunk(subscription_ids, now)
+        db.session.commit()
+        return outcome
+    
+    def write_singly_and_commit():
+        outcome = _write_subscriptions_singly(subscription_ids, now)
+        db.session.commit()
+        return outcome
+    
+    for attempt in range(1, CHUNK_ATTEMPTS + 1):
+        try:
+            outcome = run_with_retry(write_and_commit)
+            break
+        except InsufficientStock as e:
+            db.session.rollback()
+            if attempt < CHUNK_ATTEMPTS:
+                logger.info(f"Stock for product #{e.product_id} changed concurrently, retrying chunk (attempt {attempt + 1})")
+                continue
+            logger.error(f"Giving up on subscription chunk #{subscription_ids[0]}-#{subscription_ids[-1]}: stock for product #{e.product_id} kept changing")
+            return {'processed': 0, 'failed': len(subscription_ids), 'skipped': 0}
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"Error writing subscription chunk #{subscription_ids[0]}-#{subscription_ids[-1]}, "
+                           f"retrying its subscriptions one at a time: {str(e)}")
+            try:
+                outcome = run_with_retry(write_singly_and_commit)
+                break
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error processing subscription chunk #{subscription_ids[0]}-#{subscription_ids[-1]}: {str(e)}", exc_info=True)
+                return {'processed': 0, 'failed': len(subscription_ids), 'skipped': 0}
+    
+    # Report only once the chunk is committed, so retries don't log twice
+    for level, message in outcome['messages']:
+        logger.log(level, message)
+    for subscription_id, order_id in outcome['orders']:
+        logger.info(f"Successfully processed subscription #{subscription_id} - Order #{order_id} created")
+    
+    unclaimed = len(subscription_ids) - outcome['claimed']
+    if unclaimed:
+        logger.info(f"{unclaimed} subscriptions in chunk were already handled by another worker")
+    
+    return {
+        'processed': len(outcome['orders']),
+        'failed': outcome['failed'],
+        'skipped': outcome['skipped']
+    }
+
+
+def _claim_subscriptions(subscription_ids, now):
+    """
+    Claim the still-due subscriptions of a chunk for the current transaction
+    and return their ids. Rows claimed by another worker are left out.
+    """
+    query = db.session.query(Subscription.id).filter(
+        Subscription.id.in_(subscription_ids), *_due_filter(now)
+    )
+    
+    if db.engine.dialect.name == 'sqlite':
+        # SQLite has no row locks: take the database write lock first, so no other
+        # worker can commit between the due check below and our own commit
+        subscription_table = Subscription.__table__
+        db.session.execute(
+            subscription_table.update()
+            .where(subscription_table.c.id.in_(subscription_ids))
+            .values(next_delivery=subscription_table.c.next_delivery)
+        )
+    else:
+        query = query.with_for_update(skip_locked=True)
+    
+    return [row.id for row in query.order_by(Subscription.id)]
+
+
+def _write_subscription_chunk(subscription_ids, now):
+    """
+    Claim, validate and write orders for one chunk without committing.
+    Returns the claimed count, skip/fail counts, created (subscription, order)
+    ids and the log messages to emit once committed.
+    """
+    outcome = {'claimed': 0, 'failed': 0, 'skipped': 0, 'orders': [], 'messages': []}
+    
+    claimed_ids = _claim_subscriptions(subscription_ids, now)
+    outcome['claimed'] = len(claimed_ids)
+    if claimed_ids:
+        _write_subscription_orders(claimed_ids, outcome)
+    return outcome
+
+
+def _write_subscriptions_singly(subscription_ids, now):
+    """
+    Fallback for a chunk whose bulk write failed: claim the chunk, then write
+    each subscription under its own SAVEPOINT, so an error fails only that
+    subscription. Returns the same outcome as _write_subscription_chunk().
+    """
+    outcome = {'claimed': 0, 'failed': 0, 'skipped': 0, 'orders': [], 'messages': []}
+    
+    claimed_ids = _claim_subscriptions(subscription_ids, now)
+    outcome['claimed'] = len(claimed_ids)
+    for subscription_id in claimed_ids:
+        single = {'failed': 0, 'skipped': 0, 'orders': [], 'messages': []}
+        try:
+            with db.session.begin_nested():
+                _write_subscription_orders([subscription_id], single)
+        except InsufficientStock as e:
+            outcome['messages'].append((logging.WARNING, f"Stock for product #{e.product_id} changed concurrently, skipping subscription #{subscription_id}"))
+            outcome['failed'] += 1
+            continue
+        except Exception as e:
+            if is_contention_error(e):
+                raise  # retry the whole fallback
+            outcome['messages'].append((logging.ERROR, f"Error processing subscription #{subscription_id}: {str(e)}"))
+            outcome['failed'] += 1
+            continue
+        
+        for key in ('failed', 'skipped', 'orders', 'messages'):
+            outcome[key] += single[key]
+    
+    return outcome
+
+
+def _write_subscription_orders(claimed_ids, outcome):
+    """Validate and write orders for claimed subscriptions, adding to `outcome`"""
+    subscriptions = db.session.query(
+        Subscription.id, Subscription.name, Subscription.user_id, Subscription.frequency
+    ).filter(Subscription.id.in_(claimed_ids)).order_by(Subscription.id).all()
+    
+    # Bulk load items, users and products for the whole chunk
+    items_by_subscription = defaultdict(list)
+    for item in db.session.query(
+        SubscriptionItem.subscription_id, SubscriptionItem.product_id, SubscriptionItem.quantity
+    ).filter(SubscriptionItem.subscription_id.in_(claimed_ids)).order_by(SubscriptionItem.id):
+        items_by_subscription[item.subscription_id].append(item)
+    
+    user_ids = {subscription.user_id for subscription in subscriptions}
+    users = {
+        user.id: user for user in db.session.query(
+            User.id, User.is_active, User.address, User.phone
+        ).filter(User.id.in_(user_ids))
+    }
+    
+    product_ids = {item.product_id for items in items_by_subscription.values() for item in items}
+    products = {
+        product.id: {'name': product.name, 'price': product.price,
+                     'stock': product.stock, 'is_active': product.is_active}
+        for product in db.session.query(
+            Product.id, Product.name, Product.price, Product.stock, Product.is_active
+        ).filter(Product.id.in_(product_ids))
+    }
+    
+    order_rows = []
+    order_lines = []  # per order: [(product_id, quantity, price), ...]
+    planned = []  # (subscription, next_delivery) for each order in order_rows
+    
+    for subscription in subscriptions:
+        items = items_by_subscription.get(subscription.id)
+        if not items:
+            outcome['messages'].append((logging.WARNING, f"Subscription #{subscription.id} has no items, skipping"))
+            outcome['skipped'] += 1
+            continue
+        
+        user = users.get(subscription.user_id)
+        if not user or not user.is_active:
+            outcome['messages'].append((logging.WARNING, f"User #{subscription.user_id} is not active, skipping subscription #{subscription.id}"))
+            outcome['skipped'] += 1
+            continue
+        
+        # Validate against stock still unreserved in this chunk
+        stock_issues = []
+        for item in items:
+            product = products.get(item.product_id)
+            
+            if not product or not product['is_active']:
+                stock_issues.append(f"Product ID {item.product_id} not available")
+                continue
+            
+            if product['stock'] < item.quantity:
+                stock_issues.append(f"{product['name']}: need {item.quantity}, only {product['stock']} available")
+        
+        if stock_issues:
+            outcome['messages'].append((logging.WARNING, f"Stock issues for subscription #{subscription.id}: {', '.join(stock_issues)}"))
+            outcome['failed'] += 1
+            continue
+        
+        # Reserve stock in memory for the rest of the chunk
+        lines = []
+        for item in items:
+            product = products[item.product_id]
+            product['stock'] -= item.quantity
+            lines.append((item.product_id, item.quantity, product['price']))
+        
+        order_rows.append({
+            'user_id': subscription.user_id,
+            'total_amount': sum(quantity * price for _, quantity, price in lines),
+            'delivery_address': user.address or "Address not provided",
+            'phone': user.phone or "Phone not provided",
+            'payment_method': 'cod',  # Default to Cash on Delivery for subscriptions
+            'status': 'Pending'
+        })
+        order_lines.append(lines)
+        planned.append((subscription, Subscription.next_delivery_for(subscription.frequency)))
+    
+    if not order_rows:
+        return
+    
+    # One conditional decrement per product. InsufficientStock here means a
+    # concurrent checkout or worker took the stock this chunk was planned with.
+    reserve_stock((product_id, quantity) for lines in order_lines for product_id, quantity, _ in lines)
+    
+    # Bulk insert orders, keeping ids in the same order as order_rows
+    order_ids = db.session.execute(
+        insert(Order).returning(Order.id, sort_by_parameter_order=True),
+        order_rows
+    ).scalars().all()
+    
+    # Bulk inserts skip ORM flush events, so report the new orders to the dashboard counters
+    stats.add_to_counters({'orders': len(order_ids), 'orders.status.Pending': len(order_ids)})
+    orders_per_user = defaultdict(int)
+    for row in order_rows:
+        orders_per_user[row['user_id']] += 1
+    stats.add_to_summaries({user_id: {'order_count': count} for user_id, count in orders_per_user.items()})
+    
+    db.session.execute(insert(OrderItem), [
+        {'order_id': order_id, 'product_id': product_id, 'quantity': quantity, 'price': price}
+        for order_id, lines in zip(order_ids, order_lines)
+        for product_id, quantity, price in lines
+    ])
+    
+    next_deliveries = [
+        {'subscription_id': subscription.id, 'next_delivery': next_delivery}
+        for subscription, next_delivery in planned if next_delivery is not None
+    ]
+    if next_deliveries:
+        subscription_table = Subscription.__table__
+        db.session.execute(
+            subscription_table.update()
+            .where(subscription_table.c.id == bindparam('subscription_id'))
+            .values(next_delivery=bindparam('next_delivery')),
+            next_deliveries
+        )
+    
+    for (subscription, next_delivery), order_id, lines in zip(planned, order_ids, order_lines):
+        outcome['messages'].append((logging.INFO, f"Created order #{order_id} for subscription #{subscription.id}"))
+        for product_id, quantity, _ in lines:
+            outcome['messages'].append((logging.INFO, f"  - Added {quantity}x {products[product_id]['name']} to order #{order_id}"))
+        outcome['messages'].append((logging.INFO, f"Next delivery for subscription #{subscription.id} scheduled for {next_delivery}"))
+    
+    outcome['orders'] += [(subscription.id, order_id) for (subscription, _), order_id in zip(planned, order_ids)]
+
+
 def check_upcoming_subscriptions():
     """
     Check for subscriptions due in the next 24 hours and log warnings
@@ -216,6 +606,20 @@ def get_subscription_statistics():
 
 
 if __name__ == "__main__":
+    configure_logging()
+    
+    parser = argparse.ArgumentParser(description='Process due subscription orders')
+    parser.add_argument('--batch', action='store_true',
+                        help='use the set-based batch engine (recommended for large volumes)')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='subscriptions per commit in batch mode (default: SUBSCRIPTION_BATCH_SIZE)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='run the batch engine in N processes, sharded by user_id')
+    parser.add_argument('--shard', type=_parse_shard, default=None, metavar='INDEX/COUNT',
+                        help='process only one user_id shard in batch mode, e.g. 0/4')
+    args = parser.parse_args()
+    shard = args.shard
+    
     logger.info("=" * 60)
     logger.info("Starting Subscription Order Processing")
     logger.info("=" * 60)
@@ -227,7 +631,12 @@ if __name__ == "__main__":
     check_upcoming_subscriptions()
     
     # Process due subscriptions
-    result = process_subscriptions()
+    if args.workers and args.workers > 1:
+        result = process_subscriptions_parallel(args.workers, chunk_size=args.chunk_size)
+    elif args.batch or args.workers or shard:
+        result = process_subscriptions_batch(chunk_size=args.chunk_size, shard=shard)
+    else:
+        result = process_subscriptions()
     
     logger.info("Subscription processing completed!")
     logger.info("=" * 60)
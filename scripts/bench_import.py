@@ -0,0 +1,129 @@
+"""
+Product import benchmark
+------------------------
+Times product_import.import_file on generated files: an insert of N new
+products into an empty catalog, then an upsert of the same file (every row
+matched by SKU, none changed) and one with every tenth price changed.
+Prints rows per second for each.
+
+Run from the project directory (SQLite files in a temporary directory):
+    python scripts/bench_import.py --rows 10000 100000 1000000
+
+Each row count gets its own database. Pass --xlsx to import Excel files
+instead of CSV (writing them takes a while at a million rows).
+"""
+
+import argparse
+import csv
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = ('apple', 'banana', 'bread', 'butter', 'cheese', 'coffee', 'honey', 'juice', 'lemon', 'mango',
+         'milk', 'noodle', 'onion', 'paneer', 'pasta', 'rice', 'sugar', 'tea', 'tomato', 'yogurt')
+KINDS = ('fresh', 'organic', 'dried', 'frozen', 'roasted', 'premium', 'classic', 'family')
+CATEGORIES = 12
+HEADER = ['sku', 'name', 'description', 'price', 'stock', 'category_id']
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+                        help='rows per file, one run each (default 10000 100000)')
+    parser.add_argument('--chunk-size', type=int, help='rows per chunk (default PRODUCT_IMPORT_CHUNK_SIZE)')
+    parser.add_argument('--xlsx', action='store_true', help='import .xlsx files instead of CSV')
+    return parser.parse_args()
+
+
+def _rows(count, changed_every=None):
+    """Generated rows, the same for a given count; every `changed_every`th price differs"""
+    rng = random.Random(42)
+    for number in range(count):
+        price = rng.randint(10, 1000)
+        if changed_every and number % changed_every == 0:
+            price += 1
+        yield [f'SKU-{number:07d}', f'{rng.choice(KINDS).title()} {rng.choice(WORDS).title()} {number}',
+               ' '.join(rng.choice(WORDS) for _ in range(8)), price, rng.randint(0, 50),
+               rng.randint(1, CATEGORIES)]
+
+
+def _write_file(directory, count, xlsx, changed_every=None):
+    """Path of a generated import file"""
+    suffix = f'-changed{changed_every}' if changed_every else ''
+    if xlsx:
+        import openpyxl
+
+        path = os.path.join(directory, f'products-{count}{suffix}.xlsx')
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(HEADER)
+        for row in _rows(count, changed_every):
+            sheet.append(row)
+        workbook.save(path)
+    else:
+        path = os.path.join(directory, f'products-{count}{suffix}.csv')
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(HEADER)
+            writer.writerows(_rows(count, changed_every))
+    return path
+
+
+def _import(path, mode, chunk_size):
+    """(seconds, ImportResult) of one import of `path`"""
+    import product_import
+
+    with open(path, 'rb') as file:
+        data = io.BytesIO(file.read())
+    started = time.perf_counter()
+    result = product_import.import_file(data, os.path.basename(path), mode=mode, chunk_size=chunk_size)
+    return time.perf_counter() - started, result
+
+
+def _bench(count, args, directory):
+    from flask_migrate import upgrade
+    from app import create_app
+    from config import Config
+    from models import db, Category
+    import product_import
+
+    # A new app per database
+    Config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, f'bench-{count}.db')
+    app = create_app()
+    with app.app_context():
+        upgrade()
+        db.session.execute(db.insert(Category), [{'name': f'Aisle {number}'} for number in range(CATEGORIES)])
+        db.session.commit()
+
+        started = time.perf_counter()
+        path = _write_file(directory, count, args.xlsx)
+        changed_path = _write_file(directory, count, args.xlsx, changed_every=10)
+        print(f'{count} rows: files written in {time.perf_counter() - started:.1f}s')
+
+        for label, file_path, mode in (('insert', path, product_import.MODE_INSERT),
+                                       ('upsert, unchanged', path, product_import.MODE_UPSERT),
+                                       ('upsert, 10% changed', changed_path, product_import.MODE_UPSERT)):
+            seconds, result = _import(file_path, mode, args.chunk_size)
+            print(f'  {label:<22}{seconds:>8.1f}s {count / seconds:>10,.0f} rows/s   created {result.created_count},'
+                  f' updated {result.updated_count}, unchanged {result.unchanged_count}, errors {result.error_count}')
+        db.session.remove()
+        db.engine.dispose()
+
+
+def main():
+    args = _parse_args()
+    # config.py reads this on import
+    os.environ['JOB_WORKERS'] = '0'
+    directory = tempfile.mkdtemp(prefix='bench-import-')
+    for count in args.rows:
+        _bench(count, args, directory)
+
+
+if __name__ == '__main__':
+    main()
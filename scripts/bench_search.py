@@ -0,0 +1,119 @@
+"""
+Shop search benchmark
+---------------------
+Times the queries behind a shop search (search.py, facets.py) on a
+generated catalog: the ranked SEARCH_MATCH_LIMIT matches, the filter counts
+over them and the first page, for broad prefixes down to exact words. The
+last column is the LIKE '%term%' count the shop ran before the index.
+
+Run from the project directory (SQLite file in a temporary directory):
+    python scripts/bench_search.py --products 200000
+
+Pass --database to keep the generated catalog between runs.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = ('apple', 'apricot', 'avocado', 'banana', 'basil', 'bean', 'berry', 'bread', 'butter', 'cabbage',
+         'carrot', 'cheese', 'cherry', 'chili', 'coffee', 'corn', 'cream', 'garlic', 'ginger', 'grape',
+         'honey', 'juice', 'lemon', 'lentil', 'mango', 'milk', 'mint', 'noodle', 'oat', 'onion',
+         'orange', 'paneer', 'pasta', 'peach', 'pepper', 'potato', 'rice', 'salt', 'spinach', 'sugar',
+         'tea', 'tomato', 'wheat', 'yogurt')
+KINDS = ('fresh', 'organic', 'dried', 'frozen', 'roasted', 'premium', 'classic', 'family')
+
+# From one letter (most of the catalog) down to two exact words
+TERMS = ('a', 'ap', 'app', 'apple', 'organic apple', 'tomato', 'paneer fresh', 'zzz')
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('--products', type=int, default=200000, help='products to generate (default 200000)')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per search term (default 20)')
+    parser.add_argument('--database', help='SQLite file to use and keep (default: a temporary one)')
+    return parser.parse_args()
+
+
+def _seed(db, products):
+    from models import Category, Product
+    import search
+
+    rng = random.Random(42)
+    categories = [{'name': f'{word.title()} Aisle'} for word in WORDS[:12]]
+    db.session.execute(db.insert(Category), categories)
+    category_ids = db.session.execute(db.select(Category.id)).scalars().all()
+
+    batch = []
+    for number in range(products):
+        name = f'{rng.choice(KINDS).title()} {rng.choice(WORDS).title()} {number}'
+        description = ' '.join(rng.choice(WORDS) for _ in range(8))
+        batch.append({'name': name, 'description': description, 'price': rng.randint(10, 1000),
+                      'stock': rng.randint(0, 50), 'category_id': rng.choice(category_ids), 'is_active': True})
+        if len(batch) == 10000:
+            db.session.execute(db.insert(Product), batch)
+            batch = []
+    if batch:
+        db.session.execute(db.insert(Product), batch)
+    db.session.commit()
+    search.ensure_index()
+
+
+def _time(function, repeat):
+    """(median, slowest) milliseconds of `repeat` calls"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+def main():
+    args = _parse_args()
+    path = args.database or os.path.join(tempfile.mkdtemp(prefix='bench-search-'), 'bench.db')
+    # config.py reads these on import
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(path)
+    os.environ['JOB_WORKERS'] = '0'
+
+    from flask_migrate import upgrade
+    from app import create_app
+    from models import db, Product
+    import facets
+    import search
+
+    app = create_app()
+    with app.app_context():
+        upgrade()
+        if not db.session.query(Product.id).first():
+            started = time.perf_counter()
+            _seed(db, args.products)
+            print(f'Generated {args.products} products in {time.perf_counter() - started:.1f}s ({path})')
+        products = db.session.query(db.func.count(Product.id)).scalar()
+        limit = app.config['SEARCH_MATCH_LIMIT']
+        facets.count([], None, None, False)  # builds the facet index once
+
+        print(f'{products} products, SEARCH_MATCH_LIMIT {limit}, median / slowest of {args.repeat} runs (ms)')
+        print(f'{"term":<16}{"matches":>9}{"ranked ids":>18}{"filter counts":>18}{"first page":>18}'
+              f'{"LIKE":>18}')
+        for term in TERMS:
+            matches = search.matching_ids(term, limit)
+            ranked = _time(lambda: search.matching_ids(term, limit), args.repeat)
+            counted = _time(lambda: facets.count(matches, None, None, False), args.repeat)
+            paged = _time(lambda: search.page_ids(matches, in_stock=True), args.repeat)
+            like = _time(lambda: db.session.query(db.func.count(Product.id))
+                         .filter(Product.is_active == True, Product.name.contains(term)).scalar(), args.repeat)
+            columns = ''.join(f'{median:>10.1f} / {slowest:<5.1f}'
+                              for median, slowest in (ranked, counted, paged, like))
+            print(f'{term:<16}{len(matches):>9}{columns}')
+
+
+if __name__ == '__main__':
+    main()
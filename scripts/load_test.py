@@ -0,0 +1,230 @@
+"""
+Database load test
+------------------
+Runs shoppers against the app in threads, as one threaded gunicorn worker
+would serve them, and reports what the engine profile and replica routing
+in database.py did under that load: requests per second and latency for
+each kind of request, the statements each bind received, the most
+connections checked out of each pool at once, and failed requests (a pool
+timeout or a lock wait past its limit is a 500).
+
+    browse       anonymous shop and product pages (@read_only: a replica)
+    add to cart  signed-in POSTs (the primary)
+    after write  the buyer's next shop page (pinned to the primary)
+
+Point it at the databases to test:
+    DATABASE_URL=postgresql://... DATABASE_REPLICA_URLS=postgresql://... \\
+        python scripts/load_test.py --threads 16 --seconds 60
+
+Without DATABASE_URL it uses a temporary SQLite primary and a copy of it as
+the replica. The schema is migrated and a catalog and buyers are added when
+missing; a real replica must already be replicating the primary. Exits with
+1 if a request failed or a statement went to the wrong bind.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PRIMARY = 'primary'
+PASSWORD = 'load-test'
+
+# Kind of request -> where its statements must go when there are replicas
+EXPECTED_BIND = {'browse': 'replica', 'add to cart': PRIMARY, 'after write': PRIMARY}
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('--threads', type=int, default=16, help='concurrent shoppers (default 16)')
+    parser.add_argument('--buyers', type=float, default=0.25,
+                        help='share of the shoppers who sign in and add to cart (default 0.25)')
+    parser.add_argument('--seconds', type=float, default=30, help='how long to run (default 30)')
+    parser.add_argument('--products', type=int, default=2000, help='products to add to an empty catalog (default 2000)')
+    return parser.parse_args()
+
+
+class Recorder:
+    """Latencies, statuses, statements per bind and pool use, shared by the shopper threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.latencies = defaultdict(list)
+        self.failures = Counter()
+        self.statements = Counter()  # (kind, bind) -> statements
+        self.checked_out = Counter()
+        self.peak = Counter()
+
+    def request(self, kind, send, *args, **kwargs):
+        self.local.kind = kind
+        started = time.perf_counter()
+        try:
+            response = send(*args, **kwargs)
+            failed = response.status_code >= 500
+        except Exception:
+            failed = True
+        finally:
+            self.local.kind = None
+        with self.lock:
+            self.latencies[kind].append((time.perf_counter() - started) * 1000)
+            if failed:
+                self.failures[kind] += 1
+
+    def watch(self, key, engine):
+        from sqlalchemy import event
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            kind = getattr(self.local, 'kind', None)
+            if kind:
+                with self.lock:
+                    self.statements[kind, key] += 1
+
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            with self.lock:
+                self.checked_out[key] += 1
+                self.peak[key] = max(self.peak[key], self.checked_out[key])
+
+        def checkin(dbapi_connection, connection_record):
+            with self.lock:
+                self.checked_out[key] -= 1
+
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'checkout', checkout)
+        event.listen(engine, 'checkin', checkin)
+
+
+def _sqlite_databases():
+    """Temporary primary and replica files, set up as config.py reads them"""
+    directory = tempfile.mkdtemp(prefix='load-test-')
+    primary, replica = os.path.join(directory, 'primary.db'), os.path.join(directory, 'replica.db')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + primary
+    os.environ['DATABASE_REPLICA_URLS'] = 'sqlite:///' + replica
+    return primary, replica
+
+
+def _seed(db, products, buyers):
+    """Add a catalog when there is none, and the buyers' accounts; product ids of the catalog"""
+    from models import Category, Product, User
+
+    if not db.session.query(Product.id).first():
+        rng = random.Random(42)
+        db.session.execute(db.insert(Category), [{'name': f'Aisle {number}'} for number in range(12)])
+        category_ids = db.session.execute(db.select(Category.id)).scalars().all()
+        db.session.execute(db.insert(Product), [
+            {'name': f'Product {number}', 'description': f'Load test product {number}', 'price': rng.randint(10, 500),
+             'stock': 10 ** 6, 'category_id': rng.choice(category_ids), 'is_active': True}
+            for number in range(products)
+        ])
+
+    for number in range(buyers):
+        username = f'load-test-{number}'
+        if not User.query.filter_by(username=username).first():
+            user = User(username=username, email=f'{username}@example.com', phone='1234567890', address='Street')
+            user.set_password(PASSWORD)
+            db.session.add(user)
+    db.session.commit()
+    return db.session.execute(db.select(Product.id).where(Product.is_active == True)).scalars().all()
+
+
+def _browser(app, recorder, deadline, product_ids, seed):
+    rng = random.Random(seed)
+    client = app.test_client()
+    while time.perf_counter() < deadline:
+        if rng.random() < 0.5:
+            recorder.request('browse', client.get, f'/customer/shop?page={rng.randint(1, 20)}')
+        else:
+            recorder.request('browse', client.get, f'/customer/product/{rng.choice(product_ids)}')
+
+
+def _buyer(app, recorder, deadline, product_ids, number):
+    rng = random.Random(number)
+    client = app.test_client()
+    response = client.post('/auth/login', data={'username': f'load-test-{number}', 'password': PASSWORD})
+    if response.status_code != 302:
+        recorder.failures['sign in'] += 1
+        return
+    while time.perf_counter() < deadline:
+        recorder.request('add to cart', client.post, f'/customer/add_to_cart/{rng.choice(product_ids)}',
+                         data={'quantity': 1})
+        recorder.request('after write', client.get, '/customer/shop')
+
+
+def _report(recorder, seconds, replicas):
+    """Print the results; True if nothing failed or went to the wrong bind"""
+    total = sum(len(latencies) for latencies in recorder.latencies.values())
+    print(f'{total} requests in {seconds:.1f}s, {total / seconds:.0f} requests/s')
+    print(f'{"request":<14}{"count":>8}{"p50 ms":>9}{"p95 ms":>9}{"max ms":>9}{"failed":>8}  statements per bind')
+    ok = not recorder.failures
+    for kind, latencies in sorted(recorder.latencies.items()):
+        latencies.sort()
+        binds = {key: count for (statement_kind, key), count in recorder.statements.items() if statement_kind == kind}
+        print(f'{kind:<14}{len(latencies):>8}{statistics.median(latencies):>9.1f}'
+              f'{latencies[int(len(latencies) * 0.95)]:>9.1f}{latencies[-1]:>9.1f}{recorder.failures[kind]:>8}  '
+              + ', '.join(f'{key} {count}' for key, count in sorted(binds.items())))
+        if replicas:
+            expected = EXPECTED_BIND[kind]
+            wrong = sum(count for key, count in binds.items() if (key == PRIMARY) != (expected == PRIMARY))
+            if wrong:
+                print(f'  {wrong} statements expected on the {expected} went elsewhere')
+                ok = False
+    if recorder.failures['sign in']:
+        print(f'{recorder.failures["sign in"]} buyers could not sign in')
+    print('Most connections checked out at once: '
+          + ', '.join(f'{key} {recorder.peak[key]}' for key in sorted(recorder.peak)))
+    return ok
+
+
+def main():
+    args = _parse_args()
+    # config.py reads these on import
+    os.environ['JOB_WORKERS'] = '0'
+    sqlite_files = None if os.environ.get('DATABASE_URL') else _sqlite_databases()
+
+    from flask_migrate import upgrade
+    from app import create_app
+    from models import db
+
+    app = create_app()
+    app.config.update(WTF_CSRF_ENABLED=False)
+    buyers = max(1, round(args.threads * args.buyers))
+    with app.app_context():
+        upgrade()
+        product_ids = _seed(db, args.products, buyers)
+        db.session.remove()
+        if sqlite_files:
+            # The replica starts as a copy of the seeded primary
+            db.engines[None].dispose()
+            shutil.copy(*sqlite_files)
+        replicas = app.extensions['database_replicas']
+        recorder = Recorder()
+        for key, engine in db.engines.items():
+            recorder.watch(key or PRIMARY, engine)
+            print(f'{key or PRIMARY}: {engine.url.render_as_string(hide_password=True)}, {engine.pool.status()}')
+
+    deadline = time.perf_counter() + args.seconds
+    threads = [threading.Thread(target=_buyer, args=(app, recorder, deadline, product_ids, number))
+               for number in range(buyers)]
+    threads += [threading.Thread(target=_browser, args=(app, recorder, deadline, product_ids, number))
+                for number in range(args.threads - buyers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if not _report(recorder, time.perf_counter() - started, replicas):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
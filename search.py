@@ -0,0 +1,283 @@
+"""
+Product Search
+--------------
+Full-text product search over name, description and category name.
+
+SQLite uses an FTS5 virtual table (product_fts, rowid = product id) with
+prefix indexes and bm25 ranking. PostgreSQL uses a product_search side table
+holding a weighted tsvector per product, with a GIN index and ts_rank.
+The index is kept in sync by mapper events on Product and Category; Core
+bulk writes must call index_products() themselves.
+
+A search keeps its SEARCH_MATCH_LIMIT best matches, ranked by the index
+(bm25 on SQLite, ts_rank on PostgreSQL) with name matches first. Those ids
+are counted for the shop filters, which say so when a broad search reached
+the limit, and each page is filtered from them in one query. Until the index exists (or
+on other databases) search falls back to the old LIKE match on the
+product name. Create or rebuild it with:
+    flask --app app reindex-search
+"""
+
+import re
+import time
+
+from sqlalchemy import event, inspect as sa_inspect, text
+
+from models import db, Product, Category
+
+
+# Index presence per engine URL, so events and searches don't inspect every time.
+# A missing index is re-checked after NEGATIVE_CACHE_SECONDS.
+_index_ready = {}
+NEGATIVE_CACHE_SECONDS = 60
+
+# bm25 column weights for name, description, category
+SQLITE_WEIGHTS = (10.0, 1.0, 5.0)
+
+
+def _dialect(bind):
+    return bind.dialect.name
+
+
+def is_supported(bind):
+    """Check whether full-text search is available for this database"""
+    return _dialect(bind) in ('sqlite', 'postgresql')
+
+
+def index_exists(bind):
+    """Check whether the search index has been created (engine or connection)"""
+    key = str(bind.engine.url)
+    cached = _index_ready.get(key)
+    if cached is True or (cached is not None and time.monotonic() - cached < NEGATIVE_CACHE_SECONDS):
+        return cached is True
+
+    table = 'product_fts' if _dialect(bind) == 'sqlite' else 'product_search'
+    ready = is_supported(bind) and sa_inspect(bind).has_table(table)
+    _index_ready[key] = True if ready else time.monotonic()
+    return ready
+
+
+# ========== INDEX MAINTENANCE ==========
+
+def ensure_index():
+    """Create the search index if it doesn't exist yet and fill it. Returns False if unsupported."""
+    engine = db.engine
+    if not is_supported(engine):
+        return False
+
+    with engine.begin() as connection:
+        if index_exists(connection):
+            return True
+
+        if _dialect(connection) == 'sqlite':
+            connection.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5("
+                "name, description, category, "
+                "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+            ))
+        else:
+            connection.execute(text(
+                "CREATE TABLE IF NOT EXISTS product_search ("
+                "product_id INTEGER PRIMARY KEY REFERENCES product(id) ON DELETE CASCADE, "
+                "document TSVECTOR NOT NULL)"
+            ))
+            connection.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_product_search_document "
+                "ON product_search USING GIN (document)"
+            ))
+        _index_ready[str(engine.url)] = True
+
+    reindex_all()
+    return True
+
+
+def reindex_all():
+    """Rebuild the whole search index from the product table"""
+    with db.engine.begin() as connection:
+        if not index_exists(connection):
+            return
+        if _dialect(connection) == 'sqlite':
+            connection.execute(text("DELETE FROM product_fts"))
+        else:
+            connection.execute(text("DELETE FROM product_search"))
+        _insert_documents(connection, None)
+
+
+def index_products(connection, product_ids):
+    """(Re)index the given products on `connection` (e.g. after Core bulk inserts)"""
+    product_ids = list(product_ids)
+    if not product_ids or not index_exists(connection):
+        return
+    remove_products(connection, product_ids)
+    _insert_documents(connection, product_ids)
+
+
+def remove_products(connection, product_ids):
+    """Drop the given products from the search index"""
+    product_ids = list(product_ids)
+    if not product_ids or not index_exists(connection):
+        return
+    if _dialect(connection) == 'sqlite':
+        statement = text("DELETE FROM product_fts WHERE rowid IN :ids")
+    else:
+        statement = text("DELETE FROM product_search WHERE product_id IN :ids")
+    connection.execute(statement.bindparams(db.bindparam('ids', expanding=True)), {'ids': product_ids})
+
+
+def _insert_documents(connection, product_ids):
+    """Insert index rows for `product_ids` (all products when None)"""
+    where = "WHERE p.id IN :ids" if product_ids is not None else ""
+    if _dialect(connection) == 'sqlite':
+        statement = text(
+            "INSERT INTO product_fts (rowid, name, description, category) "
+            "SELECT p.id, p.name, coalesce(p.description, ''), coalesce(c.name, '') "
+            "FROM product p LEFT JOIN category c ON c.id = p.category_id " + where
+        )
+    else:
+        statement = text(
+            "INSERT INTO product_search (product_id, document) "
+            "SELECT p.id, "
+            "setweight(to_tsvector('simple', coalesce(p.name, '')), 'A') || "
+            "setweight(to_tsvector('simple', coalesce(c.name, '')), 'B') || "
+            "setweight(to_tsvector('simple', coalesce(p.description, '')), 'C') "
+            "FROM product p LEFT JOIN category c ON c.id = p.category_id " + where
+        )
+    if product_ids is not None:
+        connection.execute(statement.bindparams(db.bindparam('ids', expanding=True)), {'ids': product_ids})
+    else:
+        connection.execute(statement)
+
+
+# ========== MODEL EVENTS ==========
+
+@event.listens_for(Product, 'after_insert')
+def _product_inserted(mapper, connection, target):
+    index_products(connection, [target.id])
+
+
+@event.listens_for(Product, 'after_update')
+def _product_updated(mapper, connection, target):
+    state = sa_inspect(target)
+    if any(state.attrs[attr].history.has_changes() for attr in ('name', 'description', 'category_id')):
+        index_products(connection, [target.id])
+
+
+@event.listens_for(Product, 'after_delete')
+def _product_deleted(mapper, connection, target):
+    remove_products(connection, [target.id])
+
+
+@event.listens_for(Category, 'after_update')
+def _category_updated(mapper, connection, target):
+    if sa_inspect(target).attrs.name.history.has_changes():
+        product_ids = connection.execute(
+            db.select(Product.id).where(Product.category_id == target.id)
+        ).scalars().all()
+        index_products(connection, product_ids)
+
+
+# ========== QUERYING ==========
+
+def _match_expression(term, dialect, name_only=False):
+    """
+    Turn user input into a prefix-matching full-text query (all words must
+    match), in the product name only if `name_only`
+    """
+    words = re.findall(r'\w+', term.lower())
+    if not words:
+        return None
+    if dialect == 'sqlite':
+        match = ' '.join(f'"{word}"*' for word in words)
+        return f'name : ({match})' if name_only else match
+    # The name is weight A of the document (see _insert_documents)
+    weight = 'A' if name_only else ''
+    return ' & '.join(f'{word}:*{weight}' for word in words)
+
+
+def _other_matches(match, name_match, dialect):
+    """Full-text query for the products matching `match` but not `name_match`"""
+    if dialect == 'sqlite':
+        return f'({match}) NOT {name_match}'
+    return f'({match}) & !({name_match})'
+
+
+def _ranked(dialect, match, limit):
+    """Ids of the `limit` best products for the full-text query `match`, best first"""
+    if dialect == 'sqlite':
+        weights = ', '.join(str(weight) for weight in SQLITE_WEIGHTS)
+        statement = text(
+            "SELECT rowid FROM product_fts "
+            f"WHERE product_fts MATCH :match AND rank MATCH 'bm25({weights})' "
+            "ORDER BY rank LIMIT :limit"
+        )
+    else:
+        statement = text(
+            "SELECT product_id FROM product_search WHERE document @@ to_tsquery('simple', :match) "
+            "ORDER BY ts_rank(document, to_tsquery('simple', :match)) DESC LIMIT :limit"
+        )
+    return db.session.execute(statement, {'match': match, 'limit': limit}).scalars().all()
+
+
+def matching_ids(term, limit):
+    """
+    Ids of the `limit` best matches of `term` (active or not), best first.
+    Products with every word in their name come first, then the others, each
+    group ranked by the index. Ranking costs a few microseconds per match,
+    and a broad prefix fills `limit` from the (much fewer) name matches
+    alone. Without the index, a LIKE on the name in id order.
+    """
+    bind = db.session.get_bind(mapper=Product)
+    dialect = _dialect(bind)
+    match = _match_expression(term, dialect)
+
+    if match is None or not index_exists(bind):
+        return db.session.execute(
+            db.select(Product.id).where(Product.name.contains(term)).order_by(Product.id).limit(limit)
+        ).scalars().all()
+
+    name_match = _match_expression(term, dialect, name_only=True)
+    ids = _ranked(dialect, name_match, limit)
+    if len(ids) < limit:
+        ids += _ranked(dialect, _other_matches(match, name_match, dialect), limit - len(ids))
+    return ids
+
+
+def page_ids(ranked_ids, category_id=None, price_range=None, in_stock=False, page=1, per_page=12):
+    """
+    Ids of one page of the active products among `ranked_ids` (from
+    matching_ids), in their order. Filters: `category_id`, `price_range` as
+    (low, high) with high None for no upper bound, and stock above zero.
+    """
+    if not ranked_ids:
+        return []
+    low, high = price_range if price_range is not None else (None, None)
+
+    # Read by primary key and filtered here: with the filters in the query, SQLite
+    # prefers ix_product_active_category and walks every active product
+    rows = db.session.execute(
+        db.select(Product.id, Product.is_active, Product.category_id, Product.price, Product.stock)
+        .where(Product.id.in_(ranked_ids))
+    )
+    kept = {
+        row.id for row in rows
+        if row.is_active
+        and (not category_id or row.category_id == category_id)
+        and (not low or row.price >= low)
+        and (high is None or row.price < high)
+        and (not in_stock or row.stock > 0)
+    }
+
+    start = (page - 1) * per_page
+    return [product_id for product_id in ranked_ids if product_id in kept][start:start + per_page]
+
+
+def init_app(app):
+    """Register the reindex-search CLI command"""
+    @app.cli.command('reindex-search')
+    def reindex_search_command():
+        """Create the product search index if needed and rebuild it."""
+        if ensure_index():
+            reindex_all()
+            print("Product search index rebuilt")
+        else:
+            print("Full-text search is not supported on this database; using LIKE search")
@@ -63,18 +63,73 @@ document.addEventListener('DOMContentLoaded', function() {
 
     images.forEach(img => imageObserver.observe(img));
 
-    // Search functionality
-    const searchInput = document.querySelector('input[name="search"]');
+    // Search suggestions: show matching products under the search box while
+    // typing (JSON from /customer/api/suggest); Enter still runs the full search
+    const searchInput = document.querySelector('input[name="search"][data-suggest-url]');
     if (searchInput) {
+        const suggestions = searchInput.form.querySelector('.search-suggestions');
         let searchTimeout;
+        let latestQuery = '';
+
+        const hideSuggestions = () => suggestions.classList.add('d-none');
+
+        const renderSuggestions = (results) => {
+            suggestions.replaceChildren();
+            results.forEach(product => {
+                const link = document.createElement('a');
+                link.className = 'list-group-item list-group-item-action d-flex align-items-center';
+                link.href = searchInput.dataset.productUrl.replace(/0$/, product.id);
+
+                if (product.thumb) {
+                    const thumb = document.createElement('img');
+                    thumb.src = product.thumb;
+                    thumb.alt = '';
+                    thumb.className = 'rounded me-2';
+                    link.appendChild(thumb);
+                }
+                const name = document.createElement('span');
+                name.className = 'flex-grow-1';
+                name.textContent = product.name;
+                const price = document.createElement('span');
+                price.className = 'text-success fw-bold ms-2';
+                price.textContent = '₹' + product.price.toFixed(2);
+                link.append(name, price);
+                suggestions.appendChild(link);
+            });
+            suggestions.classList.toggle('d-none', results.length === 0);
+        };
+
         searchInput.addEventListener('input', function() {
             clearTimeout(searchTimeout);
+            const query = this.value.trim();
+            if (query.length < 2) {
+                latestQuery = '';
+                hideSuggestions();
+                return;
+            }
             searchTimeout = setTimeout(() => {
-                // Auto-submit search form after 1 second of no typing
-                if (this.value.length > 2 || this.value.length === 0) {
-                    this.closest('form').submit();
-                }
-            }, 1000);
+                latestQuery = query;
+                fetch(this.dataset.suggestUrl + '?q=' + encodeURIComponent(query))
+                    .then(response => response.json())
+                    .then(data => {
+                        // Ignore answers to queries the user has already typed past
+                        if (data.query === latestQuery) {
+                            renderSuggestions(data.results);
+                        }
+                    })
+                    .catch(hideSuggestions);
+            }, 150);
+        });
+
+        searchInput.addEventListener('keydown', function(e) {
+            if (e.key === 'Escape') {
+                hideSuggestions();
+            }
+        });
+        document.addEventListener('click', function(e) {
+            if (!searchInput.form.contains(e.target)) {
+                hideSuggestions();
+            }
         });
     }
 
@@ -0,0 +1,396 @@
+"""
+Dashboard Statistics
+--------------------
+Materialized counters for the admin dashboard, stored in the stat_counter table.
+
+Counters are adjusted incrementally from SQLAlchemy session flushes on User,
+Category, Product, Order and Subscription, inside the same transaction as
+the change itself, so the dashboard reads them with a single query instead
+of counting and summing whole tables on every hit.
+
+A change only appends its deltas to the stat_delta log: concurrent
+checkouts never wait on each other's counter rows. Reads add up the
+counter rows and the pending deltas in that one query. After about one in
+STAT_FOLD_EVERY commits that appended deltas, the log is folded into
+stat_counter in a transaction of its own, once the commit is done.
+
+Orders also update a per-customer summary row (user_order_summary: order
+count, delivered orders, total spent) the same way, so the profile page
+reads one row instead of aggregating the customer's whole order history.
+
+Bulk writes that bypass the ORM (e.g. the batch scheduler) must report their
+changes with add_to_counters() and add_to_summaries(). Counters are built
+by init_db.py, never by a read; to build them for an existing database, or
+if they ever drift, rebuild them (summaries included):
+    flask --app app rebuild-stats
+"""
+
+import logging
+import random
+import time
+from collections import defaultdict
+
+from sqlalchemy import event, inspect, case, or_
+from sqlalchemy.orm import Session
+
+from models import db, User, Category, Product, Order, Subscription, StatCounter, StatDelta, UserOrderSummary
+
+
+logger = logging.getLogger(__name__)
+
+# Statuses that always get a counter row, so increments never need an insert
+ORDER_STATUSES = ('Pending', 'Processing', 'Shipped', 'Delivered', 'Cancelled')
+SUBSCRIPTION_STATUSES = ('pending', 'approved', 'rejected')
+
+# Counter key prefixes owned by this module (rebuild replaces only these)
+COUNTER_PREFIXES = ('users', 'categories', 'products', 'orders', 'revenue', 'subscriptions')
+
+# Present once counters have been built; before that, deltas are left to the rebuild
+REBUILT_MARKER = 'stats.rebuilt_at'
+
+# Same for customer summaries, which databases from before them lack even when counters are built
+SUMMARIES_MARKER = 'stats.summaries_rebuilt_at'
+
+# Pending deltas are folded into the counters after about one in STAT_FOLD_EVERY commits that added some
+STAT_FOLD_EVERY = 100
+
+
+class Counters(dict):
+    """Counter values by key, with typed accessors that default to zero"""
+
+    def count(self, key):
+        return int(self.get(key, 0))
+
+    def amount(self, key):
+        return float(self.get(key, 0.0))
+
+
+# ========== CONTRIBUTIONS PER MODEL ==========
+# Each function maps an object's attribute values to the counters it adds to.
+
+def _user_counters(get):
+    return {'users': 1, 'users.active': 1 if get('is_active') else 0}
+
+
+def _category_counters(get):
+    return {'categories': 1, 'categories.active': 1 if get('is_active') else 0}
+
+
+def _product_counters(get):
+    return {'products': 1, 'products.active': 1 if get('is_active') else 0}
+
+
+def _order_counters(get):
+    status = get('status')
+    counters = {'orders': 1, f'orders.status.{status}': 1}
+    if status == 'Delivered':
+        counters['revenue.delivered'] = get('total_amount') or 0.0
+    return counters
+
+
+def _subscription_counters(get):
+    status = get('status')
+    counters = {'subscriptions': 1, f'subscriptions.status.{status}': 1}
+    if status == 'approved' and get('is_active'):
+        counters['subscriptions.active'] = 1
+    return counters
+
+
+def _order_summary(get):
+    """(user_id, summary column deltas) an order contributes to its customer's summary"""
+    delivered = get('status') == 'Delivered'
+    return get('user_id'), {
+        'order_count': 1,
+        'delivered_count': 1 if delivered else 0,
+        'total_spent': (get('total_amount') or 0.0) if delivered else 0.0,
+    }
+
+
+TRACKED = {
+    User: (_user_counters, ('is_active',)),
+    Category: (_category_counters, ('is_active',)),
+    Product: (_product_counters, ('is_active',)),
+    Order: (_order_counters, ('status', 'total_amount')),
+    Subscription: (_subscription_counters, ('status', 'is_active')),
+}
+
+
+def _tracked(obj):
+    return TRACKED.get(type(obj))
+
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    pass
+
+
+# Objects are expired after every commit. active_history makes SQLAlchemy load
+# the value being replaced when a tracked attribute is set, so flush history
+# knows what to subtract.
+for _model, (_, _attrs) in TRACKED.items():
+    for _attr in _attrs:
+        event.listen(getattr(_model, _attr), 'set', _keep_old_value, active_history=True)
+
+
+def _current(obj):
+    return lambda attr: getattr(obj, attr)
+
+
+def _previous(obj):
+    """Attribute getter returning values as they were before the pending change"""
+    state = inspect(obj)
+
+    def get(attr):
+        history = state.attrs[attr].history
+        if history.deleted:
+            return history.deleted[0]
+        return getattr(obj, attr)
+    return get
+
+
+def _accumulate(deltas, counters, sign):
+    for key, amount in counters.items():
+        if amount:
+            deltas[key] += sign * amount
+
+
+def _accumulate_summary(summary_deltas, obj, get, sign):
+    if isinstance(obj, Order):
+        user_id, columns = _order_summary(get)
+        _accumulate(summary_deltas[user_id], columns, sign)
+
+
+# ========== SESSION EVENTS ==========
+
+@event.listens_for(Session, 'before_flush')
+def _capture_deletes(session, flush_context, instances):
+    # Deleted rows are still loadable here, but not after the flush.
+    # Always start fresh so a failed earlier flush can't leak its deltas.
+    deltas = session.info['stat_deltas'] = defaultdict(float)
+    summary_deltas = session.info['summary_deltas'] = defaultdict(lambda: defaultdict(float))
+    # Subtract what the row holds, not edits made to it before deleting
+    for obj in session.deleted:
+        tracked = _tracked(obj)
+        if tracked:
+            _accumulate(deltas, tracked[0](_previous(obj)), -1)
+            _accumulate_summary(summary_deltas, obj, _previous(obj), -1)
+
+
+@event.listens_for(Session, 'after_flush')
+def _apply_flush(session, flush_context):
+    deltas = session.info.pop('stat_deltas', None) or defaultdict(float)
+    summary_deltas = session.info.pop('summary_deltas', None) or defaultdict(lambda: defaultdict(float))
+
+    for obj in session.new:
+        tracked = _tracked(obj)
+        if tracked:
+            _accumulate(deltas, tracked[0](_current(obj)), 1)
+            _accumulate_summary(summary_deltas, obj, _current(obj), 1)
+
+    for obj in session.dirty:
+        tracked = _tracked(obj)
+        if not tracked:
+            continue
+        state = inspect(obj)
+        if not any(state.attrs[attr].history.has_changes() for attr in tracked[1]):
+            continue
+        _accumulate(deltas, tracked[0](_previous(obj)), -1)
+        _accumulate(deltas, tracked[0](_current(obj)), 1)
+        _accumulate_summary(summary_deltas, obj, _previous(obj), -1)
+        _accumulate_summary(summary_deltas, obj, _current(obj), 1)
+
+    _apply(session, deltas)
+    _apply_summaries(session.connection(), summary_deltas)
+
+
+@event.listens_for(Session, 'after_commit')
+def _fold_after_commit(session):
+    if not session.info.pop('stat_deltas_added', False) or random.randrange(STAT_FOLD_EVERY):
+        return
+    # The session can't run statements here; the fold gets a transaction of its own on the primary
+    try:
+        with db.engine.begin() as connection:
+            fold(connection)
+    except Exception:
+        # Left in the log, where reads still count them, for the next fold
+        logger.exception("Could not fold stat deltas into the counters")
+
+
+def _apply(session, deltas):
+    """Append nonzero deltas to the stat_delta log (inserts only, no counter row is locked)"""
+    rows = [{'key': key, 'value': amount} for key, amount in deltas.items() if amount]
+    if rows:
+        session.connection().execute(StatDelta.__table__.insert(), rows)
+        session.info['stat_deltas_added'] = True
+
+
+def fold(connection):
+    """
+    Move the pending deltas into their counter rows with atomic relative
+    updates. Returns the number of deltas folded (none until counters are built).
+    """
+    if not _is_built(connection, REBUILT_MARKER):
+        return 0
+
+    # Deleted and read back in one statement, so a delta committed meanwhile is folded now or next time
+    log = StatDelta.__table__
+    totals = defaultdict(float)
+    rows = connection.execute(log.delete().returning(log.c.key, log.c.value)).all()
+    for key, amount in rows:
+        totals[key] += amount
+
+    table = StatCounter.__table__
+    missing = []
+    for key, amount in totals.items():
+        if not amount:
+            continue
+        updated = connection.execute(
+            table.update().where(table.c.key == key).values(value=table.c.value + amount)
+        )
+        if updated.rowcount == 0:
+            missing.append({'key': key, 'value': amount})
+
+    # A key without a row (e.g. a new status) starts from zero
+    if missing:
+        connection.execute(table.insert(), missing)
+    return len(rows)
+
+
+def _is_built(connection, marker):
+    table = StatCounter.__table__
+    return connection.execute(
+        db.select(table.c.key).where(table.c.key == marker)
+    ).first() is not None
+
+
+def _apply_summaries(connection, deltas):
+    """Add per-customer deltas ({user_id: {column: amount}}) to their summary rows"""
+    table = UserOrderSummary.__table__
+    missing = []
+    for user_id, columns in deltas.items():
+        columns = {column: amount for column, amount in columns.items() if amount}
+        if not columns:
+            continue
+        updated = connection.execute(
+            table.update().where(table.c.user_id == user_id)
+            .values({column: table.c[column] + amount for column, amount in columns.items()})
+        )
+        if updated.rowcount == 0:
+            missing.append({'user_id': user_id, 'order_count': 0, 'delivered_count': 0, 'total_spent': 0.0, **columns})
+
+    # A customer's first order creates their row, once summaries have been built
+    if missing and _is_built(connection, SUMMARIES_MARKER):
+        connection.execute(table.insert(), missing)
+
+
+def add_to_counters(deltas):
+    """Record counter changes for writes that bypass ORM flush events (bulk inserts/updates)"""
+    _apply(db.session, deltas)
+
+
+def add_to_summaries(deltas):
+    """Record per-customer summary changes ({user_id: {column: amount}}) for bulk order writes"""
+    _apply_summaries(db.session.connection(), deltas)
+
+
+# ========== READ & REBUILD ==========
+
+def get_counters():
+    """
+    Load all counters in one query, with the deltas not folded into them yet.
+    Read only: until counters are built (init_db.py, rebuild-stats) they are missing.
+    """
+    values = db.union_all(
+        db.select(StatCounter.key, StatCounter.value),
+        db.select(StatDelta.key, StatDelta.value),
+    ).subquery()
+    return Counters(db.session.execute(
+        db.select(values.c.key, db.func.sum(values.c.value)).group_by(values.c.key)
+    ).all())
+
+
+def compute_counters():
+    """Compute every counter from scratch with one grouped query per table"""
+    counters = Counters()
+
+    for model, prefix in ((User, 'users'), (Category, 'categories'), (Product, 'products')):
+        total, active = db.session.query(
+            db.func.count(model.id),
+            db.func.sum(case((model.is_active == True, 1), else_=0))
+        ).one()
+        counters[prefix] = total
+        counters[f'{prefix}.active'] = active or 0
+
+    counters['orders'] = 0
+    counters['revenue.delivered'] = 0.0
+    for status in ORDER_STATUSES:
+        counters[f'orders.status.{status}'] = 0
+    for status, count, amount in db.session.query(
+        Order.status, db.func.count(Order.id), db.func.sum(Order.total_amount)
+    ).group_by(Order.status):
+        counters['orders'] += count
+        counters[f'orders.status.{status}'] = count
+        if status == 'Delivered':
+            counters['revenue.delivered'] = amount or 0.0
+
+    counters['subscriptions'] = 0
+    counters['subscriptions.active'] = 0
+    for status in SUBSCRIPTION_STATUSES:
+        counters[f'subscriptions.status.{status}'] = 0
+    for status, is_active, count in db.session.query(
+        Subscription.status, Subscription.is_active, db.func.count(Subscription.id)
+    ).group_by(Subscription.status, Subscription.is_active):
+        counters['subscriptions'] += count
+        counters[f'subscriptions.status.{status}'] = counters.get(f'subscriptions.status.{status}', 0) + count
+        if status == 'approved' and is_active:
+            counters['subscriptions.active'] += count
+
+    return counters
+
+
+def get_user_summary(user_id):
+    """
+    A customer's UserOrderSummary (order_count, delivered_count, total_spent).
+    Customers without orders (or before summaries are built) have no row and
+    get a zero summary.
+    """
+    summary = db.session.get(UserOrderSummary, user_id)
+    return summary or UserOrderSummary(user_id=user_id, order_count=0, delivered_count=0, total_spent=0.0)
+
+
+def rebuild():
+    """Replace all counters and customer summaries with freshly computed values (drift repair)"""
+    counters = compute_counters()
+    counters[REBUILT_MARKER] = time.time()
+    counters[SUMMARIES_MARKER] = time.time()
+
+    table = StatCounter.__table__
+    db.session.execute(table.delete().where(or_(
+        table.c.key.in_((REBUILT_MARKER, SUMMARIES_MARKER)),
+        *[table.c.key.like(f'{prefix}%') for prefix in COUNTER_PREFIXES]
+    )))
+    db.session.execute(table.insert(), [{'key': key, 'value': value} for key, value in counters.items()])
+    # Already counted above
+    db.session.execute(StatDelta.__table__.delete())
+
+    delivered = Order.status == 'Delivered'
+    db.session.execute(UserOrderSummary.__table__.delete())
+    db.session.execute(UserOrderSummary.__table__.insert().from_select(
+        ['user_id', 'order_count', 'delivered_count', 'total_spent'],
+        db.select(
+            Order.user_id,
+            db.func.count(Order.id),
+            db.func.sum(case((delivered, 1), else_=0)),
+            db.func.coalesce(db.func.sum(case((delivered, Order.total_amount), else_=0.0)), 0.0)
+        ).group_by(Order.user_id)
+    ))
+    db.session.commit()
+    return counters
+
+
+def init_app(app):
+    """Register the rebuild-stats CLI command"""
+    @app.cli.command('rebuild-stats')
+    def rebuild_stats_command():
+        """Recompute dashboard counters and customer order summaries from the database."""
+        counters = rebuild()
+        print(f"Rebuilt {len(counters)} dashboard counters")
@@ -0,0 +1,119 @@
+"""
+Stock Reservation
+-----------------
+Race-free stock decrements shared by checkout and the subscription scheduler.
+
+Stock is never read, changed in Python and written back. Each product is
+decremented with a conditional UPDATE ... WHERE stock >= quantity inside the
+caller's transaction, so two concurrent buyers can never both take the last
+unit. Lock contention ("database is locked" on SQLite, deadlocks and
+serialization failures on PostgreSQL) is retried with exponential backoff.
+
+Every stock change also stamps Product.stock_updated_at, which catalog
+pages use for Last-Modified (http_cache.py): reserve_stock() sets it in its
+UPDATE, and a mapper event covers ORM writes (admin edits, the scheduler).
+
+Usage:
+    def place_order():
+        reserve_stock([(product_id, quantity), ...])
+        ...  # insert the order rows
+        db.session.commit()
+
+    run_with_retry(place_order)
+"""
+
+import random
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import OperationalError, DBAPIError
+
+from models import db, Product
+import catalog_cache
+
+
+# PostgreSQL error codes that mean "try again": serialization_failure,
+# deadlock_detected, lock_not_available
+RETRYABLE_PGCODES = {'40001', '40P01', '55P03'}
+
+
+class InsufficientStock(Exception):
+    """Raised when a product does not have enough stock left for a reservation"""
+
+    def __init__(self, product_id, quantity):
+        super().__init__(f"Not enough stock for product #{product_id} (requested {quantity})")
+        self.product_id = product_id
+        self.quantity = quantity
+
+
+def reserve_stock(lines):
+    """
+    Decrement stock for an iterable of (product_id, quantity) pairs within the
+    current transaction. Quantities for the same product are combined, and
+    products are updated in id order so concurrent reservations lock rows in
+    the same order. Raises InsufficientStock for the first product that
+    cannot be covered; the caller must roll back in that case.
+    """
+    totals = defaultdict(int)
+    for product_id, quantity in lines:
+        totals[product_id] += quantity
+
+    product_table = Product.__table__
+    for product_id in sorted(totals):
+        quantity = totals[product_id]
+        updated = db.session.execute(
+            product_table.update()
+            .where(product_table.c.id == product_id, product_table.c.stock >= quantity)
+            .values(stock=product_table.c.stock - quantity, stock_updated_at=datetime.utcnow())
+        )
+        if updated.rowcount != 1:
+            raise InsufficientStock(product_id, quantity)
+
+    # Pages read stock live, so the catalog version stays put; only products
+    # that just sold out are logged, for the shop's in-stock filter
+    if totals:
+        sold_out = db.session.execute(
+            db.select(product_table.c.id).where(product_table.c.id.in_(list(totals)), product_table.c.stock == 0)
+        ).scalars().all()
+        catalog_cache.log_stock_changes(sold_out)
+
+
+@event.listens_for(Product, 'before_update')
+def _stamp_stock_change(mapper, connection, target):
+    if inspect(target).attrs.stock.history.has_changes():
+        target.stock_updated_at = datetime.utcnow()
+
+
+def is_contention_error(error):
+    """Check whether a database error is transient lock contention worth retrying"""
+    if not isinstance(error, DBAPIError):
+        return False
+
+    pgcode = getattr(error.orig, 'pgcode', None)
+    if pgcode in RETRYABLE_PGCODES:
+        return True
+
+    message = str(error.orig).lower()
+    return isinstance(error, OperationalError) and ('database is locked' in message or 'database table is locked' in message)
+
+
+def run_with_retry(operation, attempts=None, base_delay=None):
+    """
+    Run `operation()` (which should end by committing) and return its result,
+    rolling back and retrying on lock contention with jittered exponential
+    backoff. Other errors, including InsufficientStock, propagate immediately.
+    """
+    attempts = attempts or current_app.config['STOCK_RETRY_ATTEMPTS']
+    base_delay = base_delay if base_delay is not None else current_app.config['STOCK_RETRY_BASE_DELAY']
+
+    for attempt in range(1, attempts + 1):
+        try:
+            return operation()
+        except DBAPIError as e:
+            db.session.rollback()
+            if attempt == attempts or not is_contention_error(e):
+                raise
+            time.sleep(base_delay * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
@@ -0,0 +1,297 @@
+"""
+Search Suggestions
+------------------
+Search-as-you-type for the shop search box. /customer/api/suggest?q=gre ap
+returns a few active products with a name word starting with each typed
+word, as compact JSON (id, name, price, thumb), without querying products.
+
+Each process keeps a prefix index in memory: every word of every active
+product name in one sorted list, tagged with the product it belongs to
+("mango\x00417"). A lookup bisects to the range of entries for the typed
+word with the fewest, keeps those whose product also has an entry for
+every other typed word, and takes the SCAN_LIMIT best of them. numpy
+arrays kept next to the entries (the product of each entry, whether its
+word is the first of the name, each name's place in order of length, then
+name) make that one pass over the ranges. Those candidates are then ranked
+exactly: names that start with the query first, then shorter names.
+
+The index follows the catalog version (catalog_cache.py). When it moves,
+the products changed since the index was built are looked up in the
+product_change log (stock-only entries are skipped: stock isn't shown
+here) and re-read. They go into a small overlay next to the big sorted
+list - the list itself is never copied or changed - in a copy of the index
+that then replaces the old one. Only the first build, and a rebuild after
+more than FULL_REBUILD_CHANGES products were patched or the log was pruned
+past the index, read every product; they run in a background thread, so
+no request waits for them. Until the first build is ready lookups return
+nothing, and during a rebuild the previous index keeps answering.
+"""
+
+import bisect
+import copy
+import re
+import threading
+
+import numpy as np
+
+from flask import current_app, url_for
+
+from models import db, Product
+import catalog_cache
+import uploads
+
+
+# Shorter queries match too much to be useful
+MIN_QUERY_LENGTH = 2
+
+# Best ranked index entries looked at per lookup, so one-letter-ish prefixes stay fast
+SCAN_LIMIT = 400
+
+# Beyond this many patched products the index is rebuilt (the overlay is copied on every patch)
+FULL_REBUILD_CHANGES = 10000
+
+WORD = re.compile(r'\w+')
+
+
+def _words(text):
+    return WORD.findall(text.casefold())
+
+
+def _entries(name, position):
+    return [f'{word}\x00{position}' for word in set(_words(name))]
+
+
+def _range(entries, term):
+    start = bisect.bisect_left(entries, term)
+    return start, bisect.bisect_left(entries, term + '\uffff', start)
+
+
+def _positions(entries, start, end):
+    return [int(entry.rpartition('\x00')[2]) for entry in entries[start:end]]
+
+
+class PrefixIndex:
+    """
+    Sorted name words of the active products as of one catalog version: the
+    words of every product when the index was built, plus an overlay with
+    the products patched in since (copied on each patch, so kept small)
+    """
+
+    def __init__(self, version, change_id, rows):
+        self.version = version
+        self.change_id = change_id  # newest product_change entry applied
+        self.products = []  # (id, name, price, image) by position, rows sorted by id
+        entries = []
+        first_words = []
+        for row in rows:
+            entries.extend(_entries(row.name, len(self.products)))
+            self.products.append((row.id, row.name, row.price, row.image))
+            first_words.append(next(iter(_words(row.name)), None))
+        # Plain strings sort much faster than (word, position) tuples
+        entries.sort()
+        self.entries = entries
+        self.ids = np.array([product[0] for product in self.products], dtype=np.int64)
+
+        # Per entry: its product's position, and whether its word comes first in the name
+        split = [entry.rpartition('\x00') for entry in entries]
+        self.positions = np.array([int(position) for _, _, position in split], dtype=np.int64)
+        self.first = np.array([word == first_words[int(position)] for word, _, position in split], dtype=bool)
+        # Per product: its place when sorted by name length, then name (the ranking after the first word)
+        order = sorted(range(len(self.products)),
+                       key=lambda position: (len(self.products[position][1]), self.products[position][1].casefold()))
+        self.rank = np.empty(len(order), dtype=np.int64)
+        self.rank[order] = np.arange(len(order))
+
+        self.patched = {}  # position -> current product, None if removed; overrides self.products
+        self.added = []  # sorted entries of the patched products
+        self.appended = {}  # product id -> position of products patched in after the build
+
+    def _position(self, product_id):
+        position = int(np.searchsorted(self.ids, product_id))
+        if position < len(self.ids) and self.ids[position] == product_id:
+            return position
+        return self.appended.get(product_id)
+
+    def _product(self, position):
+        return self.patched[position] if position in self.patched else self.products[position]
+
+    def _best_positions(self, key_range, other_ranges, prefer_first):
+        """
+        Positions of the SCAN_LIMIT best built products among the entries in `key_range`
+        that also have an entry in each of `other_ranges` (patched products left out):
+        words that come first in their name first if `prefer_first`, then by rank
+        """
+        start, end = key_range
+        positions = self.positions[start:end]
+        score = self.rank[positions]
+        if prefer_first:
+            score = score + np.where(self.first[start:end], 0, len(self.products))
+
+        keep = np.ones(len(positions), dtype=bool)
+        for other_start, other_end in other_ranges:
+            has_word = np.zeros(len(self.products), dtype=bool)
+            has_word[self.positions[other_start:other_end]] = True
+            keep &= has_word[positions]
+        if self.patched:
+            keep &= ~np.isin(positions, np.fromiter(self.patched, dtype=np.int64, count=len(self.patched)))
+        positions, score = positions[keep], score[keep]
+
+        if len(positions) > SCAN_LIMIT:
+            positions = positions[np.argpartition(score, SCAN_LIMIT - 1)[:SCAN_LIMIT]]
+        return positions.tolist()
+
+    def patched_copy(self, version, change_id, product_ids):
+        """A copy with the current rows of `product_ids` applied (missing or inactive rows are removed)"""
+        rows = {row.id: row for row in _select_rows(sorted(product_ids))} if product_ids else {}
+        patched, appended = dict(self.patched), dict(self.appended)
+        removed, added = set(), []
+        for product_id in sorted(product_ids):
+            row = rows.get(product_id)
+            current = (row.id, row.name, row.price, row.image) if row is not None and row.is_active else None
+            position = self._position(product_id)
+            previous = self._product(position) if position is not None else None
+            if current == previous:
+                continue  # e.g. only a column that isn't shown changed
+            if position is None:
+                position = len(self.products) + len(appended)
+                appended[product_id] = position
+            if position in self.patched and previous is not None:
+                removed.update(_entries(previous[1], position))
+            patched[position] = current
+            if current is not None:
+                added.extend(_entries(current[1], position))
+
+        index = copy.copy(self)
+        index.version, index.change_id = version, change_id
+        index.patched, index.appended = patched, appended
+        if removed or added:
+            index.added = sorted([entry for entry in self.added if entry not in removed] + added)
+        return index
+
+    def search(self, query, limit):
+        """Products whose name has a word starting with each word of `query`, best first"""
+        terms = list(dict.fromkeys(_words(query)))
+        if not terms:
+            return []
+        ranges = {term: (_range(self.entries, term), _range(self.added, term)) for term in terms}
+        key = min(terms, key=lambda term: sum(end - start for start, end in ranges[term]))
+        others = [term for term in terms if term != key]
+        folded = query.casefold().strip()
+
+        (start, end), (added_start, added_end) = ranges[key]
+        positions = dict.fromkeys(
+            self._best_positions((start, end), [ranges[term][0] for term in others], prefer_first=key == terms[0])
+            + _positions(self.added, added_start, added_end)
+        )
+        matches = []
+        for position in positions:
+            product = self._product(position)
+            name = product[1].casefold()
+            if others:
+                words = _words(name)
+                if not all(any(word.startswith(term) for word in words) for term in others):
+                    continue
+            matches.append((not name.startswith(folded), len(name), name, product))
+        matches.sort(key=lambda match: match[:3])
+        return [match[3] for match in matches[:limit]]
+
+
+def _select_rows(product_ids):
+    return db.session.execute(
+        db.select(Product.id, Product.name, Product.price, Product.image, Product.is_active)
+        .where(Product.id.in_(product_ids))
+    ).all()
+
+
+def build_index(version):
+    # The log position is read first, so changes racing with the load are replayed later
+    change_id = catalog_cache.newest_change()
+    rows = db.session.execute(
+        db.select(Product.id, Product.name, Product.price, Product.image)
+        .where(Product.is_active == True).order_by(Product.id)
+    )
+    return PrefixIndex(version, change_id, rows)
+
+
+class _IndexHolder:
+    """The current index of this process and its background builds"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = None
+        self.building = False
+
+    def get(self, version):
+        """The current index (None until the first is built), patched to `version` first if it is older"""
+        index = self.index
+        if index is not None and index.version == version:
+            return index
+
+        with self.lock:
+            index = self.index
+            if self.building or (index is not None and index.version == version):
+                return index
+            if index is None:
+                self._build(version)
+                return None
+
+            change_id, product_ids = catalog_cache.changed_products(index.change_id, FULL_REBUILD_CHANGES,
+                                                                    stock=False)
+            if product_ids is None:
+                self._build(version)
+                return index
+            index = self.index = index.patched_copy(version, change_id, product_ids)
+            if len(index.patched) > FULL_REBUILD_CHANGES:
+                self._build(version)  # fold the overlay into a fresh index
+            return index
+
+    def _build(self, version):
+        # Called with the lock held
+        self.building = True
+        app = current_app._get_current_object()
+        threading.Thread(target=self._run_build, args=(app, version), daemon=True,
+                         name='suggest-index').start()
+
+    def _run_build(self, app, version):
+        try:
+            with app.app_context():
+                index = build_index(version)
+            self.index = index
+        except Exception:
+            app.logger.exception("Building the search suggestion index failed")
+        finally:
+            self.building = False
+
+
+_holder = _IndexHolder()
+
+
+def thumb_url(image):
+    """Smallest available picture of a product image, or None"""
+    if not image:
+        return None
+    if not uploads.is_local(image):
+        return image if image.startswith('http') else None
+    if uploads.has_variants('products', image):
+        width = min(current_app.config['IMAGE_VARIANT_WIDTHS'])
+        image = uploads.variant_name(image, width, 'webp')
+    return url_for('static', filename='uploads/products/' + image)
+
+
+def ready():
+    """Whether this process has an index yet (until then every lookup is empty)"""
+    return _holder.index is not None
+
+
+def suggest(query, limit=None):
+    """Compact suggestions for a partial search query"""
+    query = query.strip()
+    if len(query) < MIN_QUERY_LENGTH:
+        return []
+    index = _holder.get(catalog_cache.get_version())
+    if index is None:
+        return []
+    return [
+        {'id': product_id, 'name': name, 'price': price, 'thumb': thumb_url(image)}
+        for product_id, name, price, image in index.search(query, limit or current_app.config['SUGGEST_LIMIT'])
+    ]
@@ -0,0 +1,126 @@
+"""
+Background Tasks
+----------------
+Job handlers for long-running admin operations (bulk imports, subscription
+runs, image resizing), run by the worker pool in jobs.py, plus helpers that
+enqueue them from views.
+
+Uploaded files are saved under JOB_FILES_FOLDER until their job has run.
+That folder must be shared storage if workers run on other hosts.
+"""
+
+import os
+import uuid
+
+from flask import current_app
+
+import catalog_cache
+import jobs
+import product_import
+import uploads
+
+
+# Error messages kept on the job for the status page
+MAX_STORED_ERRORS = 20
+
+
+# ========== PRODUCT IMPORT ==========
+
+def enqueue_product_import(file, filename, mode, user_id=None):
+    """Save an uploaded file and queue its import. Returns the Job."""
+    folder = current_app.config['JOB_FILES_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f'{uuid.uuid4().hex}{os.path.splitext(filename)[1].lower()}')
+    file.save(path)
+
+    return jobs.enqueue('product_import', {'path': path, 'filename': filename, 'mode': mode}, user_id=user_id)
+
+
+@jobs.handler('product_import')
+def run_product_import(params, report):
+    """Stream a saved upload into the catalog, reporting rows processed"""
+    result = product_import.ImportResult()
+    try:
+        with open(params['path'], 'rb') as file:
+            product_import.import_file(
+                file, params['filename'], mode=params['mode'], result=result,
+                progress=lambda rows: report(rows)
+            )
+    except product_import.MissingColumns:
+        raise jobs.JobError(f'The file must have these columns: {", ".join(product_import.REQUIRED_COLUMNS)}')
+    except product_import.EmptyFile as e:
+        raise jobs.JobError(str(e))
+    except Exception as e:
+        if result.success_count:
+            raise RuntimeError(f'{e} ({result.success_count} products from earlier rows were already saved)') from e
+        raise
+    finally:
+        if os.path.exists(params['path']):
+            os.remove(params['path'])
+
+    return {
+        'mode': params['mode'],
+        'created': result.created_count,
+        'updated': result.updated_count,
+        'unchanged': result.unchanged_count,
+        'errors': result.error_count,
+        'error_messages': result.error_messages[:MAX_STORED_ERRORS],
+    }
+
+
+# ========== IMAGE VARIANTS ==========
+
+def _queue_variants(kind, filename, user_id):
+    if not uploads.has_variants(kind, filename):
+        jobs.enqueue('image_variants', {'kind': kind, 'filename': filename}, user_id=user_id)
+
+
+def save_image_upload(file, kind, user_id=None):
+    """Save an uploaded image and queue its resized variants. Returns the stored file name."""
+    filename = uploads.save_image(file, kind)
+    _queue_variants(kind, filename, user_id)
+    return filename
+
+
+def save_image_url(value, kind, user_id=None):
+    """
+    Image field value to store for an entered URL: data:image URIs (already
+    checked by the form) are saved as files like uploads, other URLs are kept.
+    """
+    if not uploads.is_data_uri(value):
+        return value
+    filename = uploads.save_data_uri(value, kind)
+    _queue_variants(kind, filename, user_id)
+    return filename
+
+
+@jobs.handler('image_variants', max_attempts=3)
+def run_image_variants(params, report):
+    """Resize an uploaded image into WebP/JPEG variants (safe to re-run)"""
+    try:
+        written = uploads.generate_variants(params['kind'], params['filename'])
+    except FileNotFoundError:
+        raise jobs.JobError(f"Image {params['filename']} no longer exists")
+    except OSError as e:
+        # Pillow raises UnidentifiedImageError (an OSError) for files it can't read
+        raise jobs.JobError(f"Could not resize {params['filename']}: {e}")
+
+    # Cached catalog pages only list variants that existed when they were built
+    catalog_cache.bump_version(catalog_cache.products_with_image(params['kind'], [params['filename']]))
+    return {'kind': params['kind'], 'filename': params['filename'], 'files': written}
+
+
+# ========== SUBSCRIPTION PROCESSING ==========
+
+def enqueue_subscription_processing(user_id=None):
+    """Queue a batch run over all due subscriptions. Returns the Job."""
+    return jobs.enqueue('process_subscriptions', user_id=user_id)
+
+
+@jobs.handler('process_subscriptions', max_attempts=3)
+def run_subscription_processing(params, report):
+    """Create orders for due subscriptions with the batch scheduler (safe to re-run)"""
+    # scheduler imports the app module, so it can't be imported while the app is loading;
+    # importing it has no other side effects (its log setup only runs from the command line)
+    from scheduler import process_subscriptions_batch
+    return process_subscriptions_batch(progress=report)
@@ -0,0 +1,106 @@
+"""
+Test fixtures: the app on a throwaway SQLite file whose schema is built by
+the migrations (migrations/), emptied again after every test.
+
+Run from the project directory:
+    python -m pytest -q tests
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# config.py reads these on import, so they are set before the app is imported
+_directory = tempfile.mkdtemp(prefix='grocery-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_directory, 'test.db')
+os.environ['JOB_WORKERS'] = '0'
+os.environ['JOB_FILES_FOLDER'] = os.path.join(_directory, 'job_files')
+
+from flask_migrate import upgrade  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+from app import create_app  # noqa: E402
+from models import db, User  # noqa: E402
+import catalog_cache  # noqa: E402
+import facets  # noqa: E402
+import search  # noqa: E402
+import suggest  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app():
+    app = create_app()
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with app.app_context():
+        upgrade()
+    yield app
+
+
+@pytest.fixture
+def database(app):
+    """
+    The app's database, emptied after the test. No app context is held
+    open: requests made by the test client get their own, as in production.
+    """
+    yield db
+    with app.app_context():
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+        # Not one of the models' tables, and product ids are reused
+        search.reindex_all()
+
+    # Per-process indexes and caches follow the product_change log and catalog version, which start over
+    catalog_cache._local.clear()
+    facets._holder.index = None
+    suggest._holder = suggest._IndexHolder()
+
+
+@pytest.fixture
+def admin_client(app, database):
+    """A test client logged in as an admin"""
+    with app.app_context():
+        admin = User(username='admin', email='admin@example.com', is_admin=True, phone='1234567890', address='Office')
+        admin.set_password('admin123')
+        db.session.add(admin)
+        db.session.commit()
+
+    client = app.test_client()
+    response = client.post('/auth/login', data={'username': 'admin', 'password': 'admin123'})
+    assert response.status_code == 302
+    return client
+
+
+class QueryCounter:
+    """Counts the statements sent to the database while active (after_cursor_execute)"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _executed(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'after_cursor_execute', self._executed)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'after_cursor_execute', self._executed)
+
+
+@pytest.fixture
+def count_queries(app):
+    """count_queries(client, url) -> (response, number of statements the request ran)"""
+    def count(client, url):
+        with app.app_context():
+            engine = db.engine
+        with QueryCounter(engine) as counter:
+            response = client.get(url)
+        return response, counter.count
+    return count
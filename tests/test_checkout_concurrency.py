@@ -0,0 +1,79 @@
+"""
+Concurrent checkouts of the last units of a product: stock never goes
+negative and exactly as many orders go through as there were units.
+"""
+
+import threading
+
+from models import db, Cart, CartItem, Category, Order, OrderItem, Product, User
+
+
+STOCK = 5
+BUYERS = 16
+
+
+def _logged_in_client(app, user_id):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        # Flask-Login's session keys, to skip hashing a password per buyer
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    return client
+
+
+def test_concurrent_checkouts_do_not_oversell(app, database):
+    with app.app_context():
+        category = Category(name='Dairy')
+        db.session.add(category)
+        db.session.flush()
+        product = Product(name='Last Milk', price=60, stock=STOCK, category_id=category.id)
+        db.session.add(product)
+        db.session.flush()
+        buyer_ids = []
+        for number in range(BUYERS):
+            buyer = User(username=f'buyer{number}', email=f'buyer{number}@example.com', password_hash='-',
+                         phone='1234567890', address='Street')
+            db.session.add(buyer)
+            db.session.flush()
+            cart = Cart(user_id=buyer.id)
+            db.session.add(cart)
+            db.session.flush()
+            db.session.add(CartItem(cart_id=cart.id, product_id=product.id, quantity=1))
+            buyer_ids.append(buyer.id)
+        db.session.commit()
+        product_id = product.id
+
+    clients = [_logged_in_client(app, buyer_id) for buyer_id in buyer_ids]
+    start = threading.Barrier(BUYERS)
+    locations, errors = [], []
+
+    def buy(client):
+        try:
+            start.wait()
+            response = client.post('/customer/checkout', data={
+                'phone': '1234567890', 'delivery_address': 'Street', 'payment_method': 'cod'
+            })
+            locations.append(response.headers.get('Location', str(response.status_code)))
+        except Exception as e:  # surfaced by the assertion below
+            errors.append(e)
+
+    threads = [threading.Thread(target=buy, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with app.app_context():
+        stock = db.session.get(Product, product_id).stock
+        orders = Order.query.count()
+        units_sold = db.session.query(db.func.sum(OrderItem.quantity)).scalar()
+        carts_left = CartItem.query.count()
+
+    assert stock >= 0
+    assert stock == 0
+    assert orders == units_sold == STOCK
+    # Every other checkout was sent back to its cart, which it keeps
+    assert locations.count('/customer/orders') == STOCK
+    assert locations.count('/customer/cart') == BUYERS - STOCK
+    assert carts_left == BUYERS - STOCK
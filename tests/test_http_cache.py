@@ -0,0 +1,59 @@
+"""
+Catalog pages answer If-Modified-Since as well as If-None-Match, and a
+stock change on the page moves its Last-Modified.
+"""
+
+from datetime import datetime, timezone
+
+from models import db, Category, Product, StatCounter
+from stock import reserve_stock
+import catalog_cache
+import http_cache
+
+
+LONG_AGO = datetime(2020, 1, 1, tzinfo=timezone.utc)
+CATALOG_CHANGED = datetime(2020, 6, 1, tzinfo=timezone.utc)
+
+
+def _add_product(app):
+    with app.app_context():
+        category = Category(name='Dairy')
+        db.session.add(category)
+        db.session.flush()
+        product = Product(name='Milk', description='Toned milk', price=60, stock=10, category_id=category.id)
+        db.session.add(product)
+        db.session.flush()
+        # A catalog last changed long ago, so the test's own writes are newer
+        db.session.execute(db.update(StatCounter).where(StatCounter.key == catalog_cache.VERSION_KEY)
+                           .values(value=CATALOG_CHANGED.timestamp() * 1000))
+        db.session.commit()
+        return product.id
+
+
+def test_if_modified_since_until_stock_changes(app, database, monkeypatch):
+    monkeypatch.setitem(app.extensions, 'http_cache', http_cache.Templates('test', LONG_AGO))
+    product_id = _add_product(app)
+    client = app.test_client()
+
+    response = client.get('/customer/shop')
+    assert response.status_code == 200
+    assert response.last_modified == CATALOG_CHANGED
+    last_modified = response.headers['Last-Modified']
+    assert client.get('/customer/shop', headers={'If-Modified-Since': last_modified}).status_code == 304
+
+    with app.app_context():
+        reserve_stock([(product_id, 1)])
+        db.session.commit()
+
+    response = client.get('/customer/shop', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 200
+    assert response.last_modified > CATALOG_CHANGED
+    assert 'Stock: 9' in response.get_data(as_text=True)
+
+
+def test_signed_in_pages_have_no_last_modified(app, admin_client):
+    _add_product(app)
+
+    response = admin_client.get('/customer/shop')
+    assert response.status_code == 200
+    assert 'ETag' in response.headers and 'Last-Modified' not in response.headers
@@ -0,0 +1,33 @@
+"""
+New image variants are logged for the products that show the image, so
+in-process indexes re-read them along with the cached pages.
+"""
+
+from models import db, Category, Product, ProductChange
+import catalog_cache
+import tasks
+import uploads
+
+
+def test_variants_job_logs_products_showing_the_image(app, database, monkeypatch):
+    monkeypatch.setattr(uploads, 'generate_variants', lambda kind, filename: 0)
+    with app.app_context():
+        category = Category(name='Dairy', image='dairy.jpg')
+        db.session.add(category)
+        db.session.flush()
+        milk = Product(name='Milk', price=60, stock=10, category_id=category.id, image='milk.jpg')
+        curd = Product(name='Curd', price=40, stock=10, category_id=category.id)
+        db.session.add_all([milk, curd])
+        db.session.commit()
+        after = catalog_cache.newest_change()
+
+        tasks.run_image_variants({'kind': 'products', 'filename': 'milk.jpg'}, None)
+        db.session.commit()
+        logged = set(db.session.execute(db.select(ProductChange.product_id).where(ProductChange.id > after)).scalars())
+        assert logged == {milk.id}
+
+        after = catalog_cache.newest_change()
+        tasks.run_image_variants({'kind': 'categories', 'filename': 'dairy.jpg'}, None)
+        db.session.commit()
+        logged = set(db.session.execute(db.select(ProductChange.product_id).where(ProductChange.id > after)).scalars())
+        assert logged == {milk.id, curd.id}
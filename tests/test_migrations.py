@@ -0,0 +1,82 @@
+"""
+The migrated schema matches the models, and the hot queries use the
+indexes the migrations create (SQLite's EXPLAIN QUERY PLAN).
+"""
+
+from datetime import datetime
+
+import pytest
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+
+from models import db, CartItem, Job, Order, OrderItem, Product, Subscription, SubscriptionItem
+import keyset
+import scheduler
+
+
+def _query_plan(database, statement):
+    """SQLite's plan for `statement`, one step per line"""
+    compiled = statement.compile(database.engine, compile_kwargs={'render_postcompile': True})
+    parameters = [compiled.params[name] for name in compiled.positiontup]
+    rows = database.session.connection().exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', tuple(parameters))
+    return '\n'.join(row[-1] for row in rows)
+
+
+def test_migrations_match_models(app, database):
+    with app.app_context():
+        context = MigrationContext.configure(database.session.connection())
+        differences = [difference for difference in compare_metadata(context, database.metadata)
+                       if not (difference[0] == 'remove_table' and difference[1].name == 'alembic_version')]
+    assert differences == []
+
+
+@pytest.mark.parametrize('name, statement, index', [
+    ('due subscriptions',
+     lambda: Subscription.query.with_entities(Subscription.id).filter(*scheduler._due_filter(datetime.utcnow())),
+     'ix_subscription_due'),
+    ('subscription listing by status',
+     lambda: Subscription.query.filter(Subscription.status == 'approved')
+     .order_by(Subscription.created_at.desc(), Subscription.id.desc()).limit(11),
+     'ix_subscription_status_created'),
+    ('order listing, next page',
+     lambda: Order.query.filter(keyset.tuple_(Order.created_at, Order.id)
+                                < keyset._key_bound(Order, (datetime.utcnow(), 10)))
+     .order_by(Order.created_at.desc(), Order.id.desc()).limit(11),
+     'ix_order_created'),
+    ('customer order history',
+     lambda: Order.query.filter(Order.user_id == 1).order_by(Order.created_at.desc(), Order.id.desc()).limit(11),
+     'ix_order_user_created'),
+    ('order counts and revenue per status',
+     lambda: db.session.query(Order.status, db.func.count(Order.id), db.func.sum(Order.total_amount))
+     .group_by(Order.status),
+     'ix_order_status'),
+    ('order items',
+     lambda: OrderItem.query.filter(OrderItem.order_id == 1),
+     'ix_order_item_order_product'),
+    ('subscription items',
+     lambda: SubscriptionItem.query.filter(SubscriptionItem.subscription_id.in_([1, 2, 3])),
+     'ix_subscription_item_subscription_product'),
+    ('item already in subscription',
+     lambda: SubscriptionItem.query.filter_by(subscription_id=1, product_id=2),
+     'ix_subscription_item_subscription_product'),
+    ('item already in cart',
+     lambda: CartItem.query.filter_by(cart_id=1, product_id=2),
+     'ix_cart_item_cart_product'),
+    ('shop category',
+     lambda: Product.query.filter(Product.is_active == True, Product.category_id == 1),
+     'ix_product_active_category'),
+    ('import match by sku',
+     lambda: Product.query.filter(Product.sku.in_(['SKU1', 'SKU2'])),
+     'ix_product_sku'),
+    ('import match by name and category',
+     lambda: Product.query.filter(Product.name == 'Apple 1', Product.category_id == 1),
+     'ix_product_name_category'),
+    ('queued jobs',
+     lambda: Job.query.filter(Job.status == 'queued').order_by(Job.id),
+     'ix_job_status'),
+])
+def test_hot_query_uses_index(app, database, name, statement, index):
+    # No ANALYZE, as in the app: SQLite plans with its default estimates
+    with app.app_context():
+        plan = _query_plan(database, statement().statement)
+    assert f'INDEX {index}' in plan, f'{name}:\n{plan}'
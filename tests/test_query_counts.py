@@ -0,0 +1,97 @@
+"""
+Listing pages run the same number of queries however many rows they list:
+no query per order, item, customer, category or subscription.
+"""
+
+import itertools
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import db, Category, Order, OrderItem, Product, Subscription, SubscriptionItem, User
+import stats
+
+
+_numbers = itertools.count(1)
+
+
+def _customer():
+    """A new customer each time, so lazy loads of order.user can't be answered from the identity map"""
+    number = next(_numbers)
+    customer = User(username=f'customer{number}', email=f'customer{number}@example.com', password_hash='-',
+                    phone='1234567890', address='Street')
+    db.session.add(customer)
+    return customer
+
+
+def _category():
+    number = next(_numbers)
+    category = Category(name=f'Category {number}')
+    db.session.add(category)
+    db.session.flush()
+    for position in range(2):
+        db.session.add(Product(name=f'Product {number}.{position}', price=10, stock=100, category_id=category.id))
+    db.session.flush()
+    return category
+
+
+def add_orders(count):
+    products = _category().products.all()
+    for _ in range(count):
+        order = Order(user=_customer(), total_amount=30, delivery_address='Street', phone='1234567890')
+        db.session.add(order)
+        for product in products:
+            db.session.add(OrderItem(order=order, product_id=product.id, quantity=1, price=10))
+
+
+def add_categories(count):
+    for _ in range(count):
+        _category()
+
+
+def add_subscriptions(count, user=None):
+    """`count` subscriptions of two items each, by new customers or all by `user`"""
+    products = _category().products.all()
+    for _ in range(count):
+        subscription = Subscription(user=user or _customer(), name='Weekly basket', frequency='weekly',
+                                    status='pending', next_delivery=datetime.utcnow() + timedelta(days=7))
+        db.session.add(subscription)
+        for product in products:
+            db.session.add(SubscriptionItem(subscription=subscription, product_id=product.id, quantity=1))
+
+
+def add_own_subscriptions(count):
+    """Subscriptions of the logged-in admin, listed on their /customer/subscriptions page"""
+    add_subscriptions(count, user=User.query.filter_by(username='admin').one())
+
+
+def add_orders_and_subscriptions(count):
+    add_orders(count)
+    add_subscriptions(count)
+
+
+# url, rows added per step, text each listed row shows, rows listed after the second step
+@pytest.mark.parametrize('url, add_rows, marker, listed', [
+    ('/admin/orders', add_orders, '<strong>customer', 10),  # one page
+    ('/admin/categories', add_categories, '>Category ', 32),
+    ('/admin/dashboard', add_orders_and_subscriptions, '<strong>customer', 10),  # 5 recent orders, 5 subscriptions
+    ('/admin/subscriptions', add_subscriptions, '<strong>customer', 20),  # one page
+    ('/customer/subscriptions', add_own_subscriptions, '<strong>Products:</strong>', 32),
+])
+def test_query_count_does_not_grow_with_rows(app, admin_client, count_queries, url, add_rows, marker, listed):
+    def grow(count):
+        with app.app_context():
+            add_rows(count)
+            db.session.commit()
+            stats.rebuild()
+
+    grow(2)
+    admin_client.get(url)  # first request of the process does one-off work
+    response, few_rows = count_queries(admin_client, url)
+    assert response.status_code == 200
+
+    grow(30)
+    response, many_rows = count_queries(admin_client, url)
+    assert response.status_code == 200
+    assert many_rows == few_rows
+    assert response.get_data(as_text=True).count(marker) == listed
@@ -0,0 +1,21 @@
+"""
+scheduler.py --shard INDEX/COUNT is checked when the arguments are parsed:
+a count of at least 1 and an index below it.
+"""
+
+import argparse
+
+import pytest
+
+import scheduler
+
+
+def test_shard_in_range():
+    assert scheduler._parse_shard('0/4') == (0, 4)
+    assert scheduler._parse_shard('3/4') == (3, 4)
+
+
+@pytest.mark.parametrize('value', ['4/4', '-1/4', '0/0', '1/-2', '2', '1/2/3', 'a/4'])
+def test_bad_shard_is_a_usage_error(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        scheduler._parse_shard(value)
@@ -0,0 +1,43 @@
+"""
+Shop search keeps the best matches when a broad search has more than
+SEARCH_MATCH_LIMIT of them, and says that its counts stop there.
+"""
+
+import search
+from models import db, Category, Product
+
+
+def _add_products(app, names_and_descriptions):
+    with app.app_context():
+        search.ensure_index()
+        category = Category(name='Fruit')
+        db.session.add(category)
+        db.session.flush()
+        for name, description in names_and_descriptions:
+            db.session.add(Product(name=name, description=description, price=10, stock=5, category_id=category.id))
+        db.session.commit()
+
+
+def test_best_matches_kept_past_the_limit(app, database):
+    # Indexed first, description matches only: the old index-order LIMIT kept these
+    _add_products(app, [(f'Juice {number}', 'made with apple') for number in range(5)]
+                  + [('Apple Red', 'crisp'), ('Apple Green', 'sour')])
+
+    with app.app_context():
+        best = [db.session.get(Product, product_id).name for product_id in search.matching_ids('apple', 2)]
+        more = [db.session.get(Product, product_id).name for product_id in search.matching_ids('apple', 4)]
+    assert sorted(best) == ['Apple Green', 'Apple Red']
+    # Name matches first, then the others
+    assert sorted(more[:2]) == ['Apple Green', 'Apple Red'] and all(name.startswith('Juice') for name in more[2:])
+    assert len(more) == 4
+
+
+def test_shop_says_when_search_reached_the_limit(app, database, monkeypatch):
+    _add_products(app, [(f'Apple {number}', '') for number in range(3)])
+    monkeypatch.setitem(app.config, 'SEARCH_MATCH_LIMIT', 2)
+    client = app.test_client()
+
+    capped = client.get('/customer/shop?search=apple').get_data(as_text=True)
+    narrow = client.get('/customer/shop?search=apple+1').get_data(as_text=True)
+    assert 'Showing the best 2 matches' in capped
+    assert 'Showing the best' not in narrow
@@ -0,0 +1,77 @@
+"""
+Dashboard counters: writes append deltas instead of updating the counter
+rows, reads count the pending ones, and folding them changes no total.
+Reads never build the counters.
+"""
+
+from models import db, Category, Order, StatCounter, StatDelta, User
+import stats
+
+
+def _add_orders(count, status='Pending'):
+    customer = User(username=f'customer-{status}', email=f'{status}@example.com', password_hash='-')
+    db.session.add(customer)
+    for _ in range(count):
+        db.session.add(Order(user=customer, total_amount=25, status=status, delivery_address='Street',
+                             phone='1234567890'))
+    db.session.commit()
+
+
+def _counter_rows():
+    """This module's counter rows (the catalog version lives in the same table)"""
+    rows = db.session.execute(db.select(StatCounter.key, StatCounter.value)).all()
+    return {key: value for key, value in rows if key.startswith(stats.COUNTER_PREFIXES)}
+
+
+def test_writes_append_deltas_and_fold_keeps_totals(app, database):
+    with app.app_context():
+        stats.rebuild()
+        rows = _counter_rows()
+
+        _add_orders(3)
+        _add_orders(2, status='Delivered')
+        db.session.add(Category(name='Dairy'))
+        db.session.commit()
+
+        # The counter rows weren't touched, the reads see the changes anyway
+        assert _counter_rows() == rows
+        counters = stats.get_counters()
+        assert counters.count('orders') == 5
+        assert counters.count('orders.status.Delivered') == 2
+        assert counters.amount('revenue.delivered') == 50.0
+        assert counters.count('users') == 2
+        assert counters.count('categories') == 1
+
+        with db.engine.begin() as connection:
+            assert stats.fold(connection) > 0
+        assert StatDelta.query.count() == 0
+        assert stats.get_counters() == counters
+        assert {key: stats.get_counters()[key] for key in stats.compute_counters()} == stats.compute_counters()
+
+
+def test_reads_do_not_build_counters(app, database):
+    with app.app_context():
+        _add_orders(2)
+        customer_id = User.query.one().id
+
+        assert stats.REBUILT_MARKER not in stats.get_counters()
+        assert stats.get_user_summary(customer_id).order_count == 0
+        assert _counter_rows() == {}
+
+        # Unbuilt counters are left to the rebuild, which replaces the pending deltas
+        with db.engine.begin() as connection:
+            assert stats.fold(connection) == 0
+        stats.rebuild()
+        assert StatDelta.query.count() == 0
+        assert stats.get_counters().count('orders') == 2
+        assert stats.get_user_summary(customer_id).order_count == 2
+
+
+def test_commit_folds_its_deltas_now_and_then(app, database, monkeypatch):
+    monkeypatch.setattr(stats, 'STAT_FOLD_EVERY', 1)
+    with app.app_context():
+        stats.rebuild()
+        _add_orders(2)
+
+        assert StatDelta.query.count() == 0
+        assert _counter_rows()['orders'] == 2
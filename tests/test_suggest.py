@@ -0,0 +1,37 @@
+"""
+Suggestions rank every product matching a broad prefix, not just the
+first SCAN_LIMIT index entries in word order, and with every typed word
+matched before the SCAN_LIMIT best are taken.
+"""
+
+from collections import namedtuple
+
+import suggest
+
+
+Row = namedtuple('Row', 'id name price image is_active')
+
+
+def _index(names):
+    return suggest.PrefixIndex(1, 0, [Row(number, name, 10.0, None, True) for number, name in enumerate(names, 1)])
+
+
+def test_best_matches_past_the_scan_limit():
+    names = [f'Green Apple Juice {number}' for number in range(3 * suggest.SCAN_LIMIT)] + ['Apple', 'Apricot']
+    index = _index(names)
+
+    assert [product[1] for product in index.search('ap', 3)] == ['Apple', 'Apricot', 'Green Apple Juice 0']
+    assert [product[1] for product in index.search('apple', 1)] == ['Apple']
+    assert [product[1] for product in index.search('juice 99', 2)] == ['Green Apple Juice 99', 'Green Apple Juice 990']
+
+
+
+def test_every_word_matched_before_the_scan_limit():
+    # Plenty of shorter names match each word on its own, one name matches both
+    # (placed where its entries sort late too)
+    names = [f'Green Apple {number}' for number in range(3 * suggest.SCAN_LIMIT)]
+    names[998:998] = ['Green Apple Juice Concentrate']
+    names += [f'Juice {number}' for number in range(3 * suggest.SCAN_LIMIT)]
+    index = _index(names)
+
+    assert [product[1] for product in index.search('apple juice', 5)] == ['Green Apple Juice Concentrate']
@@ -0,0 +1,270 @@
+"""
+Image Uploads
+-------------
+Saves admin-uploaded category and product images under
+UPLOAD_FOLDER/<kind>/ named after a hash of their content, e.g. 3f2a9c1d4e5b6a7f.jpg.
+
+A hashed name always refers to the same bytes: a new upload of a changed
+image gets a new name, so browsers may cache these files forever (see
+http_cache.py), and uploading the same image twice, under whatever file
+name, stores it once. (Earlier versions put the upload's name in front,
+apples-3f2a9c1d4e5b6a7f.jpg; those files are still served the same way.)
+
+Each upload also gets resized variants, one WebP and one JPEG per width in
+IMAGE_VARIANT_WIDTHS, named after the original:
+    3f2a9c1d4e5b6a7f-320w.webp, 3f2a9c1d4e5b6a7f-320w.jpg, ...
+They are generated by a background job (tasks.py), and templates only list
+them in srcset once they exist (has_variants()), falling back to the original.
+
+Images pasted as data URIs (data:image/png;base64,...) are extracted to
+files the same way, so image columns only ever hold a short file name or
+URL. Data URIs longer than DATA_URI_MAX_LENGTH are rejected. Move images
+stored inline by earlier versions out of the database with:
+    flask --app app extract-inline-images
+"""
+
+import base64
+import binascii
+import hashlib
+import io
+import os
+import re
+
+from flask import current_app, url_for
+from PIL import Image, ImageOps, UnidentifiedImageError
+from sqlalchemy import bindparam
+from werkzeug.utils import secure_filename
+
+
+# Hex digest characters kept in the file name
+HASH_LENGTH = 16
+
+# Also matches the <name>-<hash> files of earlier versions
+HASHED_NAME = re.compile(rf'(^|[-/])[0-9a-f]{{{HASH_LENGTH}}}(-\d+w)?\.[A-Za-z0-9]+$')
+
+DATA_URI = re.compile(r'^data:image/([a-z+.-]+);base64,(.*)$', re.IGNORECASE | re.DOTALL)
+
+# Rows loaded per batch by extract-inline-images
+EXTRACT_BATCH_SIZE = 100
+
+# Pillow formats accepted from data URIs -> stored file extension
+DATA_URI_FORMATS = {'PNG': '.png', 'JPEG': '.jpg', 'GIF': '.gif', 'WEBP': '.webp'}
+
+# Variant formats: file extension -> (Pillow format, save options)
+VARIANT_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def is_hashed_name(filename):
+    """Check whether a stored file name (original or variant) carries a content hash"""
+    return bool(HASHED_NAME.search(filename))
+
+
+def is_local(image):
+    """Check whether an image value names an uploaded file (not a URL or data URI)"""
+    return bool(image) and not image.startswith(('http', 'data:image'))
+
+
+def _folder(kind):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], kind)
+
+
+def _hashed_path(kind, extension, digest):
+    """(file name, path) for content with `digest`, creating the folder"""
+    filename = f'{digest.hexdigest()[:HASH_LENGTH]}{extension.lower()}'
+    folder = _folder(kind)
+    os.makedirs(folder, exist_ok=True)
+    return filename, os.path.join(folder, filename)
+
+
+def save_image(file, kind):
+    """Save an uploaded FileStorage under a content-hashed name. Returns the stored file name."""
+    extension = os.path.splitext(secure_filename(file.filename))[1]
+
+    digest = hashlib.sha256()
+    for block in iter(lambda: file.stream.read(64 * 1024), b''):
+        digest.update(block)
+    file.stream.seek(0)
+
+    filename, path = _hashed_path(kind, extension, digest)
+    if not os.path.exists(path):
+        file.save(path)
+    return filename
+
+
+# ========== DATA URIS ==========
+
+def is_data_uri(value):
+    return bool(value) and value[:5].lower() == 'data:'
+
+
+def _decode_data_uri(value):
+    """(bytes, file extension) of a data:image URI; ValueError if it isn't a base64 image Pillow can read"""
+    match = DATA_URI.match(value.strip())
+    if not match:
+        raise ValueError('not a base64 data:image URI')
+    try:
+        data = base64.b64decode(''.join(match.group(2).split()), validate=True)
+    except binascii.Error as e:
+        raise ValueError(f'invalid base64 data ({e})')
+
+    # Trust the bytes, not the declared type
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image_format = image.format
+    except UnidentifiedImageError:
+        raise ValueError('data is not a readable image')
+    if image_format not in DATA_URI_FORMATS:
+        raise ValueError(f'unsupported image format {image_format}')
+    return data, DATA_URI_FORMATS[image_format]
+
+
+def check_data_uri(value):
+    """Return why a data URI can't be accepted as a new image, or None if it can"""
+    limit = current_app.config['DATA_URI_MAX_LENGTH']
+    if len(value) > limit:
+        return f'Inline images must be under {limit // 1024} KB; upload the file instead'
+    try:
+        _decode_data_uri(value)
+    except ValueError as e:
+        return f'Invalid inline image: {e}'
+    return None
+
+
+def save_data_uri(value, kind):
+    """Store a data:image URI like an upload. Returns the stored file name; ValueError if it can't be read."""
+    data, extension = _decode_data_uri(value)
+    filename, path = _hashed_path(kind, extension, hashlib.sha256(data))
+    if not os.path.exists(path):
+        with open(f'{path}.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(f'{path}.tmp', path)
+    return filename
+
+
+# ========== VARIANTS ==========
+
+def variant_name(filename, width, extension):
+    return f'{os.path.splitext(filename)[0]}-{width}w.{extension}'
+
+
+def has_variants(kind, filename):
+    """Check whether all variants of an uploaded image exist (the largest WebP is written last)"""
+    if not is_local(filename):
+        return False
+    widths = current_app.config['IMAGE_VARIANT_WIDTHS']
+    return os.path.exists(os.path.join(_folder(kind), variant_name(filename, max(widths), 'webp')))
+
+
+def generate_variants(kind, filename):
+    """
+    Write the resized WebP and JPEG variants of an uploaded image. Widths
+    above the original's are stored at the original size, so every variant
+    exists. Safe to run again. Returns the number of files written.
+    """
+    folder = _folder(kind)
+    widths = sorted(current_app.config['IMAGE_VARIANT_WIDTHS'])
+
+    with Image.open(os.path.join(folder, filename)) as original:
+        image = ImageOps.exif_transpose(original)  # phone photos are often stored rotated
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+        if image.mode == 'RGBA':
+            # JPEG has no alpha, so flatten onto white like the card background
+            flattened = Image.new('RGB', image.size, 'white')
+            flattened.paste(image, mask=image.getchannel('A'))
+            image = flattened
+
+        written = 0
+        for extension in ('jpg', 'webp'):
+            pillow_format, options = VARIANT_FORMATS[extension]
+            for width in widths:
+                resized = image
+                if width < image.width:
+                    resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+                # Write under a temporary name so a half-written file is never served
+                path = os.path.join(folder, variant_name(filename, width, extension))
+                resized.save(f'{path}.tmp', pillow_format, **options)
+                os.replace(f'{path}.tmp', path)
+                written += 1
+    return written
+
+
+def srcset(kind, filename, extension):
+    """srcset attribute value listing the variants of an uploaded image in one format"""
+    return ', '.join(
+        f"{url_for('static', filename=f'uploads/{kind}/' + variant_name(filename, width, extension))} {width}w"
+        for width in sorted(current_app.config['IMAGE_VARIANT_WIDTHS'])
+    )
+
+
+def init_app(app):
+    """Expose image helpers to templates and register the generate-image-variants CLI command"""
+    app.add_template_global(srcset, 'image_srcset')
+    app.add_template_global(has_variants, 'image_has_variants')
+
+    @app.cli.command('generate-image-variants')
+    def generate_image_variants_command():
+        """Create missing resized variants for images uploaded before they existed."""
+        # catalog_cache imports this module, so it can't be imported at the top
+        import catalog_cache
+        from models import db, Category, Product
+
+        images = [('categories', image) for image, in db.session.query(Category.image).distinct()] \
+            + [('products', image) for image, in db.session.query(Product.image).distinct()]
+        done = {'categories': [], 'products': []}
+        for kind, image in images:
+            if not is_local(image) or has_variants(kind, image):
+                continue
+            try:
+                generate_variants(kind, image)
+                done[kind].append(image)
+            except OSError as e:
+                print(f"Skipped {kind}/{image}: {e}")
+        # Snapshots of the products showing them list the new variants
+        catalog_cache.bump_version([product_id for kind, done_images in done.items()
+                                    for product_id in catalog_cache.products_with_image(kind, done_images)])
+        db.session.commit()
+        print(f"Generated variants for {sum(map(len, done.values()))} images")
+
+    @app.cli.command('extract-inline-images')
+    def extract_inline_images_command():
+        """Move data:image URIs stored in image columns into upload files."""
+        import catalog_cache
+        from models import db, Category, Product
+
+        for model, kind in ((Category, 'categories'), (Product, 'products')):
+            table = model.__table__
+            last_id, moved, failed = 0, 0, 0
+            while True:
+                # Batches keyed on id, so the blobs are only loaded a few at a time
+                rows = db.session.execute(
+                    db.select(table.c.id, table.c.image)
+                    .where(table.c.id > last_id, table.c.image.like('data:%'))
+                    .order_by(table.c.id).limit(EXTRACT_BATCH_SIZE)
+                ).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+
+                updates = []
+                for row in rows:
+                    try:
+                        filename = save_data_uri(row.image, kind)
+                    except ValueError as e:
+                        print(f"Skipped {kind} #{row.id}: {e}")
+                        failed += 1
+                        continue
+                    if not has_variants(kind, filename):
+                        generate_variants(kind, filename)
+                    updates.append({'row_id': row.id, 'image': filename})
+
+                if updates:
+                    db.session.execute(table.update().where(table.c.id == bindparam('row_id')), updates)
+                    catalog_cache.bump_version(catalog_cache.products_with_image(
+                        kind, [update['image'] for update in updates]))
+                db.session.commit()
+                moved += len(updates)
+            print(f"{kind.title()}: moved {moved} inline images to files, {failed} left in place")